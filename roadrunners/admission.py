@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Local admission control of the build jobs on a host.
+
+Before a build starts, the host's load average and available memory are
+compared with what the running builds are expected to still need and
+with the memory the build's runner has needed in the past. The job is
+admitted, delayed until there is room, or handed back (``coyote.Blocked``)
+to be retried later. The state is kept in a directory shared by all the
+runner processes on the host::
+
+    <admission-state-dir>/running/<pid>-<id>.json  -- admitted jobs
+    <admission-state-dir>/waiting/<pid>-<id>.json  -- delayed jobs
+    <admission-state-dir>/footprints.json          -- memory per runner
+    <admission-state-dir>/admission.lock
+
+"""
+import os
+import json
+import time
+import uuid
+import errno
+import fcntl
+import logging
+import functools
+import threading
+import contextlib
+import multiprocessing
+
+import coyote
+from .command import recording
+from .config import assize
+from .metrics import phase, register_collector
+
+__all__ = ('AdmissionController', 'get_controller', 'admission_controlled',)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_LOAD = 1.0
+DEFAULT_MIN_FREE_MEMORY = 256 * 1024 ** 2
+DEFAULT_FOOTPRINT = 512 * 1024 ** 2
+DEFAULT_MAX_WAIT = 300
+DEFAULT_POLL_INTERVAL = 5
+# Weight of the latest job in a runner's footprint.
+FOOTPRINT_WEIGHT = 0.3
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+def available_memory():
+    """Bytes of memory available to new work, from /proc/meminfo."""
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            name, value = line.split(':', 1)
+            info[name] = int(value.split()[0]) * 1024
+    if 'MemAvailable' in info:
+        return info['MemAvailable']
+    # Older kernels.
+    return info['MemFree'] + info.get('Buffers', 0) + info.get('Cached', 0)
+
+
+def load_per_cpu():
+    """The one minute load average divided by the number of CPUs."""
+    return os.getloadavg()[0] / multiprocessing.cpu_count()
+
+
+class AdmissionController(object):
+    """Decides whether a job may start on this host.
+
+    A job is admitted while the load per CPU is below ``max_load`` and
+    the available memory, less what the running jobs are expected to
+    still claim, leaves ``min_free_memory`` after the job's own
+    expected footprint. Otherwise it waits, polling every
+    ``poll_interval`` seconds, for up to ``max_wait`` seconds.
+
+    """
+
+    def __init__(self, state_dir, max_load=DEFAULT_MAX_LOAD,
+                 min_free_memory=DEFAULT_MIN_FREE_MEMORY,
+                 default_footprint=DEFAULT_FOOTPRINT,
+                 max_wait=DEFAULT_MAX_WAIT,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        self.state_dir = os.path.abspath(state_dir)
+        self.max_load = max_load
+        self.min_free_memory = min_free_memory
+        self.default_footprint = default_footprint
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.running_dir = os.path.join(self.state_dir, 'running')
+        self.waiting_dir = os.path.join(self.state_dir, 'waiting')
+        self.footprints_path = os.path.join(self.state_dir,
+                                            'footprints.json')
+        self.lock_path = os.path.join(self.state_dir, 'admission.lock')
+        for path in (self.running_dir, self.waiting_dir):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as exc:
+                    if exc.errno != errno.EEXIST:
+                        raise
+        self.pid = os.getpid()
+        # Decisions made by this process, see ``stats``.
+        self.counters = {'admitted': 0, 'delayed': 0, 'requeued': 0}
+        self._counters_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _count(self, name):
+        with self._counters_lock:
+            self.counters[name] += 1
+
+    def _entries(self, directory):
+        """The live entries in ``directory``; those of dead processes
+        are removed.
+        """
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                pid = int(name.split('-', 1)[0])
+            except ValueError:
+                continue
+            if not _pid_alive(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    entries.append(json.load(f))
+            except (IOError, ValueError):
+                continue
+        return entries
+
+    def _add_entry(self, directory, runner, footprint):
+        path = os.path.join(directory, '{0}-{1}.json'.format(
+            os.getpid(), uuid.uuid4().hex))
+        with open(path, 'w') as f:
+            json.dump({'runner': runner, 'footprint': footprint,
+                       'since': time.time()}, f)
+        return path
+
+    def footprint(self, runner):
+        """Expected peak memory use of a job of ``runner``, in bytes."""
+        try:
+            with open(self.footprints_path) as f:
+                footprints = json.load(f)
+        except (IOError, ValueError):
+            footprints = {}
+        return int(footprints.get(runner, {}).get('peak_rss',
+                                                  self.default_footprint))
+
+    def record_footprint(self, runner, peak_rss):
+        """Fold the ``peak_rss`` (bytes) of a finished job into the
+        history of ``runner``.
+        """
+        with self._locked():
+            try:
+                with open(self.footprints_path) as f:
+                    footprints = json.load(f)
+            except (IOError, ValueError):
+                footprints = {}
+            entry = footprints.setdefault(runner, {'jobs': 0})
+            if entry['jobs'] == 0:
+                entry['peak_rss'] = peak_rss
+            else:
+                # Lean towards the larger of the old and new values,
+                #   since underestimating costs more than overestimating.
+                average = (FOOTPRINT_WEIGHT * peak_rss
+                           + (1 - FOOTPRINT_WEIGHT) * entry['peak_rss'])
+                entry['peak_rss'] = int(max(average, peak_rss * 0.9))
+            entry['jobs'] += 1
+            tmp_path = '{0}.{1}.tmp'.format(self.footprints_path,
+                                            os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(footprints, f)
+            os.rename(tmp_path, self.footprints_path)
+
+    def decide(self, runner, footprint):
+        """Whether a job of ``runner`` expected to use ``footprint``
+        bytes may start now. Returns an (admit, reason) tuple.
+        """
+        load = load_per_cpu()
+        if load >= self.max_load:
+            return False, "load per CPU {0:.2f} >= {1}".format(
+                load, self.max_load)
+        # The running jobs have not necessarily reached their peak, so
+        #   what they are expected to use is held back.
+        reserved = sum(entry['footprint']
+                       for entry in self._entries(self.running_dir))
+        available = available_memory()
+        if available - reserved - footprint < self.min_free_memory:
+            return False, ("{0} bytes available, {1} reserved by running "
+                           "jobs, {2} needed".format(available, reserved,
+                                                     footprint))
+        return True, "load per CPU {0:.2f}, {1} bytes available".format(
+            load, available)
+
+    def _wait_for_room(self, runner, footprint):
+        """Wait until a job of ``runner`` may start and register it as
+        running. Returns the path of its entry and the reason it was
+        admitted.
+        """
+        deadline = time.time() + self.max_wait
+        waiting_path = None
+        try:
+            while True:
+                with self._locked():
+                    admitted, reason = self.decide(runner, footprint)
+                    if admitted:
+                        path = self._add_entry(self.running_dir, runner,
+                                               footprint)
+                        return path, reason
+                if time.time() >= deadline:
+                    self._count('requeued')
+                    logger.info("Requeueing {0} job: {1}".format(runner,
+                                                                 reason))
+                    raise coyote.Blocked("Not enough room on this host to "
+                                         "build: {0}".format(reason))
+                if waiting_path is None:
+                    self._count('delayed')
+                    logger.info("Delaying {0} job: {1}".format(runner,
+                                                               reason))
+                    waiting_path = self._add_entry(self.waiting_dir, runner,
+                                                   footprint)
+                time.sleep(self.poll_interval)
+        finally:
+            if waiting_path is not None:
+                os.remove(waiting_path)
+
+    @contextlib.contextmanager
+    def admit(self, runner):
+        """Hold a place for a job of ``runner`` for the duration of the
+        context, waiting for room as needed. Raises ``coyote.Blocked``
+        when no room was made within ``max_wait`` seconds. The memory
+        used by the commands the job runs is recorded as the runner's
+        footprint.
+        """
+        footprint = self.footprint(runner)
+        with phase('admission'):
+            running_path, reason = self._wait_for_room(runner, footprint)
+        self._count('admitted')
+        logger.debug("Admitted {0} job: {1}".format(runner, reason))
+        try:
+            with recording() as commands:
+                yield
+        finally:
+            os.remove(running_path)
+            peak_rss = max([c.peak_rss for c in commands] or [0])
+            if peak_rss:
+                self.record_footprint(runner, peak_rss)
+
+    def stats(self):
+        """The admission decisions made by this process and the state of
+        the host, as a dict.
+        """
+        with self._counters_lock:
+            stats = dict(self.counters)
+        stats.update({
+            'running': len(self._entries(self.running_dir)),
+            'waiting': len(self._entries(self.waiting_dir)),
+            'load_per_cpu': load_per_cpu(),
+            'available_memory': available_memory(),
+            })
+        return stats
+
+
+    def prometheus_samples(self):
+        """The ``stats`` as samples for ``roadrunners.metrics``."""
+        stats = self.stats()
+        samples = []
+        for decision in ('admitted', 'delayed', 'requeued'):
+            samples.append(('roadrunners_admission_decisions_total',
+                            'counter', "Admission decisions made.",
+                            {'decision': decision}, stats[decision]))
+        samples.extend([
+            ('roadrunners_admission_running_jobs', 'gauge',
+             "Jobs admitted and running on the host.", {},
+             stats['running']),
+            ('roadrunners_admission_waiting_jobs', 'gauge',
+             "Jobs waiting for admission on the host.", {},
+             stats['waiting']),
+            ('roadrunners_admission_load_per_cpu', 'gauge',
+             "One minute load average per CPU.", {}, stats['load_per_cpu']),
+            ('roadrunners_admission_available_memory_bytes', 'gauge',
+             "Memory available to new work.", {},
+             stats['available_memory']),
+            ])
+        return samples
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(settings):
+    """Return the admission controller configured in the runner
+    ``settings`` or None when admission control is not enabled.
+
+    Available settings:
+
+    - **admission-state-dir** - Directory shared by the runners on the
+      host. Admission control is disabled when this is not set.
+    - **admission-max-load** - One minute load average per CPU at which
+      jobs are held back. (default: 1.0)
+    - **admission-min-free-memory** - Memory kept free, on top of what
+      the running jobs are expected to use, e.g. ``1G``. (default: 256M)
+    - **admission-default-footprint** - Expected memory use of a job of
+      a runner without history. (default: 512M)
+    - **admission-max-wait** - Seconds a job is held back before it is
+      handed back to the queue. (default: 300)
+    - **admission-poll-interval** - Seconds between checks while a job
+      is held back. (default: 5)
+
+    """
+    state_dir = settings.get('admission-state-dir', None)
+    if not state_dir:
+        return None
+    key = os.path.abspath(state_dir)
+    with _controllers_lock:
+        controller = _controllers.get(key)
+        if controller is None or controller.pid != os.getpid():
+            controller = AdmissionController(
+                state_dir,
+                max_load=float(settings.get('admission-max-load',
+                                            DEFAULT_MAX_LOAD)),
+                min_free_memory=assize(settings.get(
+                    'admission-min-free-memory', DEFAULT_MIN_FREE_MEMORY)),
+                default_footprint=assize(settings.get(
+                    'admission-default-footprint', DEFAULT_FOOTPRINT)),
+                max_wait=float(settings.get('admission-max-wait',
+                                            DEFAULT_MAX_WAIT)),
+                poll_interval=float(settings.get('admission-poll-interval',
+                                                 DEFAULT_POLL_INTERVAL)))
+            _controllers[key] = controller
+            register_collector(controller.prometheus_samples)
+        return controller
+
+
+def admission_controlled(runner):
+    """Decorate a runner function (``build_request, settings``) so its
+    jobs go through the admission controller configured in the settings,
+    if any. The ``runner`` name is used to keep the footprint history.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(build_request, settings={}):
+            controller = get_controller(settings)
+            if controller is None:
+                return func(build_request, settings)
+            with controller.admit(runner):
+                return func(build_request, settings)
+        return wrapper
+    return decorator
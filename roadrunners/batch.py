@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Run a runner for many collections at once, outside of the queue. This is
+meant for bulk re-exports with the HTTP-bound legacy runners
+(``make_collxml`` and ``make_completezip``), which spend their time
+waiting on the repository, so that many of them can share one process.
+
+"""
+import sys
+import time
+import logging
+import threading
+from urlparse import urlsplit
+from multiprocessing.pool import ThreadPool
+
+__all__ = ('BuildRequest', 'BatchResult', 'run_batch', 'main',)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_PER_HOST = 4
+
+
+class _Attributes(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class BuildRequest(object):
+    """Enough of a coyote build request to call the runners with, for
+    the collection ``pkg_name`` at ``version`` in the repository at
+    ``uri``.
+    """
+
+    def __init__(self, pkg_name, version, uri):
+        self.pkg_name = pkg_name
+        self.version = version
+        self.transport = _Attributes(uri=uri)
+        package = _Attributes(version=version)
+        self.job = _Attributes(packageinstance=_Attributes(package=package))
+        self.buildstamp = None
+
+    def get_package(self):
+        return self.pkg_name
+
+    def get_version(self):
+        return self.version
+
+    def stamp_request(self):
+        self.buildstamp = time.strftime('%Y%m%d%H%M%S')
+
+    def get_buildstamp(self):
+        return self.buildstamp
+
+
+class BatchResult(object):
+    """The outcome of one job of a batch: the ``artifacts`` the runner
+    returned or the ``error`` it raised.
+    """
+
+    def __init__(self, pkg_name, version, uri):
+        self.pkg_name = pkg_name
+        self.version = version
+        self.uri = uri
+        self.artifacts = None
+        self.error = None
+        self.duration = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<BatchResult {0}/{1} {2}>'.format(
+            self.pkg_name, self.version,
+            self.ok and 'ok' or type(self.error).__name__)
+
+
+def run_batch(runner, items, settings={}, uri=None):
+    """Run the ``runner`` function for each of the ``items``, which are
+    ``(id, version)`` pairs or ``(id, version, uri)`` triples, with
+    ``uri`` the default repository. The jobs run concurrently, a failed
+    job does not stop the others. Returns a ``BatchResult`` for each
+    item, in the same order.
+
+    Available settings, in addition to those of the runner:
+
+    - **batch-concurrency** - Number of jobs running at the same time.
+      (default: 16)
+    - **batch-per-host** - Number of jobs running at the same time
+      against each repository host. (default: 4) The ``http-pool-maxsize``
+      should be at least this, so that the connections are reused.
+
+    """
+    concurrency = int(settings.get('batch-concurrency', DEFAULT_CONCURRENCY))
+    per_host = int(settings.get('batch-per-host', DEFAULT_PER_HOST))
+    results = []
+    for item in items:
+        if len(item) == 2:
+            item = tuple(item) + (uri,)
+        results.append(BatchResult(*item))
+    host_slots = {}
+    for result in results:
+        host = urlsplit(result.uri).netloc.lower()
+        if host not in host_slots:
+            host_slots[host] = threading.BoundedSemaphore(per_host)
+
+    def run_job(result):
+        request = BuildRequest(result.pkg_name, result.version, result.uri)
+        with host_slots[urlsplit(result.uri).netloc.lower()]:
+            started = time.time()
+            try:
+                result.artifacts = runner(request, settings)
+            except Exception as exc:
+                logger.warning("{0}/{1} failed: {2}".format(
+                    result.pkg_name, result.version, exc))
+                result.error = exc
+            result.duration = time.time() - started
+
+    if results:
+        pool = ThreadPool(max(1, min(concurrency, len(results))))
+        try:
+            pool.map(run_job, results, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    failed = len([r for r in results if not r.ok])
+    logger.info("Batch of {0} jobs done, {1} failed.".format(len(results),
+                                                            failed))
+    return results
+
+
+def _resolve_runner(spec):
+    """Find the runner function of a ``runner`` setting, e.g.
+    ``python!roadrunners.legacy:make_completezip``.
+    """
+    spec = spec.split('!', 1)[-1]
+    module_name, name = spec.split(':')
+    module = __import__(module_name, fromlist=[name])
+    return getattr(module, name)
+
+
+def main(argv=None):
+    import argparse
+    from ConfigParser import RawConfigParser
+    parser = argparse.ArgumentParser(
+        description="Run a runner for many collections, read as "
+                    "'<id> <version> [<uri>]' lines")
+    parser.add_argument('config', help="configuration (ini) file")
+    parser.add_argument('runner', help="runner name, e.g. completezip for "
+                                       "the [runner:completezip] section")
+    parser.add_argument('input', nargs='?', default='-',
+                        help="file of collections (default: stdin)")
+    parser.add_argument('--uri', default='http://cnx.org',
+                        help="repository of the collections without one")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    config = RawConfigParser()
+    config.read(args.config)
+    settings = dict(config.items('runner:' + args.runner))
+    runner = _resolve_runner(settings['runner'])
+    if args.input == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.input) as f:
+            lines = f.readlines()
+    items = [line.split() for line in lines
+             if line.strip() and not line.startswith('#')]
+
+    results = run_batch(runner, items, settings, args.uri)
+    for result in results:
+        if result.ok:
+            print('{0} {1} ok {2}'.format(result.pkg_name, result.version,
+                                          ' '.join(result.artifacts)))
+        else:
+            print('{0} {1} failed {2}'.format(result.pkg_name,
+                                              result.version, result.error))
+    return any(not r.ok for r in results) and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
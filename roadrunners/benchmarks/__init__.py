@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Benchmarks of the runners against synthetic collections.
+
+- ``synthetic`` generates complete and offline zips of a given number
+  of modules and images.
+- ``repository`` serves them over HTTP the way the (Plone based)
+  repository does, with a configurable latency and bandwidth.
+- ``stubs`` installs stand-ins for the oer.exports, cnx-buildout and
+  RhaptosPrint build scripts.
+- ``harness`` runs the jobs, reports the throughput, latency
+  percentiles and peak memory, and compares them to a stored baseline.
+
+Run ``python -m roadrunners.benchmarks --help`` for the options.
+
+"""
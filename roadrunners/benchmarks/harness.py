@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Run the runners and the download, unpack and publish paths against a
+synthetic collection, report their throughput, latency and peak memory
+and compare these to a stored baseline.
+
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+from . import synthetic, stubs
+from .repository import FakeRepository
+from ..batch import BuildRequest
+from ..config import assize
+from ..metrics import phase
+from ..publish import publish
+from ..utils import get_zip, unpack_zip
+
+__all__ = ('RUNNERS', 'BuildRequest', 'run_runner', 'run_get_zip',
+           'run_unpack_zip', 'run_publish', 'compare', 'main',)
+
+logger = logging.getLogger(__name__)
+
+# Runner names and their functions, as in the ``runner`` setting.
+RUNNERS = (
+    ('collxml', 'roadrunners.legacy:make_collxml'),
+    ('completezip', 'roadrunners.legacy:make_completezip'),
+    ('offlinezip', 'roadrunners.legacy:make_offlinezip'),
+    ('epub', 'roadrunners.epub:make_epub'),
+    ('pdf', 'roadrunners.pdf:make_pdf'),
+    ('print', 'roadrunners.legacy:make_print'),
+    )
+# Increases of latency smaller than this many seconds are noise.
+MIN_REGRESSION = 0.005
+
+
+def _resolve(spec):
+    module_name, name = spec.split(':')
+    module = __import__(module_name, fromlist=[name])
+    return getattr(module, name)
+
+
+def percentile(values, pct):
+    """The ``pct`` percentile (nearest rank) of ``values``."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def _summarize(name, latencies, failures, duration, peak_rss, size=0,
+               phases=None):
+    return {'name': name,
+            'runs': len(latencies) + failures,
+            'failures': failures,
+            'duration': duration,
+            'throughput': duration and len(latencies) / duration or 0,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies and max(latencies) or None,
+            'peak_rss': peak_rss,
+            'bytes': size,
+            'phases': phases or {},
+            }
+
+
+def run_runner(name, uri, settings, jobs=5, concurrency=1):
+    """Run ``jobs`` jobs of the runner ``name`` (see ``RUNNERS``),
+    ``concurrency`` at a time, against the repository at ``uri``. Each
+    job builds a collection of its own. The peak memory and the phase
+    timings are those recorded by ``roadrunners.metrics``.
+    """
+    runner = _resolve(dict(RUNNERS)[name])
+    settings = dict(settings)
+    metrics_file = os.path.join(settings['output-dir'],
+                                '{0}.metrics.jsonl'.format(name))
+    settings['metrics-file'] = metrics_file
+    # Measure the builds, not the skipping of current outputs.
+    settings['force'] = 'true'
+    lock = threading.Lock()
+    latencies = []
+    failures = [0]
+
+    def run_job(number):
+        request = BuildRequest('col{0}'.format(10000 + number), '1.1', uri)
+        started = time.time()
+        try:
+            runner(request, settings)
+        except Exception:
+            logger.exception("{0} job {1} failed.".format(name, number))
+            with lock:
+                failures[0] += 1
+            return
+        with lock:
+            latencies.append(time.time() - started)
+
+    started = time.time()
+    pool = ThreadPool(concurrency)
+    try:
+        pool.map(run_job, range(jobs))
+    finally:
+        pool.close()
+        pool.join()
+    duration = time.time() - started
+
+    peak_rss = 0
+    phases = {}
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            for line in f:
+                job = json.loads(line)
+                peak_rss = max(peak_rss, job['peak_rss'])
+                for measured in job['phases']:
+                    phases[measured['name']] = (phases.get(measured['name'],
+                                                           0)
+                                                + measured['duration'])
+        os.remove(metrics_file)
+    phases = dict((key, value / jobs) for key, value in phases.items())
+    return _summarize(name, latencies, failures[0], duration, peak_rss,
+                      phases=phases)
+
+
+def _time_iterations(name, iterations, setup, func):
+    """Time ``func`` on what ``setup`` returns, ``iterations`` times."""
+    latencies = []
+    peak_rss = 0
+    size = 0
+    duration = 0
+    for i in range(iterations):
+        args = setup(i)
+        started = time.time()
+        with phase(name) as measured:
+            size = func(*args)
+        latencies.append(time.time() - started)
+        duration += latencies[-1]
+        peak_rss = max(peak_rss, measured.peak_rss)
+    return _summarize(name, latencies, 0, duration, peak_rss, size)
+
+
+def run_get_zip(uri, work_dir, settings={}, iterations=5):
+    """Benchmark ``roadrunners.utils.get_zip`` (without unpacking)."""
+    def setup(i):
+        working_dir = tempfile.mkdtemp(dir=work_dir)
+        return (i, working_dir)
+
+    def fetch(i, working_dir):
+        try:
+            filepath = get_zip('col{0}'.format(20000 + i), '1.1', uri,
+                               working_dir, unpack=False, settings=settings)
+            return os.path.getsize(filepath)
+        finally:
+            shutil.rmtree(working_dir)
+    return _time_iterations('get_zip', iterations, setup, fetch)
+
+
+def run_unpack_zip(filepath, work_dir, iterations=5):
+    """Benchmark ``roadrunners.utils.unpack_zip`` on ``filepath``."""
+    def setup(i):
+        return (tempfile.mkdtemp(dir=work_dir),)
+
+    def unpack(working_dir):
+        try:
+            unpack_zip(filepath, working_dir)
+            return os.path.getsize(filepath)
+        finally:
+            shutil.rmtree(working_dir)
+    return _time_iterations('unpack_zip', iterations, setup, unpack)
+
+
+def run_publish(filepath, work_dir, iterations=5):
+    """Benchmark ``roadrunners.publish.publish``, moving a copy of
+    ``filepath`` into place.
+    """
+    def setup(i):
+        source_dir = tempfile.mkdtemp(dir=work_dir)
+        output_dir = tempfile.mkdtemp(dir=work_dir)
+        source = os.path.join(source_dir, os.path.basename(filepath))
+        shutil.copy(filepath, source)
+        return (source, output_dir)
+
+    def move(source, output_dir):
+        try:
+            publish(source, output_dir)
+            return os.path.getsize(filepath)
+        finally:
+            shutil.rmtree(os.path.dirname(source))
+            shutil.rmtree(output_dir)
+    return _time_iterations('publish', iterations, setup, move)
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Compare the ``results`` to those of the ``baseline``. Returns a
+    list of messages, one for each median latency or peak memory that
+    grew by more than ``tolerance`` (a fraction), and for each benchmark
+    with more failures than before.
+    """
+    regressions = []
+    for result in results:
+        name = result['name']
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result['failures'] > previous['failures']:
+            regressions.append("{0}: {1} failures, was {2}".format(
+                name, result['failures'], previous['failures']))
+        if result['p50'] is not None and previous['p50'] is not None \
+           and result['p50'] > previous['p50'] * (1 + tolerance) \
+           and result['p50'] - previous['p50'] > MIN_REGRESSION:
+            regressions.append("{0}: median latency {1:.3f}s, was "
+                               "{2:.3f}s".format(name, result['p50'],
+                                                 previous['p50']))
+        if result['peak_rss'] and previous['peak_rss'] \
+           and result['peak_rss'] > previous['peak_rss'] * (1 + tolerance):
+            regressions.append("{0}: peak memory {1} bytes, was "
+                               "{2} bytes".format(name, result['peak_rss'],
+                                                  previous['peak_rss']))
+    return regressions
+
+
+def load_baseline(path):
+    """Load a baseline saved by ``save_baseline``. Returns the
+    parameters it was made with and its results by name.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    return data['parameters'], dict((result['name'], result)
+                                    for result in data['results'])
+
+
+def save_baseline(path, parameters, results):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'parameters': parameters, 'results': results}, f,
+                  indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def format_report(results):
+    lines = ['{0:<12} {1:>5} {2:>5} {3:>8} {4:>8} {5:>8} {6:>8} '
+             '{7:>9}'.format('benchmark', 'runs', 'fail', 'per sec',
+                             'p50 s', 'p90 s', 'p99 s', 'peak MiB')]
+    for result in results:
+        latencies = ['{0:.3f}'.format(result[key])
+                     if result[key] is not None else '-'
+                     for key in ('p50', 'p90', 'p99')]
+        lines.append('{0:<12} {1:>5} {2:>5} {3:>8.2f} {4:>8} {5:>8} '
+                     '{6:>8} {7:>9.1f}'.format(
+                         result['name'], result['runs'], result['failures'],
+                         result['throughput'], latencies[0], latencies[1],
+                         latencies[2], result['peak_rss'] / 1024.0 ** 2))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark the runners against a synthetic collection")
+    parser.add_argument('--runners', default=','.join(n for n, s in RUNNERS),
+                        help="comma separated runners to run")
+    parser.add_argument('--jobs', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=5,
+                        help="runs of the get_zip, unpack_zip and publish "
+                             "benchmarks")
+    parser.add_argument('--modules', type=int, default=50)
+    parser.add_argument('--images', type=int, default=2,
+                        help="images per module")
+    parser.add_argument('--image-size', type=assize, default='64K')
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds before each response")
+    parser.add_argument('--bandwidth', type=assize, default=None,
+                        help="bytes per second of each response")
+    parser.add_argument('--build-time', type=float, default=0,
+                        help="seconds the stub build scripts take")
+    parser.add_argument('--output-size', type=assize, default='1M')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='SETTING=VALUE',
+                        help="runner setting, e.g. cache-dir=/tmp/cache")
+    parser.add_argument('--baseline', help="baseline file to compare to")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    parameters = dict((key, getattr(args, key)) for key in (
+        'jobs', 'concurrency', 'iterations', 'modules', 'images',
+        'image_size', 'latency', 'bandwidth', 'build_time', 'output_size'))
+    work_dir = tempfile.mkdtemp()
+    try:
+        data_dir = os.path.join(work_dir, 'data')
+        os.mkdir(data_dir)
+        options = dict(modules=args.modules, images=args.images,
+                       image_size=args.image_size)
+        complete = synthetic.make_zip(
+            os.path.join(data_dir, 'complete.zip'), 'col10000', '1.1',
+            **options)
+        offline = synthetic.make_zip(
+            os.path.join(data_dir, 'offline.zip'), 'col10000', '1.1',
+            zipname='offline', **options)
+        collxml = os.path.join(data_dir, 'collection.xml')
+        with open(collxml, 'w') as f:
+            f.write(synthetic.make_collxml('col10000', '1.1', args.modules))
+
+        settings = stubs.install_stubs(os.path.join(work_dir, 'stubs'),
+                                       args.build_time, args.output_size)
+        settings.update({'python': sys.executable,
+                         'username': 'benchmark', 'password': 'benchmark'})
+        settings.update(item.split('=', 1) for item in args.set)
+
+        results = []
+        with FakeRepository(complete, offline, collxml, args.latency,
+                            args.bandwidth) as repository:
+            results.append(run_get_zip(repository.uri, work_dir, settings,
+                                       args.iterations))
+            results.append(run_unpack_zip(complete, work_dir,
+                                          args.iterations))
+            results.append(run_publish(offline, work_dir, args.iterations))
+            for name in args.runners.split(','):
+                output_dir = os.path.join(work_dir, name)
+                os.mkdir(output_dir)
+                runner_settings = dict(settings, **{'output-dir': output_dir})
+                results.append(run_runner(name, repository.uri,
+                                          runner_settings, args.jobs,
+                                          args.concurrency))
+    finally:
+        shutil.rmtree(work_dir)
+
+    print(format_report(results))
+    if args.baseline is None:
+        return 0
+    if args.save_baseline:
+        save_baseline(args.baseline, parameters, results)
+        return 0
+    baseline_parameters, baseline = load_baseline(args.baseline)
+    if baseline_parameters != parameters:
+        print("The baseline was made with other parameters: "
+              "{0}".format(baseline_parameters))
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("Regression: " + regression)
+    return regressions and 1 or 0
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+A local stand-in for the (Plone based) repository, serving a synthetic
+collection with a configurable latency and bandwidth.
+
+"""
+import os
+import time
+import socket
+import logging
+import threading
+import BaseHTTPServer
+import SocketServer
+
+__all__ = ('FakeRepository',)
+
+logger = logging.getLogger(__name__)
+
+# Size of the pieces the bandwidth is metered in.
+CHUNK_SIZE = 16 * 1024
+
+# The views of a collection and the kind of file each serves.
+VIEWS = {
+    'complete': 'complete',
+    'create_complete': 'complete',
+    'offline': 'offline',
+    'source_create': 'collxml',
+    }
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = set()
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        """Close the (kept alive) connections of the clients."""
+        for request in list(self.connections):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        repository = self.server.repository
+        # /content/<id>/<version>/<view>
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        filepath = None
+        if len(parts) == 4 and parts[0] == 'content':
+            filepath = repository.files.get(VIEWS.get(parts[3]))
+        repository._count('requests')
+        if repository.latency:
+            time.sleep(repository.latency)
+        if filepath is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        stat = os.stat(filepath)
+        etag = '"{0}-{1}"'.format(stat.st_size, int(stat.st_mtime))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(stat.st_size))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        with open(filepath, 'rb') as f:
+            while True:
+                started = time.time()
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                repository._count('bytes_sent', len(chunk))
+                if repository.bandwidth:
+                    remaining = (float(len(chunk)) / repository.bandwidth
+                                 - (time.time() - started))
+                    if remaining > 0:
+                        time.sleep(remaining)
+
+
+class FakeRepository(object):
+    """Serve the ``complete`` and ``offline`` zips and the ``collxml``
+    (collection.xml) files for every collection id and version asked
+    for. Each response waits ``latency`` seconds before it starts and is
+    sent at ``bandwidth`` bytes per second, when given.
+
+    Use it as a context manager, its ``uri`` is that of the
+    ``build_request.transport``.
+    """
+
+    def __init__(self, complete=None, offline=None, collxml=None,
+                 latency=0, bandwidth=None, host='127.0.0.1', port=0):
+        self.files = dict((kind, path) for kind, path
+                          in (('complete', complete), ('offline', offline),
+                              ('collxml', collxml))
+                          if path is not None)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.repository = self
+        self._thread = None
+
+    @property
+    def uri(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.close_connections()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
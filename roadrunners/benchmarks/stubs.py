@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Stand-ins for the build scripts of oer.exports, cnx-buildout and
+Products.RhaptosPrint. They take the same arguments as the real ones,
+read the collection they are given, spend ``build_time`` seconds and
+write an ``output_size`` bytes result where the runner expects it.
+
+"""
+import os
+import stat
+
+__all__ = ('install_stubs',)
+
+OER_EXPORTS_SCRIPT = """\
+# Stand-in for an oer.exports script.
+import os
+import sys
+import time
+
+args = sys.argv[1:]
+if '-o' in args:
+    output = args[args.index('-o') + 1]
+else:
+    output = args[-1]
+if '-d' in args:
+    collection_dir = args[args.index('-d') + 1]
+else:
+    collection_dir = args[0]
+# Read the collection, as the real scripts do.
+for dirpath, dirnames, filenames in os.walk(collection_dir):
+    for filename in filenames:
+        with open(os.path.join(dirpath, filename), 'rb') as f:
+            while f.read(65536):
+                pass
+time.sleep({build_time!r})
+with open(output, 'wb') as f:
+    f.write(os.urandom({output_size!r}))
+"""
+
+# Arguments: <repository> <id> <version> <working directory>
+#   <completezip> <offlinezip> <epub> <oer.exports directory>
+CNX_BUILDOUT_SCRIPT = """\
+#!/bin/bash
+# Stand-in for cnx-buildout's content2epub.bash.
+set -e
+cd "$4"
+unzip -q -o "$5"
+mkdir -p "$2_$3_complete"
+sleep {build_time!r}
+head -c {output_size!r} /dev/urandom > "$2_$3_complete/$6"
+head -c {output_size!r} /dev/urandom > "$7"
+"""
+
+PRINT_MAKEFILE = """\
+# Stand-in for the RhaptosPrint makefiles.
+%.pdf:
+\tsleep {build_time!r}
+\thead -c {output_size!r} /dev/urandom > $@
+"""
+
+PRINT_STYLE_XSL = """\
+<?xml version="1.0"?>
+<xsl:stylesheet version="1.0"
+                xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+                xmlns:col="http://cnx.rice.edu/collxml">
+  <xsl:output method="text"/>
+  <xsl:template match="/">
+    <xsl:value-of select="//col:param[@name='print-style']/@value"/>
+  </xsl:template>
+</xsl:stylesheet>
+"""
+
+
+def _write(path, content, executable=False):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(content)
+    if executable:
+        os.chmod(path, os.stat(path).st_mode
+                 | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def install_stubs(directory, build_time=0, output_size=1024 * 1024):
+    """Install the stand-in build scripts under ``directory``. Returns
+    the runner settings pointing at them.
+    """
+    variables = dict(build_time=build_time, output_size=output_size)
+    oerexports_dir = os.path.join(directory, 'oer.exports')
+    cnxbuildout_dir = os.path.join(directory, 'cnx-buildout')
+    print_dir = os.path.join(directory, 'print')
+
+    script = OER_EXPORTS_SCRIPT.format(**variables)
+    _write(os.path.join(oerexports_dir, 'content2epub.py'), script)
+    _write(os.path.join(oerexports_dir, 'collectiondbk2pdf.py'), script)
+    _write(os.path.join(oerexports_dir, 'xsl', 'collxml-print-style.xsl'),
+           PRINT_STYLE_XSL)
+    _write(os.path.join(oerexports_dir, 'xsl', 'dbk2epub.xsl'), '')
+    _write(os.path.join(oerexports_dir, 'static', 'content.css'), '')
+    _write(os.path.join(cnxbuildout_dir, 'scripts', 'content2epub.bash'),
+           CNX_BUILDOUT_SCRIPT.format(**variables), executable=True)
+    for name in ('course_print.mak', 'module_print.mak'):
+        _write(os.path.join(print_dir, name),
+               PRINT_MAKEFILE.format(**variables))
+
+    return {'oer.exports-dir': oerexports_dir,
+            'cnx-buildout-dir': cnxbuildout_dir,
+            'print-dir': print_dir,
+            'pdf-generator': '/bin/true',
+            }
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Synthetic collections, packed the way the repository packs complete and
+offline zips.
+
+"""
+import os
+import zipfile
+
+__all__ = ('make_collxml', 'make_zip',)
+
+COLLXML_TEMPLATE = """\
+<?xml version="1.0"?>
+<col:collection xmlns="http://cnx.rice.edu/collxml"
+                xmlns:col="http://cnx.rice.edu/collxml"
+                xmlns:md="http://cnx.rice.edu/mdml"
+                xml:lang="en">
+  <metadata mdml-version="0.5">
+    <md:content-id>{id}</md:content-id>
+    <md:title>Synthetic collection {id}</md:title>
+    <md:version>{version}</md:version>
+  </metadata>
+  <col:parameters>
+    <col:param name="print-style" value="{print_style}"/>
+  </col:parameters>
+  <col:content>
+{modules}
+  </col:content>
+</col:collection>
+"""
+COLLXML_MODULE = """\
+    <col:module document="{module}" version="1.1"/>"""
+
+CNXML_TEMPLATE = """\
+<?xml version="1.0"?>
+<document xmlns="http://cnx.rice.edu/cnxml" id="{module}"
+          cnxml-version="0.7" module-id="{module}">
+  <title>Module {module}</title>
+  <content>
+{paragraphs}
+  </content>
+</document>
+"""
+CNXML_PARAGRAPH = """\
+    <para id="{module}-p{number}">{text}</para>"""
+CNXML_IMAGE = """\
+    <figure id="{module}-f{number}"><media alt=""><image \
+mime-type="image/png" src="{filename}"/></media></figure>"""
+
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua. ")
+
+
+def _module_ids(modules):
+    return ['m{0}'.format(10000 + i) for i in range(modules)]
+
+
+def make_collxml(pkg_name, version, modules=10, print_style='ccap-physics'):
+    """Return the collection.xml of a synthetic collection."""
+    return COLLXML_TEMPLATE.format(
+        id=pkg_name, version=version, print_style=print_style,
+        modules='\n'.join(COLLXML_MODULE.format(module=module)
+                          for module in _module_ids(modules)))
+
+
+def _make_cnxml(module, paragraphs, images):
+    content = [CNXML_PARAGRAPH.format(module=module, number=i,
+                                      text=LOREM * 4)
+               for i in range(paragraphs)]
+    content.extend(CNXML_IMAGE.format(module=module, number=i,
+                                      filename=filename)
+                   for i, filename in enumerate(images))
+    return CNXML_TEMPLATE.format(module=module,
+                                 paragraphs='\n'.join(content))
+
+
+def make_zip(filepath, pkg_name, version, modules=10, images=2,
+             image_size=64 * 1024, paragraphs=20, zipname='complete',
+             print_style='ccap-physics'):
+    """Write a synthetic ``zipname`` (complete or offline) zip of
+    ``modules`` modules, each with ``paragraphs`` paragraphs of text and
+    ``images`` images of ``image_size`` bytes, to ``filepath``. The image
+    data is random, so it does not compress, like the PNG and JPEG files
+    of real collections. Returns the ``filepath``.
+    """
+    top_level = '{0}_{1}_complete'.format(pkg_name, version)
+    if zipname == 'offline':
+        # The offline zip carries the collection in a content directory,
+        #   next to the HTML rendering of it.
+        content_dir = '{0}/content'.format(top_level)
+    else:
+        content_dir = top_level
+    with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('{0}/collection.xml'.format(content_dir),
+                          make_collxml(pkg_name, version, modules,
+                                       print_style))
+        if zipname == 'offline':
+            zip_file.writestr('{0}/start.html'.format(top_level),
+                              '<html><body></body></html>')
+        for module in _module_ids(modules):
+            filenames = ['image{0}.png'.format(i) for i in range(images)]
+            module_dir = '{0}/{1}'.format(content_dir, module)
+            zip_file.writestr('{0}/index.cnxml'.format(module_dir),
+                              _make_cnxml(module, paragraphs, filenames))
+            for filename in filenames:
+                info = zipfile.ZipInfo('{0}/{1}'.format(module_dir,
+                                                        filename))
+                # Already compressed data is stored, not deflated.
+                info.compress_type = zipfile.ZIP_STORED
+                info.external_attr = 0o644 << 16
+                zip_file.writestr(info, os.urandom(image_size))
+    return filepath
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Shared on-disk cache of the artifacts (completezip, offlinezip)
+downloaded from the repository.
+
+Artifacts are stored by the SHA-256 of their content. A separate set of
+entries maps a (host, id, version, zipname) key to the content hash, so
+one download can feed every format built for a collection version.
+The directory layout is::
+
+    <cache-dir>/objects/<2 hex>/<sha256>   -- content, read-only
+    <cache-dir>/keys/<key>.json            -- key to content mapping
+    <cache-dir>/tmp/                       -- files being populated
+    <cache-dir>/locks/<key>.lock           -- single-flight locks
+
+"""
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import contextlib
+from urlparse import urlsplit
+
+from .config import asbool, assize
+
+__all__ = ('ArtifactCache', 'get_cache', 'IntegrityError',)
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# Seconds to wait on another process populating the same key.
+DEFAULT_LOCK_TIMEOUT = 30 * 60
+LOCK_POLL_INTERVAL = 0.5
+
+
+class IntegrityError(Exception):
+    """Raised when cached content does not match its recorded hash."""
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def sha256_file(filepath):
+    """Compute the hex SHA-256 digest of the file at ``filepath``."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache(object):
+    """A size bounded, content addressed cache of downloaded artifacts
+    that can be shared by several worker processes.
+
+    When ``max_size`` (in bytes) is given, the least recently used
+    content is evicted after each addition to keep the cache under it.
+    When ``verify`` is true, content is re-hashed each time it is looked
+    up, otherwise only its size is checked.
+
+    """
+
+    def __init__(self, directory, max_size=None, verify=False,
+                 lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.verify = verify
+        self.lock_timeout = lock_timeout
+        self.objects_dir = os.path.join(self.directory, 'objects')
+        self.keys_dir = os.path.join(self.directory, 'keys')
+        self.tmp_dir = os.path.join(self.directory, 'tmp')
+        self.locks_dir = os.path.join(self.directory, 'locks')
+        for path in (self.objects_dir, self.keys_dir, self.tmp_dir,
+                     self.locks_dir):
+            _makedirs(path)
+
+    @staticmethod
+    def make_key(base_uri, pkg_name, version, zipname):
+        """Make the cache key for a repository artifact."""
+        host = urlsplit(base_uri).netloc.lower()
+        raw = '\0'.join([host, pkg_name, version, zipname])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _entry_path(self, key):
+        return os.path.join(self.keys_dir, key + '.json')
+
+    def _write_atomically(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except:
+            _remove(tmp_path)
+            raise
+
+    def get_entry(self, key):
+        """Return the recorded entry (a dict) for ``key`` or None."""
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except IOError as exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+        except ValueError:
+            # A corrupt entry is as good as a missing one.
+            return None
+
+    def lookup(self, key):
+        """Return the path to the cached content for ``key`` or None.
+
+        The returned file must be treated as read-only; use ``fetch``
+        to get a private copy.
+
+        """
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+        path = self._object_path(entry['sha256'])
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            # The content has been evicted.
+            self.discard(key)
+            return None
+        try:
+            if size != entry['size']:
+                raise IntegrityError("Size mismatch for '{0}'.".format(path))
+            if self.verify and sha256_file(path) != entry['sha256']:
+                raise IntegrityError("Hash mismatch for '{0}'.".format(path))
+        except IntegrityError as exc:
+            logger.warning("Discarding corrupt cache content: {0}".format(exc))
+            _remove(path)
+            self.discard(key)
+            return None
+        # Mark the content as recently used.
+        os.utime(path, None)
+        return path
+
+    def fetch(self, key, destination):
+        """Place a copy of the cached content for ``key`` at
+        ``destination``. Returns the destination or None on a cache miss.
+        """
+        path = self.lookup(key)
+        if path is None:
+            return None
+        try:
+            # The content is never modified in place, so a hard link
+            #   is as good as a copy and much cheaper.
+            os.link(path, destination)
+        except OSError:
+            try:
+                shutil.copyfile(path, destination)
+            except (IOError, OSError) as exc:
+                if exc.errno != errno.ENOENT or os.path.exists(path):
+                    raise
+                # Evicted since the lookup.
+                self.discard(key)
+                return None
+        return destination
+
+    def store(self, key, filepath, **info):
+        """Add the file at ``filepath`` to the cache under ``key``.
+
+        The file is copied into the cache (it is left in place) and made
+        visible atomically, so concurrent readers never see a partial
+        file. Additional keyword arguments are recorded in the entry.
+        Returns the path to the cached content.
+
+        """
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out, open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    out.write(chunk)
+            size = os.path.getsize(tmp_path)
+            sha256 = digest.hexdigest()
+            path = self._object_path(sha256)
+            _makedirs(os.path.dirname(path))
+            os.chmod(tmp_path, 0o444)
+            os.rename(tmp_path, path)
+        except:
+            _remove(tmp_path)
+            raise
+
+        info.update({'sha256': sha256, 'size': size})
+        self._write_atomically(self._entry_path(key),
+                               json.dumps(info).encode('utf-8'))
+        logger.debug("Cached '{0}' as {1} ({2} bytes).".format(
+            filepath, sha256, size))
+        if self.max_size is not None:
+            self.evict()
+        return path
+
+    def alias(self, key, other_key, **info):
+        """Make ``other_key`` refer to the same content as ``key``,
+        without storing the content again. Additional keyword arguments
+        replace those recorded for ``key``. Returns false if ``key`` is
+        not in the cache.
+        """
+        entry = self.get_entry(key)
+        if entry is None:
+            return False
+        entry.update(info)
+        self._write_atomically(self._entry_path(other_key),
+                               json.dumps(entry).encode('utf-8'))
+        return True
+
+    @contextlib.contextmanager
+    def lock(self, key, timeout=None):
+        """Hold the (cross-process) populate lock for ``key`` for the
+        duration of the context. This is used to let only one job
+        download an artifact, while concurrent jobs for the same key
+        wait for it to arrive in the cache.
+
+        The context value is true when the lock was acquired, or false
+        when ``timeout`` seconds (defaults to the cache's
+        ``lock_timeout``) passed while waiting on another process. The
+        lock is released by the operating system if its holder dies.
+
+        """
+        if timeout is None:
+            timeout = self.lock_timeout
+        path = os.path.join(self.locks_dir, key + '.lock')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            deadline = time.time() + timeout
+            acquired = waited = False
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    acquired = True
+                    break
+                except IOError as exc:
+                    if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if time.time() >= deadline:
+                    logger.warning("Gave up waiting on the lock for '{0}' "
+                                   "after {1} seconds.".format(key, timeout))
+                    break
+                if not waited:
+                    logger.debug("Waiting on another process to populate "
+                                 "'{0}'.".format(key))
+                    waited = True
+                time.sleep(LOCK_POLL_INTERVAL)
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def discard(self, key):
+        """Forget the entry for ``key``. The content is left for the
+        eviction policy to clean up, since other keys may refer to it.
+        """
+        _remove(self._entry_path(key))
+
+    def _iter_objects(self):
+        for dirpath, dirnames, filenames in os.walk(self.objects_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat
+
+    def total_size(self):
+        """Size in bytes of all the content in the cache."""
+        return sum(stat.st_size for path, stat in self._iter_objects())
+
+    def evict(self, max_size=None):
+        """Remove the least recently used content until the cache is no
+        larger than ``max_size`` (defaults to the cache's ``max_size``).
+        Returns the number of bytes freed.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0
+        objects = sorted(self._iter_objects(), key=lambda x: x[1].st_mtime)
+        total = sum(stat.st_size for path, stat in objects)
+        freed = 0
+        for path, stat in objects:
+            if total <= max_size:
+                break
+            _remove(path)
+            total -= stat.st_size
+            freed += stat.st_size
+            logger.debug("Evicted '{0}' from the cache.".format(path))
+        return freed
+
+
+def get_cache(settings):
+    """Return the artifact cache configured in the runner ``settings``
+    or None if caching is not enabled.
+
+    Available settings:
+
+    - **cache-dir** - Directory of the shared artifact cache. Caching
+      is disabled when this is not set.
+    - **cache-max-size** - Size limit of the cache, e.g. ``20G``.
+      (default: unlimited)
+    - **cache-verify** - Re-hash cached content each time it is used.
+      (default: false)
+    - **cache-lock-timeout** - Seconds to wait on another job that is
+      downloading the same artifact, before downloading it anyway.
+      (default: 1800)
+
+    """
+    directory = settings.get('cache-dir', None)
+    if not directory:
+        return None
+    max_size = settings.get('cache-max-size', None)
+    if max_size is not None:
+        max_size = assize(max_size)
+    verify = asbool(settings.get('cache-verify', False))
+    lock_timeout = float(settings.get('cache-lock-timeout',
+                                      DEFAULT_LOCK_TIMEOUT))
+    return ArtifactCache(directory, max_size=max_size, verify=verify,
+                         lock_timeout=lock_timeout)
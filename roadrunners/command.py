@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Execution of the external build commands (make, oer.exports scripts).
+
+The output of a command is streamed line by line to a rotating log file
+as it is produced, rather than held in memory until the command exits.
+Only the last lines of each stream are kept, for the error message.
+
+Each command runs in a session (and process group) of its own, so that
+on a timeout or cancellation the whole tree of processes it started
+(make, pdflatex, prince, ...) is killed, not just the shell.
+
+"""
+import os
+import time
+import errno
+import signal
+import logging
+import threading
+import contextlib
+import subprocess
+from collections import deque
+
+from .config import assize
+from .limits import get_limits
+
+__all__ = ('Command', 'make_command', 'run_command', 'cancel_all',
+           'recording',)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOG_MAX_SIZE = 10 * 1024 ** 2
+DEFAULT_LOG_BACKUPS = 3
+DEFAULT_TAIL_LINES = 100
+# Subdirectory of the output directory the command logs are written to
+#   by default.
+LOG_DIR_NAME = 'logs'
+# Seconds between a SIGTERM and the SIGKILL that follows it.
+DEFAULT_KILL_GRACE = 10
+# Seconds between checks of the time limits and resource usage.
+WATCH_INTERVAL = 0.5
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+_running = set()
+_running_lock = threading.Lock()
+_recorder = threading.local()
+
+
+def session_usage(session_id):
+    """Resource usage of the live processes in the session
+    ``session_id``, as a (CPU seconds, resident bytes) tuple. The CPU
+    time includes that of the children they have waited on.
+    """
+    ticks = pages = 0
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(name)) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            # The process is gone.
+            continue
+        # The fields after the parenthesized command name, starting
+        #   with the third field (state).
+        fields = stat[stat.rfind(')') + 2:].split()
+        if int(fields[3]) != session_id:
+            continue
+        ticks += sum(int(x) for x in fields[11:15])
+        pages += int(fields[21])
+    return float(ticks) / _CLOCK_TICKS, pages * _PAGE_SIZE
+
+
+def _kill_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except OSError as exc:
+        if exc.errno != errno.ESRCH:
+            raise
+
+
+class RotatingLog(object):
+    """An append-only log file that is rotated (``<path>.1`` and so on)
+    once it grows past ``max_size`` bytes. Writes are thread-safe.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_LOG_MAX_SIZE,
+                 backups=DEFAULT_LOG_BACKUPS):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+
+    def _rotate(self):
+        self._file.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                source = '{0}.{1}'.format(self.path, i)
+                if os.path.exists(source):
+                    os.rename(source, '{0}.{1}'.format(self.path, i + 1))
+            os.rename(self.path, self.path + '.1')
+            self._file = open(self.path, 'ab')
+        else:
+            self._file = open(self.path, 'wb')
+
+    def write(self, data):
+        with self._lock:
+            if self._file.tell() + len(data) > self.max_size \
+               and self._file.tell() > 0:
+                self._rotate()
+            self._file.write(data)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Command(object):
+    """An external command whose stdout and stderr are streamed to the
+    log file at ``log_path`` (when given) while it runs.
+
+    The line and byte counters, and the sampled ``cpu_time`` and
+    ``peak_rss`` (in bytes, of all its processes together), can be read
+    from other threads while the command runs. After ``run`` the last
+    ``tail_lines`` lines of each stream are available as ``stdout`` and
+    ``stderr``.
+
+    The command's process group is killed when it runs longer than
+    ``timeout`` seconds, when its processes use more than
+    ``cpu_timeout`` seconds of CPU time or when it is cancelled. Its
+    processes are subject to the ``limits`` (``ResourceLimits``). The
+    reason of a termination or a limit violation is recorded in
+    ``termination_reason``.
+
+    Remaining keyword arguments are passed on to ``subprocess.Popen``.
+
+    """
+
+    def __init__(self, args, cwd=None, log_path=None,
+                 log_max_size=DEFAULT_LOG_MAX_SIZE,
+                 log_backups=DEFAULT_LOG_BACKUPS,
+                 tail_lines=DEFAULT_TAIL_LINES, timeout=None,
+                 cpu_timeout=None, kill_grace=DEFAULT_KILL_GRACE,
+                 limits=None, **kwargs):
+        self.args = args
+        self.cwd = cwd
+        self.log_path = log_path
+        self.log_max_size = log_max_size
+        self.log_backups = log_backups
+        self.tail_lines = tail_lines
+        self.timeout = timeout
+        self.cpu_timeout = cpu_timeout
+        self.kill_grace = kill_grace
+        self.limits = limits
+        self.popen_kwargs = kwargs
+        self.process = None
+        self.returncode = None
+        self.termination_reason = None
+        self.stdout_tail = deque(maxlen=tail_lines)
+        self.stderr_tail = deque(maxlen=tail_lines)
+        self.stdout_lines = self.stderr_lines = 0
+        self.stdout_bytes = self.stderr_bytes = 0
+        # Sampled while the command runs.
+        self.cpu_time = 0.0
+        self.peak_rss = 0
+        self._log = None
+        self._watched = None
+        self._finished = threading.Event()
+
+    @property
+    def description(self):
+        if isinstance(self.args, basestring):
+            return self.args
+        return ' '.join(self.args)
+
+    @property
+    def bytes_read(self):
+        return self.stdout_bytes + self.stderr_bytes
+
+    def _drain(self, stream, name):
+        """Read the ``stream`` (a pipe or file) named ``stdout`` or
+        ``stderr`` line by line, until it is exhausted.
+        """
+        tail = getattr(self, name + '_tail')
+        prefix = name + ': '
+        lines = size = 0
+        for line in iter(stream.readline, b''):
+            tail.append(line)
+            lines += 1
+            size += len(line)
+            # Only this thread writes these, so they are safe to publish.
+            setattr(self, name + '_lines', lines)
+            setattr(self, name + '_bytes', size)
+            if self._log is not None:
+                self._log.write(prefix + line)
+        stream.close()
+
+    def _open_log(self):
+        if self.log_path is not None:
+            try:
+                os.makedirs(os.path.dirname(self.log_path))
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            self._log = RotatingLog(self.log_path, self.log_max_size,
+                                    self.log_backups)
+
+    def _close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def consume(self, stdout, stderr):
+        """Take in the output of a command that ran elsewhere, given as
+        the ``stdout`` and ``stderr`` files.
+        """
+        self._open_log()
+        try:
+            self._drain(stdout, 'stdout')
+            self._drain(stderr, 'stderr')
+        finally:
+            self._close_log()
+
+    def _preexec(self):
+        """Prepare the child process, before the command is executed."""
+        # Become the leader of a new session and process group.
+        os.setsid()
+        if self.limits is not None:
+            self.limits.apply()
+        preexec_fn = self.popen_kwargs.get('preexec_fn', None)
+        if preexec_fn is not None:
+            preexec_fn()
+
+    def watch(self, process):
+        """Enforce the time limits on ``process``, the leader of its own
+        session, and sample its resource usage until ``unwatch`` is
+        called.
+        """
+        self._watched = process
+        self._finished.clear()
+        with _running_lock:
+            _running.add(self)
+        for commands in getattr(_recorder, 'lists', ()):
+            commands.append(self)
+        watcher = threading.Thread(target=self._watch, args=(process,),
+                                   name='command-watcher')
+        watcher.daemon = True
+        watcher.start()
+
+    def unwatch(self):
+        self._finished.set()
+        with _running_lock:
+            _running.discard(self)
+
+    def _watch(self, process):
+        started = time.time()
+        # The process may be shared by several jobs (the worker).
+        cpu_started = session_usage(process.pid)[0]
+        while not self._finished.wait(WATCH_INTERVAL):
+            cpu, rss = session_usage(process.pid)
+            self.cpu_time = cpu - cpu_started
+            self.peak_rss = max(self.peak_rss, rss)
+            if self.timeout is not None \
+               and time.time() - started > self.timeout:
+                self.terminate('timeout')
+                break
+            if self.cpu_timeout is not None \
+               and self.cpu_time > self.cpu_timeout:
+                self.terminate('cpu-timeout')
+                break
+
+    def terminate(self, reason):
+        """Kill the command's process group, first asking nicely."""
+        process = self._watched
+        if process is None or self._finished.is_set():
+            return
+        if self.termination_reason is None:
+            self.termination_reason = reason
+        logger.warning("Terminating ({0}): {1}".format(reason,
+                                                       self.description))
+        _kill_group(process.pid, signal.SIGTERM)
+        if not self._finished.wait(self.kill_grace):
+            _kill_group(process.pid, signal.SIGKILL)
+
+    def classify_failure(self):
+        """Record which resource limit, if any, made the command fail."""
+        if self.termination_reason is None and self.limits is not None:
+            self.termination_reason = self.limits.classify(
+                self.returncode, self.stdout + self.stderr)
+            if self.termination_reason is not None:
+                logger.warning("Command exceeded {0}: {1}".format(
+                    self.limits.describe(self.termination_reason),
+                    self.description))
+
+    def cancel(self):
+        """Stop the running command and everything it started."""
+        self.terminate('cancelled')
+
+    def run(self):
+        """Run the command to completion and return its exit status."""
+        logger.debug("Running: " + self.description)
+        popen_kwargs = dict(self.popen_kwargs)
+        popen_kwargs['preexec_fn'] = self._preexec
+        self._open_log()
+        try:
+            self.process = subprocess.Popen(self.args,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.PIPE,
+                                            cwd=self.cwd,
+                                            **popen_kwargs)
+            self.watch(self.process)
+            readers = [threading.Thread(target=self._drain,
+                                        args=(self.process.stdout, 'stdout')),
+                       threading.Thread(target=self._drain,
+                                        args=(self.process.stderr, 'stderr')),
+                       ]
+            for reader in readers:
+                reader.daemon = True
+                reader.start()
+            try:
+                self.returncode = self.process.wait()
+            finally:
+                self.unwatch()
+                # Whatever the command left running would otherwise
+                #   keep the pipes open and the CPU busy.
+                _kill_group(self.process.pid, signal.SIGKILL)
+            for reader in readers:
+                reader.join()
+            self.classify_failure()
+        finally:
+            self._close_log()
+        logger.debug("Exited ({0}) after {1} stdout and {2} stderr "
+                     "line(s): {3}".format(self.returncode,
+                                           self.stdout_lines,
+                                           self.stderr_lines,
+                                           self.description))
+        return self.returncode
+
+    @property
+    def stdout(self):
+        """The kept tail of the standard output."""
+        return b''.join(self.stdout_tail)
+
+    @property
+    def stderr(self):
+        """The kept tail of the standard error."""
+        return b''.join(self.stderr_tail)
+
+    def failure_message(self):
+        """Describe why the command failed, for use in an error."""
+        output = self.stderr or self.stdout
+        if self.termination_reason == 'timeout':
+            message = "Command timed out after {0} seconds.".format(
+                self.timeout)
+        elif self.termination_reason == 'cpu-timeout':
+            message = "Command used more than {0} seconds of CPU " \
+                      "time.".format(self.cpu_timeout)
+        elif self.termination_reason == 'cancelled':
+            message = "Command was cancelled."
+        elif self.termination_reason is not None:
+            message = "Command exceeded {0} and exited with status " \
+                      "{1}.".format(self.limits.describe(
+                          self.termination_reason), self.returncode)
+        else:
+            message = "Command exited with status {0}.".format(
+                self.returncode)
+        if output:
+            message += "\n" + output
+        if self.log_path is not None:
+            message += "\nSee '{0}' for the full output.".format(
+                self.log_path)
+        return message
+
+
+def make_command(args, cwd, settings={}, log_name=None, log_dir=None,
+                 **kwargs):
+    """Make a ``Command`` configured by the runner ``settings``. See
+    ``run_command`` for the arguments and settings.
+    """
+    log_path = None
+    if log_name is not None:
+        log_dir = settings.get('command-log-dir', None) or log_dir
+        if log_dir is None and settings.get('output-dir'):
+            # Not the build directory, its workspace is removed with the
+            #   log of a failed build in it.
+            log_dir = os.path.join(settings['output-dir'], LOG_DIR_NAME)
+        log_path = os.path.join(log_dir or cwd, log_name)
+    timeout = settings.get('command-timeout', None)
+    if timeout is not None:
+        timeout = float(timeout)
+    cpu_timeout = settings.get('command-cpu-timeout', None)
+    if cpu_timeout is not None:
+        cpu_timeout = float(cpu_timeout)
+    return Command(args, cwd=cwd, log_path=log_path,
+                   log_max_size=assize(settings.get('command-log-max-size',
+                                                    DEFAULT_LOG_MAX_SIZE)),
+                   log_backups=int(settings.get('command-log-backups',
+                                                DEFAULT_LOG_BACKUPS)),
+                   tail_lines=int(settings.get('command-tail-lines',
+                                               DEFAULT_TAIL_LINES)),
+                   timeout=timeout, cpu_timeout=cpu_timeout,
+                   kill_grace=float(settings.get('command-kill-grace',
+                                                 DEFAULT_KILL_GRACE)),
+                   limits=get_limits(settings),
+                   **kwargs)
+
+
+def run_command(args, cwd, settings={}, log_name=None, log_dir=None,
+                **kwargs):
+    """Run the command ``args`` in the ``cwd`` directory and return the
+    finished ``Command``. When ``log_name`` is given, the output is
+    logged to a file of that name, in ``log_dir`` unless the settings
+    say otherwise. The log is kept after the build, failed or not.
+
+    Available settings:
+
+    - **command-log-dir** - Directory the command logs are written to.
+      (default: ``log_dir``, else the ``logs`` subdirectory of the
+      ``output-dir``, else ``cwd``)
+    - **command-log-max-size** - Size at which a command log is rotated,
+      e.g. ``10M``. (default: 10M)
+    - **command-log-backups** - Number of rotated logs kept. (default: 3)
+    - **command-tail-lines** - Number of output lines kept for the error
+      message. (default: 100)
+    - **command-timeout** - Seconds (wall-clock) after which the command
+      and everything it started is killed. (default: no limit)
+    - **command-cpu-timeout** - CPU seconds the command and everything
+      it started may use, before they are killed. (default: no limit)
+    - **command-kill-grace** - Seconds between asking the processes to
+      terminate and killing them. (default: 10)
+    - **command-max-*** and **command-nice** - Resource limits of the
+      build processes, see ``roadrunners.limits.get_limits``.
+
+    """
+    command = make_command(args, cwd, settings, log_name, log_dir,
+                           **kwargs)
+    command.run()
+    return command
+
+
+def cancel_all():
+    """Cancel all the commands running in this process, e.g. when the
+    process is asked to shut down.
+    """
+    with _running_lock:
+        commands = list(_running)
+    for command in commands:
+        command.cancel()
+
+
+@contextlib.contextmanager
+def recording():
+    """Collect the commands run by the current thread for the duration
+    of the context, in the list that is the context value. This is used
+    to account the resource usage of the commands to a job.
+    """
+    if not hasattr(_recorder, 'lists'):
+        _recorder.lists = []
+    commands = []
+    _recorder.lists.append(commands)
+    try:
+        yield commands
+    finally:
+        _recorder.lists.pop()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+rbit extension that builds several formats of a collection version in
+one job, fetching its data from the repository only once.
+
+"""
+import contextlib
+from multiprocessing.pool import ThreadPool
+
+import coyote
+from . import utils
+from .epub import make_epub
+from .legacy import make_offlinezip
+from .metrics import instrumented
+from .pdf import make_pdf
+from .utils import logger
+from .workspace import build_workspace
+
+__all__ = ('FORMATS', 'make_formats',)
+
+# The format runners and the repository zips they build from.
+FORMATS = (
+    ('epub', make_epub, 'complete'),
+    ('pdf', make_pdf, 'offline'),
+    ('offlinezip', make_offlinezip, 'complete'),
+    )
+
+
+def _prefetch(build_request, zipnames, settings):
+    """Put the ``zipnames`` of the requested collection in the artifact
+    cache of the ``settings``, for the format runners to pick up.
+    """
+    pkg_name = build_request.get_package()
+    version = build_request.get_version()
+    base_uri = build_request.transport.uri
+    with build_workspace(settings) as build_dir:
+        for zipname in zipnames:
+            utils.get_zip(pkg_name, version, base_uri, build_dir,
+                          unpack=False, zipname=zipname, settings=settings)
+
+
+@contextlib.contextmanager
+def _cache_dir(settings):
+    """Provide the artifact cache directory of the ``settings``, a
+    workspace of its own when none is configured.
+    """
+    if settings.get('cache-dir'):
+        yield settings['cache-dir']
+    else:
+        with build_workspace(settings) as cache_dir:
+            yield cache_dir
+
+
+@instrumented('formats')
+def make_formats(build_request, settings={}):
+    """Build the epub, pdf and offlinezip of a collection version at the
+    same time. The complete and offline zips are fetched once, into the
+    shared artifact cache, and each format is then built by its own
+    runner (``make_epub``, ``make_pdf``, ``make_offlinezip``) in its own
+    build directory. Returns the artifacts of all the formats.
+
+    The offlinezip build publishes the epub of the collection as well,
+    so when both are requested the epub is left to it.
+
+    When one of the formats fails, the others still finish (and are
+    published), then the job fails naming the formats that did.
+
+    Available settings:
+
+    - **formats** - Comma separated formats to build.
+      (default: epub, pdf, offlinezip)
+    - **cache-dir** - The shared artifact cache, see
+      ``roadrunners.cache.get_cache``. When it is not set, a cache of
+      this job's own is made in a workspace, see
+      ``roadrunners.workspace.build_workspace``, and removed afterwards.
+    - The settings of each of the format runners.
+
+    """
+    names = [name.strip() for name
+             in settings.get('formats', 'epub, pdf, offlinezip').split(',')
+             if name.strip()]
+    formats = [f for f in FORMATS if f[0] in names]
+    unknown = set(names) - set(f[0] for f in formats)
+    if unknown:
+        raise coyote.Failed("Unknown formats: {0}".format(
+            ', '.join(sorted(unknown))))
+    if 'offlinezip' in names and 'epub' in names:
+        # Both would publish <id>-<version>.epub.
+        formats = [f for f in formats if f[0] != 'epub']
+    if not formats:
+        logger.warning("No formats to build.")
+        return []
+
+    settings = dict(settings)
+    with _cache_dir(settings) as cache_dir:
+        settings['cache-dir'] = cache_dir
+        zipnames = []
+        for name, runner, zipname in formats:
+            if zipname not in zipnames:
+                zipnames.append(zipname)
+        _prefetch(build_request, zipnames, settings)
+
+        def build(format):
+            name, runner = format[:2]
+            try:
+                return runner(build_request, settings), None
+            except Exception as exc:
+                logger.exception("The {0} build failed.".format(name))
+                return None, exc
+
+        pool = ThreadPool(len(formats))
+        try:
+            outcomes = pool.map(build, formats, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    artifacts = []
+    failures = []
+    for (name, runner, zipname), (result, exc) in zip(formats, outcomes):
+        if exc is None:
+            # The offlinezip build makes an epub as well.
+            artifacts.extend(a for a in result if a not in artifacts)
+        else:
+            failures.append((name, exc))
+    if failures:
+        message = '; '.join('{0}: {1}'.format(name, exc)
+                            for name, exc in failures)
+        if all(isinstance(exc, coyote.Blocked) for name, exc in failures):
+            raise coyote.Blocked(message)
+        raise coyote.Failed("Failed to build {0}".format(message))
+    return artifacts
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Helpers for interpreting the (string) values of runner settings.
+
+"""
+
+__all__ = ('asbool', 'asfloat_pair', 'assize',)
+
+_SIZE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def asbool(value):
+    """Interpret a settings value (usually a string) as a boolean."""
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('true', 'yes', 'on', '1')
+    return bool(value)
+
+
+def asfloat_pair(value):
+    """Interpret a settings value of one number, or a ``<first>, <second>``
+    pair of numbers. A single number is returned as a float, a pair as
+    a tuple of floats.
+    """
+    if not isinstance(value, basestring):
+        return value
+    parts = [float(x) for x in value.replace(',', ' ').split()]
+    if len(parts) == 1:
+        return parts[0]
+    return tuple(parts[:2])
+
+
+def assize(value):
+    """Interpret a settings value as a number of bytes. The value may
+    carry a ``K``, ``M``, ``G`` or ``T`` suffix (powers of 1024), for
+    example ``512M`` or ``20G``.
+    """
+    if not isinstance(value, basestring):
+        return int(value)
+    value = value.strip().lower().rstrip('b')
+    multiplier = _SIZE_SUFFIXES.get(value[-1:], None)
+    if multiplier is not None:
+        return int(float(value[:-1]) * multiplier)
+    return int(value)
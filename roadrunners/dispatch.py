@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Run the runners of an ini file's ``[runner:*]`` sections for a list of
+collections on a local process pool, without the broker. This is meant
+for mass rebuilds.
+
+Every finished job is appended to a journal (JSON lines). Running again
+with the same journal skips the jobs that already succeeded, so an
+interrupted rebuild resumes where it left off.
+
+"""
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
+from collections import deque
+from ConfigParser import RawConfigParser
+from Queue import Queue, Empty
+
+import coyote
+from .batch import BuildRequest, _resolve_runner
+
+__all__ = ('Job', 'Dispatcher', 'read_journal', 'main',)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URI = 'http://cnx.org'
+# Times a job blocked on a dependency is retried, and the seconds to
+#   wait before each retry.
+DEFAULT_ATTEMPTS = 3
+DEFAULT_RETRY_DELAY = 30
+# Seconds the result of a job whose worker died has to arrive, it could
+#   have been sent just before.
+LOST_GRACE = 1
+
+# The settings of the runners, loaded once in each worker process.
+_worker_settings = {}
+# Where a worker process announces the jobs it starts.
+_worker_started = []
+
+
+def _read_settings(config_path):
+    config = RawConfigParser()
+    if not config.read(config_path):
+        raise IOError("Could not read '{0}'.".format(config_path))
+    return dict((section[len('runner:'):], dict(config.items(section)))
+                for section in config.sections()
+                if section.startswith('runner:'))
+
+
+def _terminate(signum, frame):
+    # Take the build commands' process groups down with this worker.
+    from .command import cancel_all
+    cancel_all()
+    os._exit(1)
+
+
+def _init_worker(config_path, started):
+    # Interrupts are handled by the dispatcher, which terminates the
+    #   workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _terminate)
+    _worker_settings.update(_read_settings(config_path))
+    _worker_started.append(started)
+
+
+def _run_job(pkg_name, version, uri, runner_name):
+    """Run one job in a worker process. Returns the outcome as a dict,
+    since the exceptions of the runners need not be picklable.
+    """
+    started = time.time()
+    # Written straight to the pipe, so it is not lost when the worker
+    #   dies right after.
+    _worker_started[0].put(((pkg_name, version, runner_name), os.getpid(),
+                            started))
+    outcome = {'status': 'ok', 'artifacts': [], 'error': None}
+    try:
+        settings = _worker_settings[runner_name]
+        runner = _resolve_runner(settings['runner'])
+        outcome['artifacts'] = runner(BuildRequest(pkg_name, version, uri),
+                                      settings)
+    except coyote.Blocked as exc:
+        outcome.update(status='blocked', error=str(exc))
+    except Exception as exc:
+        logger.exception("{0} job {1}/{2} failed.".format(runner_name,
+                                                         pkg_name, version))
+        outcome.update(status='failed', error='{0}: {1}'.format(
+            type(exc).__name__, exc))
+    outcome['duration'] = time.time() - started
+    return outcome
+
+
+class Job(object):
+    """A job of ``runner`` for the collection ``pkg_name`` at
+    ``version``. It starts once the jobs of the ``requires`` keys, when
+    they are part of the same run, succeeded.
+    """
+
+    def __init__(self, pkg_name, version, runner, uri=DEFAULT_URI,
+                 requires=()):
+        self.pkg_name = pkg_name
+        self.version = version
+        self.runner = runner
+        self.uri = uri
+        self.requires = tuple(requires)
+        self.attempts = 0
+        self.not_before = 0
+
+    @property
+    def key(self):
+        return (self.pkg_name, self.version, self.runner)
+
+    def __str__(self):
+        return '{0}/{1} {2}'.format(self.pkg_name, self.version, self.runner)
+
+
+def read_journal(path):
+    """Read the outcomes of a journal, the last one of each job wins.
+    Returns a dict of ``(id, version, runner)`` keys to outcomes.
+    """
+    outcomes = {}
+    if not os.path.exists(path):
+        return outcomes
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The line an interruption cut short.
+                continue
+            key = (entry['id'], entry['version'], entry['runner'])
+            outcomes[key] = entry
+    return outcomes
+
+
+class Dispatcher(object):
+    """Run ``jobs`` on ``processes`` worker processes, with at most
+    ``limits[runner]`` (default 1) jobs of each runner at a time. A job
+    starts as soon as the jobs it requires succeeded, and is skipped
+    when one of them did not. A job blocked on a dependency
+    (``coyote.Blocked``) is retried up to ``attempts`` times,
+    ``retry_delay`` seconds later. A job running longer than
+    ``timeouts[runner]`` seconds has its worker terminated, and a job
+    whose worker died fails.
+    """
+
+    def __init__(self, config_path, jobs, processes=None, limits={},
+                 journal_path=None, attempts=DEFAULT_ATTEMPTS,
+                 retry_delay=DEFAULT_RETRY_DELAY, output=sys.stdout,
+                 timeouts={}):
+        self.config_path = config_path
+        self.processes = processes or multiprocessing.cpu_count()
+        self.limits = limits
+        self.timeouts = timeouts
+        self.journal_path = journal_path
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.output = output
+        self.skipped = []
+        self.outcomes = []
+        self.statuses = {}
+        self.finished = 0
+        done = {}
+        if journal_path is not None:
+            done = read_journal(journal_path)
+        self.pending = deque()
+        for job in jobs:
+            if done.get(job.key, {}).get('status') == 'ok':
+                self.skipped.append(job)
+            else:
+                self.pending.append(job)
+        self.total = len(self.pending)
+        self.planned = set(job.key for job in self.pending)
+
+    def _ready(self, job):
+        return all(key not in self.planned or self.statuses.get(key) == 'ok'
+                   for key in job.requires)
+
+    def _next_job(self, running, in_flight):
+        """Take the first pending job that may start now, if any."""
+        if in_flight >= self.processes:
+            return None
+        now = time.time()
+        for job in self.pending:
+            if job.not_before <= now and self._ready(job) \
+               and running.get(job.runner, 0) < self.limits.get(job.runner,
+                                                                1):
+                self.pending.remove(job)
+                return job
+        return None
+
+    def _record(self, job, outcome):
+        entry = dict(outcome, id=job.pkg_name, version=job.version,
+                     runner=job.runner, uri=job.uri, attempts=job.attempts,
+                     finished=time.time())
+        self.outcomes.append(entry)
+        self.statuses[job.key] = outcome['status']
+        if self.journal_path is not None:
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def _finish(self, job, outcome):
+        self.finished += 1
+        self._record(job, outcome)
+        self._progress(job, outcome['status'], outcome)
+        if outcome['status'] == 'ok':
+            return
+        # Nothing that requires this job can be built now.
+        for dependent in list(self.pending):
+            if job.key in dependent.requires and dependent in self.pending:
+                self.pending.remove(dependent)
+                self._finish(dependent, {
+                    'status': 'skipped', 'artifacts': [], 'duration': 0,
+                    'error': "{0} did not build".format(job)})
+
+    def _check_workers(self, pool, started, submitted, workers):
+        """Find the submitted jobs that will not complete: those whose
+        worker died, which the pool does not notice, and those past
+        their timeout, whose worker is terminated. Returns their
+        (job, outcome) pairs.
+        """
+        while not started.empty():
+            key, pid, started_at = started.get()
+            # The announcement of a job that already completed is stale.
+            if key in submitted:
+                workers[key] = (pid, started_at)
+        # The pool replaces the workers that die.
+        alive = set(process.pid for process in pool._pool
+                    if process.is_alive())
+        lost = []
+        now = time.time()
+        for key, (pid, started_at) in list(workers.items()):
+            job, result = submitted[key]
+            timeout = self.timeouts.get(job.runner)
+            if pid not in alive:
+                error = "Worker {0} died".format(pid)
+                result.wait(LOST_GRACE)
+            elif timeout is not None and now - started_at > timeout:
+                error = "Timed out after {0}s".format(timeout)
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            else:
+                continue
+            del workers[key]
+            if result.ready():
+                continue
+            lost.append((job, {'status': 'failed', 'artifacts': [],
+                               'error': error,
+                               'duration': time.time() - started_at}))
+        return lost
+
+    def run(self):
+        """Run the pending jobs. Returns the outcomes of this run."""
+        completions = Queue()
+        started = SimpleQueue()
+        running = {}
+        # The jobs in the pool and their results, by key, and the
+        #   (pid, time) of the workers running them.
+        submitted = {}
+        workers = {}
+        lost = False
+        pool = multiprocessing.Pool(self.processes, _init_worker,
+                                    (self.config_path, started))
+        try:
+            while self.pending or submitted:
+                while True:
+                    job = self._next_job(running, len(submitted))
+                    if job is None:
+                        break
+                    job.attempts += 1
+                    running[job.runner] = running.get(job.runner, 0) + 1
+                    submitted[job.key] = (job, pool.apply_async(
+                        _run_job,
+                        (job.pkg_name, job.version, job.uri, job.runner),
+                        callback=lambda outcome, job=job:
+                            completions.put((job, outcome))))
+                if not submitted and not any(job.not_before > time.time()
+                                             for job in self.pending):
+                    raise RuntimeError("Jobs waiting on each other: "
+                                       "{0}".format(', '.join(
+                                           str(job) for job in self.pending)))
+                for job, outcome in self._check_workers(pool, started,
+                                                        submitted, workers):
+                    lost = True
+                    completions.put((job, outcome))
+                try:
+                    # A timeout keeps the wait interruptible and lets
+                    #   delayed retries come due.
+                    job, outcome = completions.get(timeout=1)
+                except Empty:
+                    continue
+                if submitted.pop(job.key, None) is None:
+                    # The result of a job already taken for lost.
+                    continue
+                workers.pop(job.key, None)
+                running[job.runner] -= 1
+                if outcome['status'] == 'blocked' \
+                   and job.attempts < self.attempts:
+                    job.not_before = time.time() + self.retry_delay
+                    self.pending.append(job)
+                    self._progress(job, 'blocked, retrying', outcome)
+                    continue
+                self._finish(job, outcome)
+            if lost:
+                # The pool would wait for the results of the lost jobs.
+                pool.terminate()
+            else:
+                pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return self.outcomes
+
+    def _progress(self, job, status, outcome):
+        self.output.write('[{0}/{1}] {2} {3} ({4:.1f}s)\n'.format(
+            self.finished, self.total, job, status, outcome['duration']))
+        self.output.flush()
+
+    def format_summary(self):
+        lines = []
+        if self.skipped:
+            lines.append('Skipped {0} jobs done in an earlier run.'.format(
+                len(self.skipped)))
+        by_runner = {}
+        for entry in self.outcomes:
+            by_runner.setdefault(entry['runner'], []).append(entry)
+        for runner, entries in sorted(by_runner.items()):
+            durations = [e['duration'] for e in entries]
+            failed = [e for e in entries if e['status'] != 'ok']
+            lines.append('{0}: {1} ok, {2} failed, {3:.1f}s mean, {4:.1f}s '
+                         'max'.format(runner, len(entries) - len(failed),
+                                      len(failed),
+                                      sum(durations) / len(durations),
+                                      max(durations)))
+        failures = [e for e in self.outcomes if e['status'] != 'ok']
+        if failures:
+            lines.append('Failures:')
+            for entry in failures:
+                lines.append('  {0}/{1} {2}: {3}'.format(
+                    entry['id'], entry['version'], entry['runner'],
+                    entry['error']))
+        return '\n'.join(lines)
+
+
+def _parse_collection(value, uri):
+    """Parse ``<id>/<version>``, ``<id> <version>`` or
+    ``<id> <version> <uri>``.
+    """
+    parts = value.split()
+    if len(parts) == 1:
+        # The uri has slashes of its own, only <id>/<version> is split.
+        parts = parts[0].split('/')
+        if len(parts) != 2:
+            parts = []
+    if len(parts) == 2:
+        parts.append(uri)
+    if len(parts) != 3 or not all(parts):
+        raise ValueError("Not a collection: '{0}'".format(value))
+    return parts
+
+
+def main(argv=None):
+    import argparse
+    import logging.config
+    parser = argparse.ArgumentParser(
+        description="Run the runners of an ini file for many collections "
+                    "on a local process pool")
+    parser.add_argument('config', help="configuration (ini) file")
+    parser.add_argument('collections', nargs='*',
+                        help="collections as <id>/<version>")
+    parser.add_argument('-f', '--formats', required=True,
+                        help="comma separated runners, e.g. "
+                             "completezip,offlinezip,pdf for the "
+                             "[runner:<name>] sections")
+    parser.add_argument('-i', '--input',
+                        help="file of collections, as '<id> <version> "
+                             "[<uri>]' lines, '-' for stdin")
+    parser.add_argument('--uri', default=DEFAULT_URI,
+                        help="repository of the collections without one")
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('-l', '--limit', action='append', default=[],
+                        metavar='RUNNER=N',
+                        help="jobs of a runner at a time (default: the "
+                             "runner's dispatch-concurrency setting or 1)")
+    parser.add_argument('-t', '--timeout', action='append', default=[],
+                        metavar='RUNNER=SECONDS',
+                        help="time a job of a runner may take (default: "
+                             "the runner's dispatch-job-timeout setting "
+                             "or none)")
+    parser.add_argument('-j', '--journal',
+                        help="results journal to append to and to resume "
+                             "from")
+    parser.add_argument('--attempts', type=int, default=DEFAULT_ATTEMPTS,
+                        help="attempts of a job blocked on a dependency")
+    parser.add_argument('--retry-delay', type=float,
+                        default=DEFAULT_RETRY_DELAY)
+    parser.add_argument('--plan', action='store_true',
+                        help="also run the runners the formats require, "
+                             "each once its inputs are built, skipping "
+                             "those with fresh outputs")
+    parser.add_argument('--force', action='store_true',
+                        help="with --plan, rebuild fresh outputs too")
+    args = parser.parse_args(argv)
+
+    config = RawConfigParser()
+    config.read(args.config)
+    if config.has_section('loggers'):
+        logging.config.fileConfig(args.config,
+                                  disable_existing_loggers=False)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+    runner_settings = _read_settings(args.config)
+    formats = args.formats.split(',')
+    for name in formats:
+        if name not in runner_settings:
+            parser.error("No [runner:{0}] section in '{1}'.".format(
+                name, args.config))
+
+    limits = dict((name, int(settings.get('dispatch-concurrency', 1)))
+                  for name, settings in runner_settings.items())
+    for item in args.limit:
+        name, value = item.split('=', 1)
+        limits[name] = int(value)
+    timeouts = dict((name, float(settings['dispatch-job-timeout']))
+                    for name, settings in runner_settings.items()
+                    if settings.get('dispatch-job-timeout'))
+    for item in args.timeout:
+        name, value = item.split('=', 1)
+        timeouts[name] = float(value)
+
+    lines = list(args.collections)
+    if args.input == '-':
+        lines.extend(sys.stdin.readlines())
+    elif args.input is not None:
+        with open(args.input) as f:
+            lines.extend(f.readlines())
+    if args.plan:
+        from .planner import Planner
+        planner = Planner(runner_settings)
+    jobs = []
+    fresh = 0
+    for line in lines:
+        if not line.strip() or line.startswith('#'):
+            continue
+        try:
+            pkg_name, version, uri = _parse_collection(line, args.uri)
+        except ValueError as exc:
+            parser.error(str(exc))
+        if args.plan:
+            try:
+                planned, fresh_runners = planner.plan(
+                    pkg_name, version, formats, uri, args.force)
+            except ValueError as exc:
+                parser.error(str(exc))
+            jobs.extend(planned)
+            fresh += len(fresh_runners)
+        else:
+            # The formats of a collection are queued in the given order,
+            #   so that dependencies (e.g. the completezip of an
+            #   offlinezip) usually come first.
+            jobs.extend(Job(pkg_name, version, name, uri)
+                        for name in formats)
+    if fresh:
+        print('{0} outputs are fresh, not rebuilding them.'.format(fresh))
+
+    dispatcher = Dispatcher(args.config, jobs, args.processes, limits,
+                            args.journal, args.attempts, args.retry_delay,
+                            timeouts=timeouts)
+    try:
+        dispatcher.run()
+    except KeyboardInterrupt:
+        sys.stdout.write('Interrupted.\n')
+    print(dispatcher.format_summary())
+    failed = [e for e in dispatcher.outcomes if e['status'] != 'ok']
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,16 +11,28 @@ rbit extensions for integration with oer.exports epub generation code.
 """
 import os
 import sys
-import subprocess
-import shutil
-import tempfile
 import jsonpickle
 
 import coyote
 from . import utils
+from .admission import admission_controlled
+from .index import indexed
+from .manifest import make_manifest, is_current, write_manifest
+from .metrics import instrumented, phase
+from .profiling import profiled
+from .publish import publish
 from .utils import logger
+from .worker import run_script
+from .workspace import build_workspace
 
+# The settings that shape the epub, recorded in its build manifest.
+MANIFEST_SETTINGS = ('oer.exports-dir', 'python',)
 
+
+@instrumented('epub')
+@admission_controlled('epub')
+@profiled('epub')
+@indexed('epub')
 def make_epub(build_request, settings={}):
     """Interface with the oer.exports epub code.
 
@@ -29,59 +41,92 @@ def make_epub(build_request, settings={}):
     - **output-dir** - Directory where the produced file is stuck.
     - **oer.exports-dir** - Defines the location of the oer.exports package.
     - **python** - Defines which python executable should be used.
+    - **force** - Build even when the output is current, see
+      ``roadrunners.manifest.is_current``.
+    - **oer.exports-worker*** - Long-lived worker settings, see
+      ``roadrunners.worker.get_worker``.
+    - **command-*** - Build command logging and limit settings, see
+      ``roadrunners.command.run_command``.
+    - **admission-*** - Host admission control settings, see
+      ``roadrunners.admission.get_controller``.
+    - **metrics-*** - Metrics export settings, see
+      ``roadrunners.metrics.export``.
+    - **index-file** - Index of the published artifacts, see
+      ``roadrunners.index.get_index``.
+    - **retention-*** - Output directory retention settings, see
+      ``roadrunners.retention.get_policy``.
+    - **profile*** - Opt-in profiling settings, see
+      ``roadrunners.profiling.should_profile``.
+    - **http-*** - Connection pool and timeout settings, see
+      ``roadrunners.sessions.get_session``.
+    - **cache-*** - Shared download cache settings, see
+      ``roadrunners.cache.get_cache``.
+    - **workspace-*** - Build directory settings, see
+      ``roadrunners.workspace.build_workspace``.
 
     """
-    python_executable = settings.get('python', sys.executable)
     oerexports_dir = settings['oer.exports-dir']
     output_dir = settings['output-dir']
 
-    # Create a temporary directory to work in...
-    build_dir = tempfile.mkdtemp()
-    logger.debug("Working in '{0}'.".format(build_dir))
-
-    # Acquire the collection's data in a collection directory format.
     pkg_name = build_request.get_package()
     version = build_request.get_version()
     base_uri = build_request.transport.uri
-    collection_dir = utils.get_completezip(pkg_name, version, base_uri,
-                                           build_dir)
-    # FIXME We need to grab the version from the unpacked directory
-    #       name because 'latest' is only a symbolic name that will
-    #       not be used in the resulting filename.
-    if version == 'latest':
-        # Using the unpacked complete zip filename, with the structure
-        #   <id>_<version>_complete, we can parse the version.
-        version = collection_dir.split('_')[1]
+    expected_size = utils.cached_zip_size(pkg_name, version, base_uri,
+                                          'complete', settings)
+
+    # Create a temporary directory to work in, it is removed when
+    #   we are done with it, also when the build fails.
+    with build_workspace(settings, expected_size) as build_dir:
+        # Acquire the collection's data in a collection directory format.
+        zip_filepath = utils.get_completezip(pkg_name, version, base_uri,
+                                             build_dir, unpack=False,
+                                             settings=settings)
+        # 'latest' is only a symbolic name that will not be used in the
+        #   resulting filename, the complete zip's top level directory,
+        #   <id>_<version>_complete, has the version.
+        if version == 'latest':
+            version = utils.resolve_zip_version(zip_filepath) or version
 
-    # Run the oer.exports script against the collection data.
-    build_script = os.path.join(oerexports_dir, 'content2epub.py')
-    result_filename = '{0}-{1}.epub'.format(build_request.get_package(),
-                                            version)
-    result_filepath = os.path.join(build_dir, result_filename)
-    command = [python_executable, build_script, collection_dir,
-               # The follow are not optional, values must be supplied.
-               '-t', 'collection',
-               '-c', os.path.join(oerexports_dir, 'static', 'content.css'),
-               '-e', os.path.join(oerexports_dir, 'xsl', 'dbk2epub.xsl'),
-               '-o', result_filepath,
-               ]
-    logger.debug("Running: " + ' '.join(command))
-    process = subprocess.Popen(command,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                               cwd=build_dir)
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        # Something went wrong...
-        raise coyote.Failed("Unknown issue: \n" + stderr)
-    else:
-        msg = "PDF created, moving contents to final destination..."
-        logger.debug(msg)
+        result_filename = '{0}-{1}.epub'.format(build_request.get_package(),
+                                                version)
+        output_filepath = os.path.join(output_dir, result_filename)
+        with phase('manifest'):
+            manifest = make_manifest('epub', settings, MANIFEST_SETTINGS,
+                                     ('oer.exports-dir',),
+                                     files={'complete': zip_filepath})
+            if is_current(output_filepath, manifest, settings):
+                logger.info("'{0}' is up to date.".format(output_filepath))
+                return [output_filepath]
+        with phase('unpack') as unpacking:
+            unpacking.bytes = os.path.getsize(zip_filepath)
+            collection_dir = utils.unpack_zip(zip_filepath, build_dir)[0]
 
-    # Move the file to it's final destination.
-    shutil.copy2(result_filepath, output_dir)
-    output_filepath = os.path.join(output_dir, result_filename)
+        # Run the oer.exports script against the collection data.
+        build_script = os.path.join(oerexports_dir, 'content2epub.py')
+        result_filepath = os.path.join(build_dir, result_filename)
+        args = [collection_dir,
+                # The follow are not optional, values must be supplied.
+                '-t', 'collection',
+                '-c', os.path.join(oerexports_dir, 'static', 'content.css'),
+                '-e', os.path.join(oerexports_dir, 'xsl', 'dbk2epub.xsl'),
+                '-o', result_filepath,
+                ]
+        log_name = '{0}.log'.format(result_filename)
+        with phase('build'):
+            result = run_script(build_script, args, build_dir, settings,
+                                log_name)
+        if result.returncode != 0:
+            # Something went wrong...
+            raise coyote.Failed("Unknown issue: \n"
+                                + result.failure_message())
+        else:
+            msg = "PDF created, moving contents to final destination..."
+            logger.debug(msg)
 
-    # Remove the temporary build directory
-    shutil.rmtree(build_dir)
+        # Move the file to it's final destination.
+        with phase('publish') as publishing:
+            publishing.bytes = os.path.getsize(result_filepath)
+            output_filepath = publish(result_filepath, output_dir)
+        write_manifest(output_filepath, manifest)
 
     return [output_filepath]
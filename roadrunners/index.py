@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+SQLite index of the artifacts the runners publish, so that what has been
+built can be looked up without scanning the output directories.
+
+A runner decorated with ``indexed`` records each artifact it returns,
+by the collection id, version and format parsed from its filename
+(``<id>-<version>.<format suffix>``). The index file should be on a
+local disk, SQLite's locking is not to be trusted on network storage.
+
+Usage: ``python -m roadrunners.index <index-file> <command>``, see
+``main``.
+
+"""
+import os
+import sys
+import time
+import sqlite3
+import logging
+import functools
+import contextlib
+
+from .cache import sha256_file
+from .manifest import read_manifest
+
+__all__ = ('FORMATS', 'parse_filename', 'version_key', 'ArtifactIndex',
+           'get_index', 'indexed',)
+
+logger = logging.getLogger(__name__)
+
+# The artifact filename suffixes and the formats they are.
+FORMATS = (
+    ('.complete.zip', 'completezip'),
+    ('.offline.zip', 'offlinezip'),
+    ('.epub', 'epub'),
+    ('.pdf', 'pdf'),
+    ('.xml', 'collxml'),
+    )
+# Seconds to wait on another process writing to the index.
+DEFAULT_TIMEOUT = 30
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    version TEXT NOT NULL,
+    format TEXT NOT NULL,
+    runner TEXT,
+    size INTEGER NOT NULL,
+    sha256 TEXT,
+    duration REAL,
+    toolchain TEXT,
+    mtime REAL NOT NULL,
+    built REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_by_collection
+    ON artifacts (id, format, version);
+CREATE INDEX IF NOT EXISTS artifacts_by_format ON artifacts (format);
+"""
+COLUMNS = ('path', 'id', 'version', 'format', 'runner', 'size', 'sha256',
+           'duration', 'toolchain', 'mtime', 'built',)
+
+
+def parse_filename(filename):
+    """Parse an artifact ``filename`` into its (id, version, format).
+    Returns None for anything that is not an artifact.
+    """
+    filename = os.path.basename(filename)
+    for suffix, format in FORMATS:
+        if not filename.endswith(suffix):
+            continue
+        parts = filename[:-len(suffix)].rsplit('-', 1)
+        if len(parts) == 2 and all(parts):
+            return parts[0], parts[1], format
+        return None
+    return None
+
+
+def version_key(version):
+    """Sort key of a collection version, 1.10 comes after 1.9."""
+    key = []
+    for part in version.split('.'):
+        try:
+            key.append((int(part), ''))
+        except ValueError:
+            key.append((-1, part))
+    return key
+
+
+def _toolchain(path):
+    """The toolchain revisions of the manifest of ``path``, if any."""
+    manifest = read_manifest(path)
+    if not manifest or not manifest.get('toolchain'):
+        return None
+    return ' '.join('{0}={1}'.format(key, value) for key, value
+                    in sorted(manifest['toolchain'].items()))
+
+
+class ArtifactIndex(object):
+    """The index of artifacts kept in the SQLite database at ``path``.
+    Rows are returned as dicts of ``COLUMNS``.
+    """
+
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # A connection of its own for each use, they are not to be
+        #   shared by threads.
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _select(self, where, args=(), order=''):
+        query = 'SELECT {0} FROM artifacts WHERE {1} {2}'.format(
+            ', '.join(COLUMNS), where, order)
+        with self._connect() as connection:
+            return [dict(row) for row in connection.execute(query, args)]
+
+    def record(self, path, runner=None, duration=None):
+        """Record the artifact at ``path``, built by ``runner`` in
+        ``duration`` seconds. An artifact that did not change since it
+        was recorded keeps its row. Returns the row, None when ``path``
+        is not an artifact.
+        """
+        path = os.path.abspath(path)
+        parsed = parse_filename(path)
+        if parsed is None:
+            return None
+        stat = os.stat(path)
+        row = self.get_path(path)
+        if row is not None and row['size'] == stat.st_size \
+           and row['mtime'] == stat.st_mtime:
+            return row
+        row = dict(zip(COLUMNS, (path,) + parsed + (
+            runner, stat.st_size, sha256_file(path), duration,
+            _toolchain(path), stat.st_mtime, time.time())))
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO artifacts ({0}) VALUES ({1})'.format(
+                    ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                [row[column] for column in COLUMNS])
+        return row
+
+    def remove(self, path):
+        """Forget the artifact at ``path``."""
+        with self._connect() as connection:
+            connection.execute('DELETE FROM artifacts WHERE path = ?',
+                               (os.path.abspath(path),))
+
+    def get_path(self, path):
+        rows = self._select('path = ?', (os.path.abspath(path),))
+        return rows and rows[0] or None
+
+    def find(self, pkg_name, version=None, format=None):
+        """The artifacts of collection ``pkg_name``, optionally of one
+        ``version`` and ``format``, newest version first.
+        """
+        where, args = ['id = ?'], [pkg_name]
+        if format is not None:
+            where.append('format = ?')
+            args.append(format)
+        if version is not None:
+            where.append('version = ?')
+            args.append(version)
+        rows = self._select(' AND '.join(where), args)
+        rows.sort(key=lambda row: (version_key(row['version']),
+                                   row['format']), reverse=True)
+        return rows
+
+    def exists(self, pkg_name, version, format):
+        """Tell whether the format of the collection version is built."""
+        return bool(self.find(pkg_name, version, format))
+
+    def latest(self, pkg_name, format):
+        """The version of the newest artifact of the format of the
+        collection, None when there is none.
+        """
+        rows = self.find(pkg_name, format=format)
+        return rows and rows[0]['version'] or None
+
+    def report(self):
+        """Capacity per format, as (format, count, bytes) tuples."""
+        query = ('SELECT format, COUNT(*), SUM(size) FROM artifacts '
+                 'GROUP BY format ORDER BY format')
+        with self._connect() as connection:
+            return [tuple(row) for row in connection.execute(query)]
+
+    def scan(self, directory):
+        """Record the artifacts found in ``directory``, e.g. to build
+        the index of an existing output directory. Returns their number.
+        """
+        count = 0
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            if os.path.isfile(path) and self.record(path) is not None:
+                count += 1
+        return count
+
+    def prune(self):
+        """Forget the artifacts that are gone. Returns their number."""
+        rows = self._select('1')
+        gone = [row['path'] for row in rows
+                if not os.path.exists(row['path'])]
+        for path in gone:
+            self.remove(path)
+        return len(gone)
+
+
+def get_index(settings):
+    """Return the artifact index configured in the runner ``settings``
+    or None if indexing is not enabled.
+
+    Available settings:
+
+    - **index-file** - SQLite database the published artifacts are
+      recorded in. Indexing is disabled when this is not set.
+
+    """
+    path = settings.get('index-file', None)
+    if not path:
+        return None
+    return ArtifactIndex(path)
+
+
+def indexed(runner):
+    """Decorate a runner function (``build_request, settings``) so the
+    artifacts it returns are recorded in the index, see ``get_index``
+    for the settings.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(build_request, settings={}):
+            started = time.time()
+            artifacts = func(build_request, settings)
+            duration = time.time() - started
+            try:
+                index = get_index(settings)
+                if index is not None:
+                    for path in artifacts or ():
+                        index.record(path, runner, duration)
+            except (sqlite3.Error, IOError, OSError):
+                # The index is no reason to fail a job.
+                logger.exception("Failed to index the artifacts.")
+            return artifacts
+        return wrapper
+    return decorator
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Query the index of the published artifacts")
+    parser.add_argument('index', help="index (SQLite) file")
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser(
+        'exists', help="exit 0 when the format of a version is built")
+    command.add_argument('id')
+    command.add_argument('version')
+    command.add_argument('format')
+    command = commands.add_parser(
+        'latest', help="print the newest version built of a format")
+    command.add_argument('id')
+    command.add_argument('format')
+    command = commands.add_parser('list',
+                                  help="list the artifacts of a collection")
+    command.add_argument('id')
+    command.add_argument('version', nargs='?')
+    commands.add_parser('report', help="print the size of each format")
+    command = commands.add_parser(
+        'scan', help="record the artifacts in output directories")
+    command.add_argument('directories', nargs='+')
+    commands.add_parser('prune', help="forget the artifacts that are gone")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    index = ArtifactIndex(args.index)
+    if args.command == 'exists':
+        return not index.exists(args.id, args.version, args.format) and 1 or 0
+    elif args.command == 'latest':
+        version = index.latest(args.id, args.format)
+        if version is None:
+            return 1
+        print(version)
+    elif args.command == 'list':
+        for row in index.find(args.id, args.version):
+            print('{version} {format} {size} {path}'.format(**row))
+    elif args.command == 'report':
+        for format, count, size in index.report():
+            print('{0}: {1} artifacts, {2} bytes'.format(format, count,
+                                                         size))
+    elif args.command == 'scan':
+        for directory in args.directories:
+            print('{0}: {1} artifacts'.format(directory,
+                                              index.scan(directory)))
+    elif args.command == 'prune':
+        print('{0} artifacts forgotten'.format(index.prune()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
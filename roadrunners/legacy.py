@@ -11,15 +11,26 @@ road runners that interfaces with the legacy (plone based) repository.
 """
 import os
 import sys
-import tempfile
+import errno
 import traceback
-import subprocess
 import shutil
 import jsonpickle
-import requests
 
 import coyote
-from .utils import logger, get_completezip, unpack_zip
+from .admission import admission_controlled
+from .command import run_command
+from .index import indexed
+from .manifest import make_manifest, is_current, write_manifest
+from .metrics import instrumented, phase
+from .profiling import profiled
+from .publish import publish
+from .retention import in_use
+from .sessions import get_session
+from .utils import (
+    logger, get_completezip, unpack_zip, cached_zip_size,
+    INTERRUPTIONS, download, load_validators, save_validators,
+    )
+from .workspace import build_workspace
 
 __all__ = (
     'make_completezip',
@@ -28,7 +39,38 @@ __all__ = (
     'make_collxml',
     )
 
+# The settings that shape the print pdf, recorded in its build manifest.
+PRINT_MANIFEST_SETTINGS = ('print-dir', 'python',)
+
+
+def _fetch_output(url, output_filepath, base_uri, settings, **kwargs):
+    """Stream the response to ``url`` to ``output_filepath``, rather
+    than hold it in memory. The output of an earlier run is revalidated
+    rather than transferred again.
+    """
+    validators = {}
+    if os.path.exists(output_filepath):
+        validators = load_validators(output_filepath)
+    try:
+        with phase('fetch') as fetching:
+            progress = download(url, output_filepath,
+                                session=get_session(base_uri, settings),
+                                validators=validators, **kwargs)
+            fetching.bytes = progress.received
+    except INTERRUPTIONS as exc:
+        raise coyote.Failed("Issue connecting to the depend service at "
+                            "{0}".format(url))
+    except RuntimeError as exc:
+        raise coyote.Failed(str(exc))
+    if progress.not_modified:
+        logger.debug("'{0}' is up to date.".format(output_filepath))
+    else:
+        save_validators(output_filepath, progress.validators)
+
 
+@instrumented('collxml')
+@profiled('collxml')
+@indexed('collxml')
 def make_collxml(build_request, settings={}):
     """\
     Creates a completezip by calling the (plone based) repository.
@@ -38,6 +80,16 @@ def make_collxml(build_request, settings={}):
     - **output-dir** - Directory where the produced file is stuck.
     - **path-to-content** - Useful for communication without a web server
       in front of zope. (default: /content)
+    - **http-*** - Connection pool and timeout settings, see
+      ``roadrunners.sessions.get_session``.
+    - **metrics-*** - Metrics export settings, see
+      ``roadrunners.metrics.export``.
+    - **index-file** - Index of the published artifacts, see
+      ``roadrunners.index.get_index``.
+    - **retention-*** - Output directory retention settings, see
+      ``roadrunners.retention.get_policy``.
+    - **profile*** - Opt-in profiling settings, see
+      ``roadrunners.profiling.should_profile``.
 
     """
     output_dir = settings['output-dir']
@@ -53,25 +105,15 @@ def make_collxml(build_request, settings={}):
     # Make a request to the repository to create the completezip.
     url = "{0}{1}/{2}/{3}/source_create".format(base_uri, content_path,
                                                   id, version)
-    try:
-        resp = requests.get(url)
-    except requests.exceptions.ConnectionError as exc:
-        raise coyote.Failed("Issue connecting to the depend service at "
-                          "{0}".format(url))
-
-    if resp.status_code != 200:
-        raise coyote.Failed("Response code is '{}' for '{}'.".format(
-                resp.status_code, resp.url))
-
-    # Write out the results to the filesystem.
     result_filename = "{0}-{1}.xml".format(id, version)
     output_filepath = os.path.join(output_dir, result_filename)
-    with open(output_filepath, 'wb') as f:
-        f.write(resp.content)
-
+    _fetch_output(url, output_filepath, base_uri, settings)
     return [output_filepath]
 
 
+@instrumented('completezip')
+@profiled('completezip')
+@indexed('completezip')
 def make_completezip(build_request, settings={}):
     """\
     Creates a completezip by calling the (plone based) repository.
@@ -83,6 +125,16 @@ def make_completezip(build_request, settings={}):
     - **password** - Self explanitory
     - **path-to-content** - Useful for communication without a web server
       in front of zope. (default: /content)
+    - **http-*** - Connection pool and timeout settings, see
+      ``roadrunners.sessions.get_session``.
+    - **metrics-*** - Metrics export settings, see
+      ``roadrunners.metrics.export``.
+    - **index-file** - Index of the published artifacts, see
+      ``roadrunners.index.get_index``.
+    - **retention-*** - Output directory retention settings, see
+      ``roadrunners.retention.get_policy``.
+    - **profile*** - Opt-in profiling settings, see
+      ``roadrunners.profiling.should_profile``.
 
     """
     output_dir = settings['output-dir']
@@ -100,25 +152,17 @@ def make_completezip(build_request, settings={}):
     # Make a request to the repository to create the completezip.
     url = "{0}{1}/{2}/{3}/create_complete".format(base_uri, content_path,
                                                   id, version)
-    try:
-        resp = requests.get(url, auth=(username, password))
-    except requests.exceptions.ConnectionError as exc:
-        raise coyote.Failed("Issue connecting to the depend service at "
-                          "{0}".format(url))
-
-    if resp.status_code != 200:
-        raise coyote.Failed("Response code is '{}' for '{}'.".format(
-                resp.status_code, resp.url))
-
-    # Write out the results to the filesystem.
     result_filename = "{0}-{1}.complete.zip".format(id, version)
     output_filepath = os.path.join(output_dir, result_filename)
-    with open(output_filepath, 'wb') as f:
-        f.write(resp.content)
-
+    _fetch_output(url, output_filepath, base_uri, settings,
+                  auth=(username, password))
     return [output_filepath]
 
 
+@instrumented('offlinezip')
+@admission_controlled('offlinezip')
+@profiled('offlinezip')
+@indexed('offlinezip')
 def make_offlinezip(build_request, settings={}):
     """\
     Creates an offlinezip using the complete zip (dependency).
@@ -130,6 +174,24 @@ def make_offlinezip(build_request, settings={}):
     - **cnx-buildout-dir** - Defines the location of cnx-buildout.
     - **python-env** - Defines a virtual-env directory to activate for this
       legacy stuff.
+    - **http-*** - Connection pool and timeout settings, see
+      ``roadrunners.sessions.get_session``.
+    - **cache-*** - Shared download cache settings, see
+      ``roadrunners.cache.get_cache``.
+    - **workspace-*** - Build directory settings, see
+      ``roadrunners.workspace.build_workspace``.
+    - **command-*** - Build command logging and limit settings, see
+      ``roadrunners.command.run_command``.
+    - **admission-*** - Host admission control settings, see
+      ``roadrunners.admission.get_controller``.
+    - **metrics-*** - Metrics export settings, see
+      ``roadrunners.metrics.export``.
+    - **index-file** - Index of the published artifacts, see
+      ``roadrunners.index.get_index``.
+    - **retention-*** - Output directory retention settings, see
+      ``roadrunners.retention.get_policy``.
+    - **profile*** - Opt-in profiling settings, see
+      ``roadrunners.profiling.should_profile``.
 
     Dependencies:
 
@@ -150,85 +212,93 @@ def make_offlinezip(build_request, settings={}):
     # This should be something like 'http://cnx.org:80'.
     base_uri = build_request.transport.uri.rstrip('/')
 
-    # Create a temporary directory to work in...
-    build_dir = tempfile.mkdtemp()
-    logger.debug("Working in '{0}'.".format(build_dir))
-
-    # Acquire the completezip file for use in the build. The
-    #   completezip could be in the output directory. If it's not
-    #   there we will need to download it from the host repository.
-    completezip_filename = '{0}-{1}.complete.zip'.format(id, version)
-    completezip_filepath = os.path.join(output_dir, completezip_filename)
-    if not os.path.exists(completezip_filepath):
-        # Looks like we will need to download the file...
+    expected_size = cached_zip_size(id, version, base_uri, 'complete',
+                                    settings)
+
+    # Create a temporary directory to work in, it is removed when
+    #   we are done with it, also when the build fails.
+    with build_workspace(settings, expected_size) as build_dir:
+        # Acquire the completezip file for use in the build. The
+        #   completezip could be in the output directory. If it's not
+        #   there we will need to download it from the host repository.
+        completezip_filename = '{0}-{1}.complete.zip'.format(id, version)
+        completezip_filepath = os.path.join(output_dir, completezip_filename)
+        fetched = False
         try:
-            completezip_filepath = get_completezip(id, version,
-                                                   base_uri, build_dir,
-                                                   unpack=False)
-        except Exception as exc:
-            raise Blocked("Issues is probably that the complete zip "
-                          "does not exist yet.")
-    else:
-        # The build script needs working directory access to the
-        #   complete zip file.
-        shutil.copy2(completezip_filepath, build_dir)
-
-    # Run the oer.exports script against the collection data.
-    build_script = os.path.join(cnxbuildout_dir, 'scripts',
-                                'content2epub.bash')
-    offlinezip_result_filename = '{0}-{1}.offline.zip'.format(id, version)
-    # XXX The build script putting the file somewhere other other than where
-    #     I told it to. *Grumbles*
-    unpacked_collection_dir = "{0}_{1}_complete".format(id, version)
-    offlinezip_result_filepath = os.path.join(build_dir,
-                                              unpacked_collection_dir,
-                                              offlinezip_result_filename)
-    epub_result_filename = '{0}-{1}.epub'.format(id, version)
-    epub_result_filepath = os.path.join(build_dir, epub_result_filename)
-
-    command = []
-    working_dir = build_dir
-    if python_env is not None:
-        activate = os.path.join(python_env, 'bin', 'activate')
-        command.extend(['source', activate, '&&'])
-        working_dir = python_env
-    command.extend([build_script, "Connexions", id, version,
-                    build_dir,  # maps to working directory
-                    completezip_filename,
-                    offlinezip_result_filename,
-                    epub_result_filename,
-                    oerexports_dir,
-                    ])
-    logger.debug("Running: " + ' '.join(command))
-    process = subprocess.Popen(' '.join(command),
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                               cwd=oerexports_dir, shell=True,
-                               executable='/bin/bash')
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        # Something went wrong...
-        raise coyote.Failed(stderr)
-    else:
-        msg = "Offline zip created, moving contents to final destination..."
-        logger.debug(msg)
-
-    # Write out the results to the filesystem.
-    offlinezip_output_filepath = os.path.join(output_dir,
-                                              offlinezip_result_filename)
-    epub_output_filepath = os.path.join(output_dir,
-                                        epub_result_filename)
-
-    shutil.copy2(offlinezip_result_filepath, output_dir)
-    shutil.copy2(epub_result_filepath, output_dir)
-    artifacts = [os.path.join(output_dir, offlinezip_result_filename),
-                 os.path.join(output_dir, epub_result_filename),
-                 ]
-
-    # Remove the temporary build directory
-    shutil.rmtree(build_dir)
+            # The build script needs working directory access to the
+            #   complete zip file.
+            with phase('fetch') as fetching, in_use(completezip_filepath):
+                fetching.bytes = os.path.getsize(completezip_filepath)
+                publish(completezip_filepath, build_dir, keep=True)
+            fetched = True
+        except IOError as exc:
+            # Not built, or removed by a retention sweep.
+            if exc.errno != errno.ENOENT:
+                raise
+        if not fetched:
+            # Looks like we will need to download the file...
+            try:
+                completezip_filepath = get_completezip(id, version,
+                                                       base_uri, build_dir,
+                                                       unpack=False,
+                                                       settings=settings)
+            except Exception as exc:
+                raise coyote.Blocked("Issues is probably that the complete "
+                                     "zip does not exist yet.")
+
+        # Run the oer.exports script against the collection data.
+        build_script = os.path.join(cnxbuildout_dir, 'scripts',
+                                    'content2epub.bash')
+        offlinezip_result_filename = '{0}-{1}.offline.zip'.format(id, version)
+        # XXX The build script putting the file somewhere other other than
+        #     where I told it to. *Grumbles*
+        unpacked_collection_dir = "{0}_{1}_complete".format(id, version)
+        offlinezip_result_filepath = os.path.join(build_dir,
+                                                  unpacked_collection_dir,
+                                                  offlinezip_result_filename)
+        epub_result_filename = '{0}-{1}.epub'.format(id, version)
+        epub_result_filepath = os.path.join(build_dir, epub_result_filename)
+
+        command = []
+        working_dir = build_dir
+        if python_env is not None:
+            activate = os.path.join(python_env, 'bin', 'activate')
+            command.extend(['source', activate, '&&'])
+            working_dir = python_env
+        command.extend([build_script, "Connexions", id, version,
+                        build_dir,  # maps to working directory
+                        completezip_filename,
+                        offlinezip_result_filename,
+                        epub_result_filename,
+                        oerexports_dir,
+                        ])
+        log_name = '{0}.log'.format(offlinezip_result_filename)
+        with phase('build'):
+            result = run_command(' '.join(command), oerexports_dir,
+                                 settings, log_name, shell=True,
+                                 executable='/bin/bash')
+        if result.returncode != 0:
+            # Something went wrong...
+            raise coyote.Failed(result.failure_message())
+        else:
+            msg = ("Offline zip created, moving contents to final "
+                   "destination...")
+            logger.debug(msg)
+
+        # Write out the results to the filesystem.
+        with phase('publish') as publishing:
+            publishing.bytes = (os.path.getsize(offlinezip_result_filepath)
+                                + os.path.getsize(epub_result_filepath))
+            artifacts = [publish(offlinezip_result_filepath, output_dir),
+                         publish(epub_result_filepath, output_dir),
+                         ]
 
     return artifacts
 
+@instrumented('print')
+@admission_controlled('print')
+@profiled('print')
+@indexed('print')
 def make_print(build_request, settings={}):
     """Interface with the Products.RhaptosPrint.printing Makefile.
 
@@ -237,6 +307,22 @@ def make_print(build_request, settings={}):
     - **output-dir** - Directory where the produced file is stuck.
     - **python** - Maps to the make file's PYTHON variable
     - **print-dir** - Maps to the make file's PRINT_DIR variable
+    - **force** - Build even when the output is current, see
+      ``roadrunners.manifest.is_current``.
+    - **workspace-*** - Build directory settings, see
+      ``roadrunners.workspace.build_workspace``.
+    - **command-*** - Build command logging and limit settings, see
+      ``roadrunners.command.run_command``.
+    - **admission-*** - Host admission control settings, see
+      ``roadrunners.admission.get_controller``.
+    - **metrics-*** - Metrics export settings, see
+      ``roadrunners.metrics.export``.
+    - **index-file** - Index of the published artifacts, see
+      ``roadrunners.index.get_index``.
+    - **retention-*** - Output directory retention settings, see
+      ``roadrunners.retention.get_policy``.
+    - **profile*** - Opt-in profiling settings, see
+      ``roadrunners.profiling.should_profile``.
 
     """
     output_dir = settings['output-dir']
@@ -249,63 +335,80 @@ def make_print(build_request, settings={}):
     status_message = "Starting job, timestamp: {0}".format(timestamp)
     logger.debug(status_message)
 
-    # Create a temporary directory to work in...
-    build_dir = tempfile.mkdtemp()
-    logger.debug("Working in '{0}'.".format(build_dir))
-
-
-    # Run the makefile from RhaptosPrint that will create the PDF
+    # The makefile fetches the collection from the repository itself,
+    #   a published version (not 'latest') of it does not change.
     id = build_request.get_package()
     version = build_request.get_version()
-    pdf_filename = "{}.pdf".format(id)
-    is_module = id.startswith('m')
-    make_file = is_module and 'module_print.mak' or 'course_print.mak'
-    command = ' '.join(['make', '-e', '-f', make_file, pdf_filename])
-
-    # put makefile in place
-    shutil.copy2(os.path.join(print_dir, make_file), build_dir)
-
-    # Override various make variables.
-    myenv = dict(os.environ)
-
-    host = build_request.transport.uri
-    host = '/'.join(host.split('/')[:3])  # just the {protocol}://{hostname}
-
-    #set up makefile variable overrides as envionment variables
-    overrides = {}
-    overrides['VERSION'] = build_request.job.packageinstance.package.version
-
-    if python_executable:
-        overrides['PYTHON'] = python_executable.encode('utf-8')
-    if print_dir:
-        overrides['PRINT_DIR'] = print_dir.encode('utf-8')
-
-    if host:
-        overrides['HOST'] = host.encode('utf-8')
-
-    logger.debug("Running command: " + command + " environ: " + str(overrides))
-    myenv.update(overrides)
-    process = subprocess.Popen(command,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                               cwd=build_dir, shell=True, env=myenv, 
-                               executable='/bin/bash')
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        raise coyote.Failed(stderr)
-    else:
-        msg = "PDF created, moving contents to final destination..."
-        logger.debug(msg)
-
+    host = '/'.join(build_request.transport.uri.split('/')[:3])
+    output_filepath = os.path.join(output_dir,
+                                   "{}-{}.pdf".format(id, version))
+    manifest = None
+    if version != 'latest':
+        with phase('manifest'):
+            manifest = make_manifest(
+                'print', settings, PRINT_MANIFEST_SETTINGS, ('print-dir',),
+                inputs={'host': host, 'id': id, 'version': version})
+            if is_current(output_filepath, manifest, settings):
+                logger.info("'{0}' is up to date.".format(output_filepath))
+                return [output_filepath]
+
+    # Create a temporary directory to work in, it is removed when
+    #   we are done with it, also when the build fails.
+    with build_workspace(settings) as build_dir:
+        # Run the makefile from RhaptosPrint that will create the PDF
+        pdf_filename = "{}.pdf".format(id)
+        is_module = id.startswith('m')
+        make_file = is_module and 'module_print.mak' or 'course_print.mak'
+        command = ' '.join(['make', '-e', '-f', make_file, pdf_filename])
+
+        # put makefile in place
+        shutil.copy2(os.path.join(print_dir, make_file), build_dir)
+
+        # Override various make variables.
+        myenv = dict(os.environ)
+
+        host = build_request.transport.uri
+        # just the {protocol}://{hostname}
+        host = '/'.join(host.split('/')[:3])
+
+        #set up makefile variable overrides as envionment variables
+        overrides = {}
+        package = build_request.job.packageinstance.package
+        overrides['VERSION'] = package.version
+
+        if python_executable:
+            overrides['PYTHON'] = python_executable.encode('utf-8')
+        if print_dir:
+            overrides['PRINT_DIR'] = print_dir.encode('utf-8')
+
+        if host:
+            overrides['HOST'] = host.encode('utf-8')
+
+        logger.debug("Running command: " + command + " environ: "
+                     + str(overrides))
+        myenv.update(overrides)
+        # The logs of all the builds share a directory.
+        log_name = '{0}-{1}.print.log'.format(id, version)
+        with phase('build'):
+            result = run_command(command, build_dir, settings, log_name,
+                                 shell=True, env=myenv,
+                                 executable='/bin/bash')
+        if result.returncode != 0:
+            raise coyote.Failed(result.failure_message())
+        else:
+            msg = "PDF created, moving contents to final destination..."
+            logger.debug(msg)
+
+
+        # Rename and move the resulting document to the defined location.
+        new_pdf_filename = "{}-{}.pdf".format(id, version)
+        pdf_filepath = os.path.join(build_dir, pdf_filename)
+        with phase('publish') as publishing:
+            publishing.bytes = os.path.getsize(pdf_filepath)
+            output_filepath = publish(pdf_filepath, output_dir,
+                                      new_pdf_filename)
+        if manifest is not None:
+            write_manifest(output_filepath, manifest)
 
-    # Rename and move the resulting document to the defined location.
-    new_pdf_filename = "{}-{}.pdf".format(id, version)
-    os.rename(os.path.join(build_dir, pdf_filename),
-              os.path.join(build_dir, new_pdf_filename))
-    pdf_filename = new_pdf_filename
-    shutil.copy2(os.path.join(build_dir, pdf_filename), output_dir)
 
-    # Remove the temporary build directory
-    shutil.rmtree(build_dir)
-
-
-    return [os.path.join(output_dir, pdf_filename)]
+    return [output_filepath]
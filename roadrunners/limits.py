@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Resource limits (memory, CPU time, open files, priority) for the build
+commands, so that one oversized build fails on its own instead of
+starving the other jobs on the host or waking the OOM killer.
+
+"""
+import os
+import signal
+import resource
+
+from .config import assize
+
+__all__ = ('ResourceLimits', 'get_limits',)
+
+# Seconds between the CPU time soft limit (SIGXCPU) and the hard limit
+#   (SIGKILL), so that the soft limit is what is usually hit.
+CPU_HARD_LIMIT_MARGIN = 5
+
+# Output that gives away a failed allocation or a full file table.
+_MEMORY_ERRORS = ('MemoryError', 'Cannot allocate memory', 'Out of memory',
+                  'out of memory', 'std::bad_alloc',
+                  'java.lang.OutOfMemoryError',)
+_OPEN_FILES_ERRORS = ('Too many open files',)
+
+
+class ResourceLimits(object):
+    """Limits applied to a command's processes as it starts. Each of the
+    processes gets these limits (they are inherited), they are not
+    shared.
+
+    - ``memory`` - Bytes of address space (``RLIMIT_AS``).
+    - ``cpu_time`` - Seconds of CPU time (``RLIMIT_CPU``).
+    - ``open_files`` - Number of file descriptors (``RLIMIT_NOFILE``).
+    - ``nice`` - Increment to the scheduling niceness.
+
+    """
+
+    def __init__(self, memory=None, cpu_time=None, open_files=None,
+                 nice=None):
+        self.memory = memory
+        self.cpu_time = cpu_time
+        self.open_files = open_files
+        self.nice = nice
+
+    def without_cpu_time(self):
+        """A copy of these limits without the CPU time limit, for
+        processes that live across jobs.
+        """
+        return ResourceLimits(self.memory, None, self.open_files, self.nice)
+
+    def apply(self):
+        """Apply the limits to the current process. This is meant to
+        run in the child, before the command is executed.
+        """
+        if self.nice:
+            os.nice(self.nice)
+        if self.memory is not None:
+            resource.setrlimit(resource.RLIMIT_AS,
+                               (self.memory, self.memory))
+        if self.cpu_time is not None:
+            resource.setrlimit(resource.RLIMIT_CPU,
+                               (self.cpu_time,
+                                self.cpu_time + CPU_HARD_LIMIT_MARGIN))
+        if self.open_files is not None:
+            resource.setrlimit(resource.RLIMIT_NOFILE,
+                               (self.open_files, self.open_files))
+
+    def classify(self, returncode, output):
+        """Tell which limit, if any, made a command fail with
+        ``returncode`` and ``output`` (the tail of its output). Returns
+        ``memory-limit``, ``cpu-time-limit``, ``open-files-limit`` or
+        None.
+        """
+        if returncode == 0:
+            return None
+        if self.cpu_time is not None and returncode in (
+                -signal.SIGXCPU, 128 + signal.SIGXCPU):
+            # The command, or a child of the shell running it, was
+            #   signalled for going over the soft limit.
+            return 'cpu-time-limit'
+        if self.memory is not None \
+           and any(error in output for error in _MEMORY_ERRORS):
+            return 'memory-limit'
+        if self.open_files is not None \
+           and any(error in output for error in _OPEN_FILES_ERRORS):
+            return 'open-files-limit'
+        return None
+
+    def describe(self, reason):
+        """Describe the limit named ``reason`` (see ``classify``)."""
+        if reason == 'memory-limit':
+            return "its memory limit ({0} bytes)".format(self.memory)
+        elif reason == 'cpu-time-limit':
+            return "its CPU time limit ({0} seconds)".format(self.cpu_time)
+        elif reason == 'open-files-limit':
+            return "its open files limit ({0})".format(self.open_files)
+        raise ValueError(reason)
+
+
+def get_limits(settings):
+    """Return the ``ResourceLimits`` configured in the runner ``settings``
+    or None when no limits are set.
+
+    Available settings:
+
+    - **command-max-memory** - Address space each build process may
+      use, e.g. ``2G``.
+    - **command-max-cpu-time** - CPU seconds each build process may use.
+    - **command-max-open-files** - Number of files each build process
+      may have open.
+    - **command-nice** - Niceness added to the build processes, e.g.
+      ``10`` to let other work on the host go first.
+
+    """
+    memory = settings.get('command-max-memory', None)
+    cpu_time = settings.get('command-max-cpu-time', None)
+    open_files = settings.get('command-max-open-files', None)
+    nice = settings.get('command-nice', None)
+    if memory is None and cpu_time is None and open_files is None \
+       and nice is None:
+        return None
+    return ResourceLimits(
+        memory=memory is not None and assize(memory) or None,
+        cpu_time=cpu_time is not None and int(cpu_time) or None,
+        open_files=open_files is not None and int(open_files) or None,
+        nice=nice is not None and int(nice) or None)
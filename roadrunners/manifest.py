@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Build manifests, written next to a runner's output as
+``<output>.manifest.json``. A manifest records what the output was built
+from: the SHA-256 of the input zip, the settings that shape the output
+and the revision of the toolchain checkout (oer.exports, RhaptosPrint).
+A runner about to build the same output from the same inputs with the
+same toolchain returns the existing output instead.
+
+"""
+import os
+import json
+import time
+import logging
+import threading
+import subprocess
+
+from .cache import sha256_file
+from .config import asbool
+
+__all__ = ('MANIFEST_SUFFIX', 'toolchain_revision', 'make_manifest',
+           'read_manifest', 'write_manifest', 'is_current',)
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_SUFFIX = '.manifest.json'
+# Seconds a toolchain revision is remembered, the checkout can be
+#   updated underneath a long running process.
+REVISION_TTL = 60
+
+_revisions = {}
+_revisions_lock = threading.Lock()
+
+
+def _git(directory, *args):
+    process = subprocess.Popen(('git',) + args, cwd=directory,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise OSError(err.strip())
+    return out.strip()
+
+
+def toolchain_revision(directory):
+    """The git revision checked out in ``directory``, suffixed with
+    ``+dirty`` when tracked files were changed. Returns None when it is
+    not a git checkout, or git is not available.
+    """
+    directory = os.path.abspath(directory)
+    now = time.time()
+    with _revisions_lock:
+        cached = _revisions.get(directory)
+        if cached is not None and now - cached[0] < REVISION_TTL:
+            return cached[1]
+    try:
+        revision = _git(directory, 'rev-parse', 'HEAD')
+        if _git(directory, 'status', '--porcelain', '--untracked-files=no'):
+            revision += '+dirty'
+    except OSError as exc:
+        logger.debug("No revision for '{0}': {1}".format(directory, exc))
+        revision = None
+    with _revisions_lock:
+        _revisions[directory] = (now, revision)
+    return revision
+
+
+def make_manifest(runner, settings, keys=(), toolchains=(), files={},
+                  inputs={}):
+    """Describe a build of ``runner`` from the input ``files`` (a dict
+    of names to paths, these are hashed) and other ``inputs`` (names to
+    values), the ``keys`` of its ``settings`` that shape the output and
+    the ``toolchains``, the keys of the checkout directories it runs.
+    """
+    manifest = {'runner': runner, 'inputs': dict(inputs), 'settings': {},
+                'toolchain': {}}
+    for name, path in files.items():
+        manifest['inputs'][name] = sha256_file(path)
+    for key in keys:
+        manifest['settings'][key] = settings.get(key)
+    for key in toolchains:
+        directory = settings.get(key)
+        manifest['toolchain'][key] = directory \
+            and toolchain_revision(directory) or None
+    return manifest
+
+
+def read_manifest(output_filepath):
+    """Read the manifest of ``output_filepath``, None if there is none."""
+    try:
+        with open(output_filepath + MANIFEST_SUFFIX, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_manifest(output_filepath, manifest):
+    """Record the ``manifest`` that ``output_filepath`` was built from."""
+    manifest = dict(manifest, size=os.path.getsize(output_filepath),
+                    built=time.time())
+    path = output_filepath + MANIFEST_SUFFIX
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def is_current(output_filepath, manifest, settings={}):
+    """Tell whether ``output_filepath`` was built as the ``manifest``
+    describes, so it need not be built again. An unknown toolchain
+    revision, or a changed checkout, is never current.
+
+    Available settings:
+
+    - **force** - Always build, ignoring the manifests. (default: false)
+
+    """
+    if asbool(settings.get('force', False)):
+        return False
+    if not all(revision and not revision.endswith('+dirty')
+               for revision in manifest['toolchain'].values()):
+        return False
+    recorded = read_manifest(output_filepath)
+    if recorded is None or not os.path.exists(output_filepath):
+        return False
+    if recorded.get('size') != os.path.getsize(output_filepath):
+        return False
+    return all(recorded.get(key) == value
+               for key, value in manifest.items())
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Timing and resource metrics of the runner jobs, by phase (fetch, unpack,
+transform, build, publish, cleanup).
+
+A runner decorated with ``instrumented`` records a ``JobMetrics`` for
+each job. Code anywhere below the runner wraps its work in ``phase``,
+which adds to the current job of the thread, if any. At the end of a
+job its metrics are appended as one JSON line to the metrics file and
+the totals of the process are written to a Prometheus text format file,
+for the node exporter's textfile collector to pick up.
+
+"""
+import os
+import re
+import json
+import time
+import errno
+import socket
+import logging
+import resource
+import functools
+import threading
+import contextlib
+
+from .command import recording
+
+__all__ = ('JobMetrics', 'phase', 'current_job', 'instrumented',
+           'register_collector',)
+
+logger = logging.getLogger(__name__)
+
+_PROMETHEUS_PREFIX = 'roadrunners-'
+_PROMETHEUS_NAME = re.compile(r'^roadrunners-(\d+)\.prom$')
+
+_local = threading.local()
+_totals_lock = threading.Lock()
+# Process-wide totals, exported in the Prometheus format.
+_jobs_total = {}  # (runner, status) -> count
+_phase_seconds = {}  # (runner, phase) -> seconds
+_phase_bytes = {}  # (runner, phase) -> bytes
+_peak_rss = {}  # runner -> bytes, of the last job
+_collectors = []
+# Seconds between the samples of the memory use of the running phases.
+SAMPLE_INTERVAL = 0.05
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+
+
+def max_rss():
+    """The high-water mark of the resident set size of this process in
+    bytes.
+    """
+    # Linux reports it in kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Sampler(object):
+    """Samples the resident set size of this process while phases are
+    running, raising their ``peak_rss``, so that a peak that is freed
+    before the phase ends is seen too.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.phases = set()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def add(self, measured):
+        with self.condition:
+            self.phases.add(measured)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run,
+                                               name='metrics-sampler')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def discard(self, measured):
+        with self.condition:
+            self.phases.discard(measured)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.phases:
+                    self.condition.wait()
+                phases = list(self.phases)
+            rss = current_rss()
+            for measured in phases:
+                measured.peak_rss = max(measured.peak_rss, rss)
+            time.sleep(self.interval)
+
+
+_sampler = _Sampler()
+
+
+class Phase(object):
+    """Measurements of one phase of a job. Code running in the phase can
+    add to ``bytes`` to record the amount of data it moved.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.duration = None
+        self.bytes = 0
+        self.peak_rss = 0
+        self.commands = 0
+        self.failed = False
+
+    def as_dict(self):
+        return {'name': self.name, 'duration': self.duration,
+                'bytes': self.bytes, 'peak_rss': self.peak_rss,
+                'commands': self.commands, 'failed': self.failed,
+                }
+
+
+class JobMetrics(object):
+    """The metrics of one job of ``runner``, identified by ``job``."""
+
+    def __init__(self, runner, job=None):
+        self.runner = runner
+        self.job = job
+        self.started = time.time()
+        self.duration = None
+        self.status = None
+        self.phases = []
+        self.peak_rss = 0
+
+    def add(self, measured):
+        self.phases.append(measured)
+        self.peak_rss = max(self.peak_rss, measured.peak_rss)
+
+    def as_dict(self):
+        return {'runner': self.runner, 'job': self.job,
+                'host': socket.gethostname(), 'pid': os.getpid(),
+                'started': self.started, 'duration': self.duration,
+                'status': self.status, 'peak_rss': self.peak_rss,
+                'phases': [p.as_dict() for p in self.phases],
+                }
+
+
+def current_job():
+    """The ``JobMetrics`` of the job running in this thread, or None."""
+    return getattr(_local, 'job', None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Measure the phase ``name`` of the current job for the duration of
+    the context, whose value is the ``Phase``. The peak memory use is
+    that of this process, sampled during the phase, or of the commands
+    run in the phase, whichever is larger.
+    """
+    measured = Phase(name)
+    measured.peak_rss = current_rss()
+    max_rss_started = max_rss()
+    _sampler.add(measured)
+    try:
+        with recording() as commands:
+            yield measured
+    except:
+        measured.failed = True
+        raise
+    finally:
+        _sampler.discard(measured)
+        measured.duration = time.time() - measured.started
+        measured.commands = len(commands)
+        peak_rss = max(measured.peak_rss, current_rss())
+        # A new high-water mark of the process was reached in the phase,
+        #   whether or not it was sampled.
+        max_rss_ended = max_rss()
+        if max_rss_ended > max_rss_started:
+            peak_rss = max(peak_rss, max_rss_ended)
+        measured.peak_rss = max([peak_rss]
+                                + [c.peak_rss for c in commands])
+        job = current_job()
+        if job is not None:
+            job.add(measured)
+        logger.debug("Phase '{0}' took {1:.3f}s, {2} bytes.".format(
+            name, measured.duration, measured.bytes))
+
+
+def register_collector(collector):
+    """Add a function returning more samples for the Prometheus export,
+    as (name, type, help, labels, value) tuples.
+    """
+    if collector not in _collectors:
+        _collectors.append(collector)
+
+
+def _update_totals(job):
+    with _totals_lock:
+        key = (job.runner, job.status)
+        _jobs_total[key] = _jobs_total.get(key, 0) + 1
+        for measured in job.phases:
+            key = (job.runner, measured.name)
+            _phase_seconds[key] = _phase_seconds.get(key, 0) \
+                + measured.duration
+            _phase_bytes[key] = _phase_bytes.get(key, 0) + measured.bytes
+        _peak_rss[job.runner] = job.peak_rss
+
+
+def _format_labels(labels):
+    return ','.join('{0}="{1}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in sorted(labels.items()))
+
+
+def prometheus_samples():
+    """The process-wide totals, as (name, type, help, labels, value)
+    tuples.
+    """
+    samples = []
+    with _totals_lock:
+        for (runner, status), count in sorted(_jobs_total.items()):
+            samples.append(('roadrunners_jobs_total', 'counter',
+                            "Jobs finished, by runner and status.",
+                            {'runner': runner, 'status': status}, count))
+        for (runner, name), seconds in sorted(_phase_seconds.items()):
+            samples.append(('roadrunners_phase_seconds_total', 'counter',
+                            "Time spent in each phase of the jobs.",
+                            {'runner': runner, 'phase': name}, seconds))
+        for (runner, name), size in sorted(_phase_bytes.items()):
+            samples.append(('roadrunners_phase_bytes_total', 'counter',
+                            "Bytes moved in each phase of the jobs.",
+                            {'runner': runner, 'phase': name}, size))
+        for runner, size in sorted(_peak_rss.items()):
+            samples.append(('roadrunners_job_peak_rss_bytes', 'gauge',
+                            "Peak memory use of the last job.",
+                            {'runner': runner}, size))
+    for collector in list(_collectors):
+        try:
+            samples.extend(collector())
+        except Exception:
+            logger.exception("Failed to collect metrics.")
+    return samples
+
+
+def format_prometheus(samples):
+    """Render ``samples`` in the Prometheus text format."""
+    lines = []
+    described = set()
+    for name, type, help, labels, value in samples:
+        if name not in described:
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, type))
+            described.add(name)
+        if labels:
+            name = '{0}{{{1}}}'.format(name, _format_labels(labels))
+        lines.append('{0} {1}'.format(name, repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(directory):
+    """Write the metrics of this process to ``directory``, replacing the
+    earlier version. Files of processes that are gone are removed.
+    """
+    for name in os.listdir(directory):
+        match = _PROMETHEUS_NAME.match(name)
+        if match is not None and not _pid_alive(int(match.group(1))):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+    path = os.path.join(directory, '{0}{1}.prom'.format(_PROMETHEUS_PREFIX,
+                                                        os.getpid()))
+    # The collector skips files not ending in .prom, so this is not
+    #   picked up half written.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(format_prometheus(prometheus_samples()))
+    os.rename(tmp_path, path)
+
+
+def write_json_line(path, job):
+    """Append the metrics of ``job`` to the JSON lines file at
+    ``path``.
+    """
+    line = json.dumps(job.as_dict(), sort_keys=True) + '\n'
+    # A single write to a file opened for appending is not interleaved
+    #   with those of other processes.
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def export(job, settings):
+    """Export the metrics of the finished ``job``.
+
+    Available settings:
+
+    - **metrics-file** - File the metrics of each job are appended to,
+      as JSON lines.
+    - **metrics-prometheus-dir** - Directory (of the node exporter's
+      textfile collector) the process' metrics are written to, in the
+      Prometheus text format.
+
+    """
+    _update_totals(job)
+    metrics_file = settings.get('metrics-file', None)
+    prometheus_dir = settings.get('metrics-prometheus-dir', None)
+    try:
+        if metrics_file:
+            write_json_line(metrics_file, job)
+        if prometheus_dir:
+            write_prometheus(prometheus_dir)
+    except (IOError, OSError):
+        # Metrics are no reason to fail a job.
+        logger.exception("Failed to export metrics.")
+
+
+def _job_id(build_request):
+    try:
+        return '{0}/{1}'.format(build_request.get_package(),
+                                build_request.get_version())
+    except Exception:
+        return None
+
+
+def instrumented(runner):
+    """Decorate a runner function (``build_request, settings``) so the
+    metrics of its jobs are recorded and exported, see ``export`` for
+    the settings.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(build_request, settings={}):
+            job = JobMetrics(runner, _job_id(build_request))
+            previous, _local.job = current_job(), job
+            try:
+                result = func(build_request, settings)
+                job.status = 'ok'
+                return result
+            except Exception as exc:
+                job.status = type(exc).__name__.lower()
+                raise
+            finally:
+                _local.job = previous
+                job.duration = time.time() - job.started
+                export(job, settings)
+                logger.debug("Job {0} ({1}) took {2:.3f}s: {3}".format(
+                    job.job, runner, job.duration, ', '.join(
+                        '{0} {1:.3f}s'.format(p.name, p.duration)
+                        for p in job.phases)))
+        return wrapper
+    return decorator
@@ -11,17 +11,31 @@ rbit extensions for integration with oer.exports pdf generation code.
 """
 import os
 import sys
-import subprocess
-import shutil
-import tempfile
+import errno
 import jsonpickle
-from lxml import etree
 
 import coyote
 from . import utils
+from .admission import admission_controlled
+from .index import indexed
+from .manifest import make_manifest, is_current, write_manifest
+from .metrics import instrumented, phase
+from .profiling import profiled
+from .publish import publish
+from .retention import in_use
 from .utils import logger
+from .worker import run_script
+from .workspace import build_workspace
+from .xslt import extract_print_style
 
+# The settings that shape the pdf, recorded in its build manifest.
+MANIFEST_SETTINGS = ('oer.exports-dir', 'pdf-generator', 'python',)
 
+
+@instrumented('pdf')
+@admission_controlled('pdf')
+@profiled('pdf')
+@indexed('pdf')
 def make_pdf(build_request, settings={}):
     """rbit extension to interface with the oer.exports epub code.
 
@@ -31,71 +45,119 @@ def make_pdf(build_request, settings={}):
     - **oer.exports-dir** - Defines the location of the oer.exports package.
     - **pdf-generator** - Executable location for wkhtml2pdf or princexml.
     - **python** - Defines which python executable should be used.
+    - **force** - Build even when the output is current, see
+      ``roadrunners.manifest.is_current``.
+    - **oer.exports-worker*** - Long-lived worker settings, see
+      ``roadrunners.worker.get_worker``.
+    - **command-*** - Build command logging and limit settings, see
+      ``roadrunners.command.run_command``.
+    - **admission-*** - Host admission control settings, see
+      ``roadrunners.admission.get_controller``.
+    - **metrics-*** - Metrics export settings, see
+      ``roadrunners.metrics.export``.
+    - **index-file** - Index of the published artifacts, see
+      ``roadrunners.index.get_index``.
+    - **retention-*** - Output directory retention settings, see
+      ``roadrunners.retention.get_policy``.
+    - **profile*** - Opt-in profiling settings, see
+      ``roadrunners.profiling.should_profile``.
+    - **http-*** - Connection pool and timeout settings, see
+      ``roadrunners.sessions.get_session``.
+    - **cache-*** - Shared download cache settings, see
+      ``roadrunners.cache.get_cache``.
+    - **workspace-*** - Build directory settings, see
+      ``roadrunners.workspace.build_workspace``.
 
     """
-    python_executable = settings.get('python', sys.executable)
     oerexports_dir = settings['oer.exports-dir']
     output_dir = settings['output-dir']
     pdf_generator_executable = settings['pdf-generator']
 
-    # Create a temporary directory to work in...
-    build_dir = tempfile.mkdtemp()
-    logger.debug("Working in '{0}'.".format(build_dir))
-
-    # Acquire the collection's data in a collection directory format.
     pkg_name = build_request.get_package()
     version = build_request.get_version()
     base_uri = build_request.transport.uri
-    collection_dir = utils.get_offlinezip(pkg_name, version, base_uri,
-                                           build_dir)
-    collection_dir = os.path.join(build_dir, collection_dir, 'content')
-
-    # FIXME We need to grab the version from the unpacked directory
-    #       name because 'latest' is only a symbolic name that will
-    #       not be used in the resulting filename.
-    if version == 'latest':
-        # Using the unpacked complete zip filename, with the structure
-        #   <id>_<version>_complete, we can parse the version.
-        version = collection_dir.split('_')[1]
-
-    #Extract the print-style from the collection.xml
-    printstyle_xsl = os.path.join(oerexports_dir,'xsl','collxml-print-style.xsl')
-    collxml_path = os.path.join(collection_dir,'collection.xml')
-    xslt = etree.XSLT(etree.parse(printstyle_xsl))
-    collxml = etree.parse(collxml_path)
-    printstyle = str(xslt(collxml)).strip()
-    
-    
-    # Run the oer.exports script against the collection data.
-    build_script = os.path.join(oerexports_dir, 'collectiondbk2pdf.py')
-    result_filename = '{0}-{1}.pdf'.format(build_request.get_package(),
-                                           version)
-    result_filepath = os.path.join(build_dir, result_filename)
-    command = [python_executable, build_script,
-               '-p', pdf_generator_executable,
-               '-d', collection_dir,
-               # XXX We need a place to input this option...
-               '-s', printstyle,
-               result_filepath,
-               ]
-    logger.debug("Running: " + ' '.join(command))
-    process = subprocess.Popen(command,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                               cwd=build_dir)
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        # Something went wrong...
-        raise coyote.Failed("Unknown issue: \n" + stderr)
-        return
-    else:
-        msg = "PDF created, moving contents to final destination..."
-        logger.debug(msg)
-
-    # Move the file to it's final destination.
-    shutil.copy2(result_filepath, output_dir)
-    output_filepath = os.path.join(output_dir, result_filename)
-
-    # Remove the temporary build directory
-    shutil.rmtree(build_dir)
+    expected_size = utils.cached_zip_size(pkg_name, version, base_uri,
+                                          'offline', settings)
+
+    # Create a temporary directory to work in, it is removed when
+    #   we are done with it, also when the build fails.
+    with build_workspace(settings, expected_size) as build_dir:
+        # Acquire the collection's data in a collection directory format.
+        #   The offlinezip could be in the output directory, built by
+        #   the offlinezip runner. If it's not there we will need to
+        #   download it from the host repository.
+        offlinezip_filename = '{0}-{1}.offline.zip'.format(pkg_name, version)
+        offlinezip_filepath = os.path.join(output_dir, offlinezip_filename)
+        zip_filepath = None
+        try:
+            with phase('fetch') as fetching, in_use(offlinezip_filepath):
+                fetching.bytes = os.path.getsize(offlinezip_filepath)
+                publish(offlinezip_filepath, build_dir, keep=True)
+            zip_filepath = os.path.join(build_dir, offlinezip_filename)
+        except IOError as exc:
+            # Not built, or removed by a retention sweep.
+            if exc.errno != errno.ENOENT:
+                raise
+        if zip_filepath is None:
+            zip_filepath = utils.get_offlinezip(pkg_name, version, base_uri,
+                                                build_dir, unpack=False,
+                                                settings=settings)
+        # 'latest' is only a symbolic name that will not be used in the
+        #   resulting filename, the offline zip's top level directory,
+        #   <id>_<version>_complete, has the version.
+        if version == 'latest':
+            version = utils.resolve_zip_version(zip_filepath) or version
+
+        result_filename = '{0}-{1}.pdf'.format(build_request.get_package(),
+                                               version)
+        output_filepath = os.path.join(output_dir, result_filename)
+        with phase('manifest'):
+            manifest = make_manifest('pdf', settings, MANIFEST_SETTINGS,
+                                     ('oer.exports-dir',),
+                                     files={'offline': zip_filepath})
+            if is_current(output_filepath, manifest, settings):
+                logger.info("'{0}' is up to date.".format(output_filepath))
+                return [output_filepath]
+
+        with phase('unpack') as unpacking:
+            unpacking.bytes = os.path.getsize(zip_filepath)
+            collection_dir = utils.unpack_zip(zip_filepath, build_dir)[0]
+        collection_dir = os.path.join(build_dir, collection_dir, 'content')
+
+        #Extract the print-style from the collection.xml
+        printstyle_xsl = os.path.join(oerexports_dir, 'xsl',
+                                      'collxml-print-style.xsl')
+        collxml_path = os.path.join(collection_dir,'collection.xml')
+        with phase('transform'):
+            printstyle = extract_print_style(collxml_path, printstyle_xsl)
+
+
+        # Run the oer.exports script against the collection data.
+        build_script = os.path.join(oerexports_dir, 'collectiondbk2pdf.py')
+        result_filepath = os.path.join(build_dir, result_filename)
+        args = ['-p', pdf_generator_executable,
+                '-d', collection_dir,
+                # XXX We need a place to input this option...
+                '-s', printstyle,
+                result_filepath,
+                ]
+        log_name = '{0}.log'.format(result_filename)
+        with phase('build'):
+            result = run_script(build_script, args, build_dir, settings,
+                                log_name)
+        if result.returncode != 0:
+            # Something went wrong...
+            raise coyote.Failed("Unknown issue: \n"
+                                + result.failure_message())
+            return
+        else:
+            msg = "PDF created, moving contents to final destination..."
+            logger.debug(msg)
+
+        # Move the file to it's final destination.
+        with phase('publish') as publishing:
+            publishing.bytes = os.path.getsize(result_filepath)
+            output_filepath = publish(result_filepath, output_dir)
+        write_manifest(output_filepath, manifest)
 
     return [output_filepath]
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Plan the jobs that build a format of a collection version, from what
+each runner requires and produces, instead of discovering the
+dependencies by failing (``coyote.Blocked``) and retrying.
+
+The plan is a graph of ``roadrunners.dispatch.Job``, each requiring the
+jobs that produce its input. Jobs whose outputs are already fresh are
+left out, and so are those whose outputs another job of the plan
+produces as well. A plan in which two jobs would otherwise write the
+same file is rejected.
+
+"""
+import os
+
+from .dispatch import Job, DEFAULT_URI
+
+__all__ = ('Contract', 'CONTRACTS', 'Planner',)
+
+
+class Contract(object):
+    """What the runner ``runner`` (``<module>:<function>``) requires,
+    the ``requires`` contracts, and the files it ``outputs`` to its
+    ``output-dir``, as templates of the collection ``id`` and
+    ``version``.
+    """
+
+    def __init__(self, name, runner, requires=(), outputs=()):
+        self.name = name
+        self.runner = runner
+        self.requires = tuple(requires)
+        self.outputs = tuple(outputs)
+
+    def output_paths(self, pkg_name, version, settings):
+        output_dir = settings['output-dir']
+        return [os.path.join(output_dir, template.format(id=pkg_name,
+                                                         version=version))
+                for template in self.outputs]
+
+
+CONTRACTS = (
+    Contract('collxml', 'roadrunners.legacy:make_collxml',
+             outputs=('{id}-{version}.xml',)),
+    # The repository creates the complete zip that is then also
+    #   available for download, to the epub runner.
+    Contract('completezip', 'roadrunners.legacy:make_completezip',
+             outputs=('{id}-{version}.complete.zip',)),
+    Contract('offlinezip', 'roadrunners.legacy:make_offlinezip',
+             requires=('completezip',),
+             outputs=('{id}-{version}.offline.zip', '{id}-{version}.epub')),
+    Contract('epub', 'roadrunners.epub:make_epub',
+             requires=('completezip',),
+             outputs=('{id}-{version}.epub',)),
+    Contract('pdf', 'roadrunners.pdf:make_pdf',
+             requires=('offlinezip',),
+             outputs=('{id}-{version}.pdf',)),
+    # Publishes the same file as the pdf runner, the two are not to be
+    #   planned together on one output directory.
+    Contract('print', 'roadrunners.legacy:make_print',
+             outputs=('{id}-{version}.pdf',)),
+    )
+
+
+def _runner_spec(settings):
+    return settings.get('runner', '').split('!', 1)[-1]
+
+
+class Planner(object):
+    """Plans jobs for the runners configured in ``runner_settings``, a
+    dict of the ``[runner:<name>]`` sections' settings by name. The jobs
+    of a plan are for these runner names.
+    """
+
+    def __init__(self, runner_settings, contracts=CONTRACTS):
+        self.runner_settings = runner_settings
+        self.contracts = dict((c.name, c) for c in contracts)
+        by_spec = dict((c.runner, c) for c in contracts)
+        # The contract of each configured runner, and the runner
+        #   configured for each contract.
+        self.contract_of = {}
+        self.runner_for = {}
+        for name, settings in sorted(runner_settings.items()):
+            contract = by_spec.get(_runner_spec(settings))
+            if contract is None:
+                continue
+            self.contract_of[name] = contract
+            self.runner_for.setdefault(contract.name, name)
+
+    def outputs(self, runner, pkg_name, version):
+        """Paths of the files ``runner`` produces for the collection."""
+        return self.contract_of[runner].output_paths(
+            pkg_name, version, self.runner_settings[runner])
+
+    def requirements(self, runner):
+        """The runner names ``runner`` directly requires."""
+        names = []
+        for required in self.contract_of[runner].requires:
+            name = self.runner_for.get(required)
+            if name is None:
+                raise ValueError("No runner is configured for the {0} "
+                                 "that {1} requires.".format(required,
+                                                             runner))
+            names.append(name)
+        return names
+
+    def is_fresh(self, runner, pkg_name, version, fresh_inputs=True):
+        """Tell whether the outputs of ``runner`` for the collection
+        exist and are newer than those of the runners it requires.
+        Nothing of the moving ``latest`` version is ever fresh.
+        """
+        if version == 'latest' or not fresh_inputs:
+            return False
+        paths = self.outputs(runner, pkg_name, version)
+        if not all(os.path.exists(path) for path in paths):
+            return False
+        built = min(os.path.getmtime(path) for path in paths)
+        for required in self.requirements(runner):
+            for path in self.outputs(required, pkg_name, version):
+                if os.path.getmtime(path) > built:
+                    return False
+        return True
+
+    def _merge_outputs(self, jobs, pkg_name, version):
+        """Leave out the ``jobs`` whose outputs another of the jobs
+        produces as well, e.g. the epub of the offlinezip, its
+        dependents require that job instead. Raises ValueError when two
+        jobs would otherwise write the same file.
+        """
+        outputs = dict((job.runner,
+                        set(self.outputs(job.runner, pkg_name, version)))
+                       for job in jobs)
+        covered_by = {}
+        for job in jobs:
+            for other in jobs:
+                shared = outputs[job.runner] & outputs[other.runner]
+                if other is job or not shared:
+                    continue
+                if outputs[job.runner] < outputs[other.runner]:
+                    covered_by[job.runner] = other.runner
+                elif not outputs[other.runner] < outputs[job.runner]:
+                    raise ValueError("The {0} and {1} runners both "
+                                     "produce {2}.".format(
+                                         job.runner, other.runner,
+                                         ', '.join(sorted(shared))))
+
+        def runner_of(name):
+            while name in covered_by:
+                name = covered_by[name]
+            return name
+
+        merged = []
+        for job in jobs:
+            if job.runner in covered_by:
+                continue
+            requires = []
+            for key in job.requires:
+                key = key[:2] + (runner_of(key[2]),)
+                if key not in requires:
+                    requires.append(key)
+            job.requires = tuple(requires)
+            merged.append(job)
+        return merged
+
+    def plan(self, pkg_name, version, runners, uri=DEFAULT_URI,
+             force=False):
+        """Plan the jobs that build ``runners`` (names) for the
+        collection, in an order where each job comes after those it
+        requires. Fresh outputs are not rebuilt, unless ``force`` is
+        true. Returns the jobs and the names of the runners found fresh.
+        Raises ValueError for what cannot be planned, see
+        ``_merge_outputs``.
+        """
+        jobs = []
+        fresh = []
+        visited = {}
+
+        def visit(runner, path=()):
+            if runner in path:
+                raise ValueError("Circular requirement: {0}".format(
+                    ' -> '.join(path + (runner,))))
+            if runner in visited:
+                return visited[runner]
+            if runner not in self.contract_of:
+                raise ValueError("Nothing is known of what the {0} runner "
+                                 "requires and produces.".format(runner))
+            requirements = self.requirements(runner)
+            inputs_fresh = all([visit(required, path + (runner,))
+                                for required in requirements])
+            if not force and self.is_fresh(runner, pkg_name, version,
+                                           inputs_fresh):
+                fresh.append(runner)
+                visited[runner] = True
+                return True
+            requires = [(pkg_name, version, required)
+                        for required in requirements
+                        if required not in fresh]
+            jobs.append(Job(pkg_name, version, runner, uri, requires))
+            visited[runner] = False
+            return False
+
+        for runner in runners:
+            visit(runner)
+        return self._merge_outputs(jobs, pkg_name, version), fresh
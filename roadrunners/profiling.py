@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Opt-in profiling of the runner jobs. A profiled job leaves a cProfile
+dump (``.prof``, for ``pstats`` or snakeviz) and a text report of its
+hottest functions, its largest allocations and the CPU time of its
+child processes next to its output.
+
+"""
+import os
+import time
+import random
+import logging
+import cProfile
+import pstats
+import resource
+import functools
+import threading
+from StringIO import StringIO
+
+try:
+    # Part of Python 3.4+, and of the pytracemalloc backport.
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from .command import recording
+from .config import asbool
+from .metrics import current_rss
+
+__all__ = ('should_profile', 'JobProfile', 'profiled',)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOP = 25
+# Frames kept for each traced allocation.
+TRACEMALLOC_FRAMES = 10
+
+# tracemalloc traces the whole process, it is started by the first
+#   profiled job and stopped by the last one.
+_tracing_lock = threading.Lock()
+_tracing_jobs = [0]
+
+
+def should_profile(settings):
+    """Tell whether to profile a job of a runner with these ``settings``.
+
+    Available settings:
+
+    - **profile** - Profile every job. (default: false)
+    - **profile-sample-rate** - Fraction of the jobs to profile, e.g.
+      ``0.01`` for one in a hundred. (default: 0)
+    - **profile-dir** - Directory the profiles are written to.
+      (default: the ``output-dir``)
+    - **profile-top** - Number of functions and allocations in the
+      report. (default: 25)
+
+    """
+    if asbool(settings.get('profile', False)):
+        return True
+    rate = float(settings.get('profile-sample-rate', 0))
+    return rate > 0 and random.random() < rate
+
+
+def _start_tracing():
+    if tracemalloc is None:
+        return
+    with _tracing_lock:
+        if _tracing_jobs[0] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        _tracing_jobs[0] += 1
+
+
+def _stop_tracing():
+    if tracemalloc is None:
+        return
+    with _tracing_lock:
+        _tracing_jobs[0] -= 1
+        if _tracing_jobs[0] == 0:
+            tracemalloc.stop()
+
+
+class JobProfile(object):
+    """Profile of one job, from ``start`` to ``stop``. cProfile only sees
+    the thread it is started in. The allocations and the child process
+    times are those of the whole process, so they include the work of
+    other jobs running at the same time.
+    """
+
+    def __init__(self, runner, job=None, top=DEFAULT_TOP):
+        self.runner = runner
+        self.job = job
+        self.top = top
+        self.profiler = cProfile.Profile()
+        self.duration = None
+        self.status = None
+        self.commands = []
+        self.snapshot = None
+        self._children = None
+        self._rss = None
+
+    def start(self):
+        self._children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._rss = current_rss()
+        self._started = time.time()
+        _start_tracing()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        self.duration = time.time() - self._started
+        if tracemalloc is not None:
+            self.snapshot = tracemalloc.take_snapshot()
+        _stop_tracing()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.children_user = children.ru_utime - self._children.ru_utime
+        self.children_system = children.ru_stime - self._children.ru_stime
+        # ru_maxrss of the children is their largest, in kilobytes.
+        self.children_max_rss = children.ru_maxrss * 1024
+        self.rss_growth = current_rss() - self._rss
+
+    def format_report(self):
+        lines = ["Profile of the {0} job {1}: {2}, {3:.3f}s.".format(
+                     self.runner, self.job, self.status, self.duration),
+                 "",
+                 "Child processes: {0:.3f}s user, {1:.3f}s system, "
+                 "largest {2} bytes resident.".format(
+                     self.children_user, self.children_system,
+                     self.children_max_rss),
+                 ]
+        for command in self.commands:
+            lines.append("  {0}: {1:.3f}s CPU, {2} bytes peak "
+                         "resident.".format(command.description,
+                                            command.cpu_time,
+                                            command.peak_rss))
+        lines.extend(["", "Top functions by cumulative time:"])
+        stream = StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        lines.append(stream.getvalue().strip('\n'))
+        lines.extend(["", "Top allocations:"])
+        if self.snapshot is None:
+            lines.append("  tracemalloc is not available, the resident "
+                         "memory grew by {0} bytes.".format(self.rss_growth))
+        else:
+            for stat in self.snapshot.statistics('traceback')[:self.top]:
+                lines.append("  {0} bytes in {1} blocks".format(stat.size,
+                                                               stat.count))
+                lines.extend('    ' + line
+                             for line in stat.traceback.format())
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory, basename):
+        """Write the ``.prof`` dump and the ``.profile.txt`` report to
+        ``directory``. Returns their paths.
+        """
+        prof_path = os.path.join(directory, basename + '.prof')
+        report_path = os.path.join(directory, basename + '.profile.txt')
+        self.profiler.dump_stats(prof_path)
+        with open(report_path, 'w') as f:
+            f.write(self.format_report())
+        return prof_path, report_path
+
+
+def _job_name(build_request):
+    try:
+        return '{0}-{1}'.format(build_request.get_package(),
+                                build_request.get_version())
+    except Exception:
+        return 'job-{0}'.format(int(time.time()))
+
+
+def profiled(runner):
+    """Decorate a runner function (``build_request, settings``) so that
+    its jobs are profiled when the settings ask for it, see
+    ``should_profile``.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(build_request, settings={}):
+            if not should_profile(settings):
+                return func(build_request, settings)
+            job = _job_name(build_request)
+            profile = JobProfile(runner, job,
+                                 int(settings.get('profile-top',
+                                                  DEFAULT_TOP)))
+            profile.start()
+            try:
+                with recording() as commands:
+                    result = func(build_request, settings)
+                profile.status = 'ok'
+                return result
+            except Exception as exc:
+                profile.status = type(exc).__name__.lower()
+                raise
+            finally:
+                profile.stop()
+                profile.commands = commands
+                directory = settings.get('profile-dir',
+                                         settings['output-dir'])
+                basename = '{0}.{1}'.format(job, runner)
+                try:
+                    paths = profile.write(directory, basename)
+                    logger.info("Profile of the {0} job {1} written to "
+                                "'{2}'.".format(runner, job, paths[0]))
+                except (IOError, OSError):
+                    # A profile is no reason to fail a job.
+                    logger.exception("Failed to write the profile.")
+        return wrapper
+    return decorator
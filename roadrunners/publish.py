@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Publishing of build results into the output directory.
+
+Files are made visible under their final name with an atomic rename, so
+readers of the output directory never see a partially written file.
+
+"""
+import os
+import uuid
+import errno
+import fcntl
+import shutil
+import logging
+
+__all__ = ('publish',)
+
+logger = logging.getLogger(__name__)
+
+# The Linux ioctl to share the data blocks of one file with another.
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _temporary_path(directory, filename):
+    return os.path.join(directory,
+                        '.{0}.{1}.tmp'.format(filename, uuid.uuid4().hex))
+
+
+def _reflink(source, destination):
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, destination)
+
+
+def _copy(source, destination):
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+            dst.flush()
+            os.fsync(dst.fileno())
+    shutil.copystat(source, destination)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def publish(filepath, directory, filename=None, keep=False):
+    """Put the file at ``filepath`` in ``directory`` as ``filename``
+    (defaults to the file's own name) and return its new path.
+
+    The file is moved, unless ``keep`` is true. A move is a plain rename
+    when both are on the same filesystem. Otherwise, or when keeping the
+    original, the cheapest of a reflink, a hard link and a streamed copy
+    is made under a temporary name, which is then renamed into place.
+
+    """
+    if filename is None:
+        filename = os.path.basename(filepath)
+    target = os.path.join(directory, filename)
+
+    if not keep:
+        try:
+            os.rename(filepath, target)
+            logger.debug("Moved '{0}' to '{1}'.".format(filepath, target))
+            return target
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+
+    methods = [('reflinked', _reflink), ('copied', _copy)]
+    if keep:
+        # A hard link shares more than the data, so it is only of use
+        #   when the original is kept around unmodified.
+        methods.insert(1, ('linked', os.link))
+    tmp_path = _temporary_path(directory, filename)
+    try:
+        for i, (description, method) in enumerate(methods):
+            try:
+                method(filepath, tmp_path)
+                break
+            except (IOError, OSError):
+                _remove(tmp_path)
+                if i == len(methods) - 1:
+                    raise
+        os.rename(tmp_path, target)
+    except:
+        _remove(tmp_path)
+        raise
+    if not keep:
+        os.remove(filepath)
+    logger.debug("Published '{0}' to '{1}' ({2}).".format(
+        filepath, target, description))
+    return target
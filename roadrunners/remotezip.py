@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Read access to zip files on the repository without downloading them.
+
+Only the central directory and the members that are asked for are
+transferred, using HTTP Range requests.
+
+"""
+import os
+import re
+import fnmatch
+import zipfile
+from collections import OrderedDict
+
+from .sessions import get_session
+from .utils import logger, if_range_header, response_validators
+
+__all__ = ('RemoteFile', 'RangeNotSupported', 'RemoteFileChanged',
+           'open_remote_zip', 'extract_remote_members',)
+
+# Size of the pieces the remote file is fetched and cached in.
+DEFAULT_BLOCK_SIZE = 256 * 1024
+# Number of blocks kept in memory.
+DEFAULT_MAX_BLOCKS = 64
+_CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+class RangeNotSupported(Exception):
+    """Raised when the server does not answer range requests."""
+
+
+class RemoteFileChanged(Exception):
+    """Raised when the remote file changed while it was being read,
+    e.g. a new ``latest`` version was published.
+    """
+
+
+class RemoteFile(object):
+    """A read-only, seekable file-like object over an HTTP resource.
+
+    Data is fetched in ``block_size`` blocks using Range requests and the
+    most recently used ``max_blocks`` blocks are kept in memory.
+    Contiguous missing blocks are fetched with a single request. The
+    blocks are pinned to the version of the resource found on opening it
+    (``If-Range``), ``RemoteFileChanged`` is raised when it changes.
+
+    """
+
+    def __init__(self, url, session, block_size=DEFAULT_BLOCK_SIZE,
+                 max_blocks=DEFAULT_MAX_BLOCKS, **kwargs):
+        self.session = session
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.request_kwargs = kwargs
+        self.position = 0
+        self.closed = False
+        self._blocks = OrderedDict()
+        # Counters, useful to see how much was actually transferred.
+        self.bytes_fetched = 0
+        self.requests = 0
+
+        response = session.head(url, allow_redirects=True, **kwargs)
+        if response.status_code != 200:
+            raise RuntimeError("Could not access file at '{0}' with "
+                               "response ({1}).".format(url,
+                                                        response.status_code))
+        if response.headers.get('Accept-Ranges', 'none') != 'bytes':
+            raise RangeNotSupported(url)
+        # Talk to where we were redirected to, rather than follow the
+        #   redirect on each read.
+        self.url = response.url
+        self.size = int(response.headers['Content-Length'])
+        self.if_range = if_range_header(response_validators(response))
+
+    def _fetch(self, first_block, last_block):
+        start = first_block * self.block_size
+        end = min((last_block + 1) * self.block_size, self.size) - 1
+        headers = {'Range': 'bytes={0}-{1}'.format(start, end)}
+        if self.if_range is not None:
+            headers['If-Range'] = self.if_range
+        response = self.session.get(self.url, headers=headers,
+                                    **self.request_kwargs)
+        self.requests += 1
+        if response.status_code == 200 and self.if_range is not None:
+            # The whole of a different version.
+            raise RemoteFileChanged(self.url)
+        if response.status_code != 206:
+            raise RangeNotSupported("Response ({0}) to a range request on "
+                                    "'{1}'.".format(response.status_code,
+                                                    self.url))
+        data = response.content
+        self._check_range(response, start, end, data)
+        self.bytes_fetched += len(data)
+        blocks = []
+        for i in range(first_block, last_block + 1):
+            offset = (i - first_block) * self.block_size
+            blocks.append(data[offset:offset + self.block_size])
+            self._store(i, blocks[-1])
+        return blocks
+
+    def _check_range(self, response, start, end, data):
+        """Make sure a partial ``response`` holds the bytes ``start`` to
+        ``end`` of the file as it was opened.
+        """
+        match = _CONTENT_RANGE.match(
+            response.headers.get('Content-Range', '').strip())
+        if match is None:
+            raise RangeNotSupported("No Content-Range in the response to "
+                                    "a range request on '{0}'.".format(
+                                        self.url))
+        first, last, total = match.groups()
+        if total != '*' and int(total) != self.size:
+            raise RemoteFileChanged(self.url)
+        if (int(first), int(last)) != (start, end) \
+           or len(data) != end - start + 1:
+            raise RangeNotSupported(
+                "Bytes {0}-{1} ({2} bytes) in the response to a request "
+                "for {3}-{4} of '{5}'.".format(first, last, len(data),
+                                               start, end, self.url))
+
+    def _store(self, index, data):
+        self._blocks.pop(index, None)
+        self._blocks[index] = data
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+    def _block(self, index):
+        data = self._blocks.pop(index)
+        # Move to the most recently used end.
+        self._blocks[index] = data
+        return data
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = max(0, min(size, self.size - self.position))
+        if size == 0:
+            return b''
+        first = self.position // self.block_size
+        last = (self.position + size - 1) // self.block_size
+        # Use the cached blocks and fetch each run of missing blocks
+        #   with a single request.
+        chunks = []
+        i = first
+        while i <= last:
+            if i in self._blocks:
+                chunks.append(self._block(i))
+                i += 1
+                continue
+            run_end = i
+            while run_end < last and run_end + 1 not in self._blocks:
+                run_end += 1
+            chunks.extend(self._fetch(i, run_end))
+            i = run_end + 1
+        data = b''.join(chunks)
+        offset = self.position - first * self.block_size
+        data = data[offset:offset + size]
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self.position + offset
+        elif whence == os.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence ({0}).".format(whence))
+        if position < 0:
+            raise IOError("Negative seek position {0}.".format(position))
+        self.position = position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.closed = True
+        self._blocks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_remote_zip(pkg_name, version, base_uri, zipname='complete',
+                    settings={}):
+    """Open a completezip or offlinezip on the repository as a
+    ``zipfile.ZipFile`` without downloading it. Members are fetched as
+    they are read.
+
+    Raises ``RangeNotSupported`` when the repository can not serve
+    parts of the file, in which case the caller should fall back to
+    ``roadrunners.utils.get_zip``.
+
+    Available settings:
+
+    - **remote-zip-block-size** - Size of the blocks fetched and cached.
+      (default: 262144)
+    - **remote-zip-max-blocks** - Number of blocks cached in memory.
+      (default: 64)
+
+    """
+    url = '{0}/content/{1}/{2}/{3}'.format(base_uri.rstrip('/'), pkg_name,
+                                           version, zipname)
+    block_size = int(settings.get('remote-zip-block-size',
+                                  DEFAULT_BLOCK_SIZE))
+    max_blocks = int(settings.get('remote-zip-max-blocks',
+                                  DEFAULT_MAX_BLOCKS))
+    remote_file = RemoteFile(url, get_session(base_uri, settings),
+                             block_size=block_size, max_blocks=max_blocks)
+    logger.debug("Opened remote zip '{0}' ({1} bytes).".format(
+        remote_file.url, remote_file.size))
+    return zipfile.ZipFile(remote_file)
+
+
+def extract_remote_members(pkg_name, version, base_uri, working_dir,
+                           patterns, zipname='complete', settings={}):
+    """Unpack only the members matching the glob ``patterns`` of a
+    repository zip into ``working_dir``, transferring only those
+    members. Returns the manifest of top level entries, like
+    ``roadrunners.utils.unpack_zip``.
+    """
+    remote_zip = open_remote_zip(pkg_name, version, base_uri, zipname,
+                                 settings)
+    remote_file = remote_zip.fp
+    try:
+        names = [name for name in remote_zip.namelist()
+                 if any(fnmatch.fnmatch(name, p) for p in patterns)]
+        manifest = []
+        for name in names:
+            top_level = name.split('/', 1)[0]
+            if top_level not in manifest:
+                manifest.append(top_level)
+            if name.endswith('/'):
+                continue
+            remote_zip.extract(name, working_dir)
+        logger.debug("Fetched {0} bytes in {1} request(s) for {2} "
+                     "member(s).".format(remote_file.bytes_fetched,
+                                         remote_file.requests, len(names)))
+    finally:
+        remote_zip.close()
+        remote_file.close()
+    return manifest
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Retention of the artifacts in the runners' output directories: keep the
+last versions of each collection and format, drop what is too old and
+evict the least recently used artifacts to stay under a size quota.
+
+A sweep removes a limited number of artifacts at a time, so it can run
+beside the workers, e.g. ``python -m roadrunners.retention config.ini
+--interval 600``. Artifacts used or published within the grace period
+are never removed, and neither are those being read by a job that holds
+them ``in_use``.
+
+"""
+import os
+import sys
+import time
+import errno
+import fcntl
+import logging
+import contextlib
+
+from .cache import get_cache
+from .config import assize
+from .index import get_index, parse_filename, version_key
+from .manifest import MANIFEST_SUFFIX
+from .utils import VALIDATORS_SUFFIX
+
+__all__ = ('Artifact', 'RetentionPolicy', 'collect', 'in_use',
+           'remove_artifact', 'sweep', 'get_policy', 'sweep_runners',)
+
+logger = logging.getLogger(__name__)
+
+# Seconds an artifact is left alone after it was last used.
+DEFAULT_GRACE = 60 * 60
+# Artifacts removed by a single sweep.
+DEFAULT_BATCH = 100
+DAY = 24 * 60 * 60
+# Files kept next to an artifact, named after it.
+SIDECAR_SUFFIXES = (MANIFEST_SUFFIX, VALIDATORS_SUFFIX,)
+# Files the profiled jobs leave, named ``<id>-<version>.<runner><suffix>``.
+PROFILE_SUFFIXES = ('.prof', '.profile.txt',)
+
+
+class Artifact(object):
+    """An artifact file of a runner's output directory."""
+
+    def __init__(self, path, pkg_name, version, format, stat):
+        self.path = path
+        self.pkg_name = pkg_name
+        self.version = version
+        self.format = format
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        # Not all filesystems record the access time, a publish counts
+        #   as a use.
+        self.last_used = max(stat.st_atime, stat.st_mtime)
+
+    def __repr__(self):
+        return '<Artifact {0}>'.format(self.path)
+
+
+def collect(directory):
+    """The artifacts in ``directory``."""
+    artifacts = []
+    for filename in os.listdir(directory):
+        parsed = parse_filename(filename)
+        if parsed is None or filename.startswith('.'):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            artifacts.append(Artifact(path, *parsed, stat=os.stat(path)))
+        except OSError:
+            # Removed underneath us.
+            continue
+    return artifacts
+
+
+class RetentionPolicy(object):
+    """Which artifacts to remove: all but the ``keep_versions`` newest
+    versions of each collection and format, those older than
+    ``max_age`` seconds and, least recently used first, those beyond a
+    total of ``max_size`` bytes. Artifacts used within ``grace``
+    seconds are kept regardless.
+    """
+
+    def __init__(self, keep_versions=None, max_age=None, max_size=None,
+                 grace=DEFAULT_GRACE):
+        self.keep_versions = keep_versions
+        self.max_age = max_age
+        self.max_size = max_size
+        self.grace = grace
+
+    def select(self, artifacts, now=None):
+        """The (artifact, reason) pairs to remove of ``artifacts``, in
+        the order to remove them.
+        """
+        if now is None:
+            now = time.time()
+        removable = [a for a in artifacts
+                     if a.last_used < now - self.grace]
+        removable_paths = set(a.path for a in removable)
+        selected = []
+        chosen = set()
+
+        def choose(artifact, reason):
+            if artifact.path not in chosen:
+                chosen.add(artifact.path)
+                selected.append((artifact, reason))
+
+        if self.keep_versions is not None:
+            groups = {}
+            for artifact in artifacts:
+                key = (artifact.pkg_name, artifact.format)
+                groups.setdefault(key, []).append(artifact)
+            for group in groups.values():
+                group.sort(key=lambda a: version_key(a.version),
+                           reverse=True)
+                for artifact in group[self.keep_versions:]:
+                    if artifact.path in removable_paths:
+                        choose(artifact, 'versions')
+        if self.max_age is not None:
+            for artifact in removable:
+                if artifact.mtime < now - self.max_age:
+                    choose(artifact, 'age')
+        if self.max_size is not None:
+            total = sum(a.size for a in artifacts
+                        if a.path not in chosen)
+            for artifact in sorted(removable, key=lambda a: a.last_used):
+                if total <= self.max_size:
+                    break
+                if artifact.path not in chosen:
+                    choose(artifact, 'quota')
+                    total -= artifact.size
+        return selected
+
+
+@contextlib.contextmanager
+def in_use(path):
+    """Keep the artifact at ``path`` from being removed for the duration
+    of the context. Raises IOError when it is gone.
+    """
+    with open(path, 'rb') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        # It could have been removed while we waited for the lock.
+        try:
+            current = os.stat(path).st_ino
+        except OSError:
+            current = None
+        if os.fstat(f.fileno()).st_ino != current:
+            raise IOError(errno.ENOENT, "Removed while waiting", path)
+        yield
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def _remove_profiles(path, profile_dir=None):
+    """Remove the job profiles of the collection version of the artifact
+    at ``path`` once none of its artifacts are left.
+    """
+    directory, filename = os.path.split(path)
+    pkg_name, version = parse_filename(filename)[:2]
+    for artifact in collect(directory):
+        if (artifact.pkg_name, artifact.version) == (pkg_name, version):
+            return
+    profile_dir = profile_dir or directory
+    prefix = '{0}-{1}.'.format(pkg_name, version)
+    try:
+        filenames = os.listdir(profile_dir)
+    except OSError:
+        return
+    for filename in filenames:
+        if not filename.startswith(prefix):
+            continue
+        rest = filename[len(prefix):]
+        for suffix in PROFILE_SUFFIXES:
+            # The runner name, not a longer version, e.g. 1.1.2.
+            if rest.endswith(suffix) and '.' not in rest[:-len(suffix)]:
+                _remove(os.path.join(profile_dir, filename))
+
+
+def remove_artifact(path, index=None, profile_dir=None):
+    """Remove the artifact at ``path``, the files kept next to it (its
+    manifest and download validators) and its ``index`` entry, unless
+    it is in use. The job profiles of its collection version (in
+    ``profile_dir``, by default its directory) go with the last artifact
+    of that version. Returns whether it was removed.
+    """
+    try:
+        # Opened for writing, NFS only grants exclusive locks then.
+        fd = os.open(path, os.O_RDWR)
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            return False
+        if exc.errno in (errno.EACCES, errno.EPERM, errno.EROFS):
+            logger.warning("Cannot remove '{0}': {1}".format(
+                path, exc.strerror))
+            return False
+        raise
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as exc:
+            if exc.errno in (errno.EAGAIN, errno.EACCES):
+                logger.debug("'{0}' is in use.".format(path))
+                return False
+            raise
+        # It could have been republished (renamed over) since it was
+        #   opened, the new artifact is not the one to remove.
+        try:
+            current = os.stat(path).st_ino
+        except OSError:
+            current = None
+        if os.fstat(fd).st_ino != current:
+            logger.debug("'{0}' was replaced.".format(path))
+            return False
+        os.remove(path)
+    finally:
+        os.close(fd)
+    for suffix in SIDECAR_SUFFIXES:
+        _remove(path + suffix)
+    _remove_profiles(path, profile_dir)
+    if index is not None:
+        index.remove(path)
+    return True
+
+
+def _remove_stale_temporaries(directory, now, grace):
+    """Remove the temporary files (``.<name>.<uuid>.tmp``) left by
+    publishes that never finished.
+    """
+    for filename in os.listdir(directory):
+        if not (filename.startswith('.') and filename.endswith('.tmp')):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            if os.stat(path).st_mtime < now - grace:
+                os.remove(path)
+                logger.info("Removed the stale '{0}'.".format(path))
+        except OSError:
+            continue
+
+
+def sweep(directory, policy, batch=DEFAULT_BATCH, index=None,
+          dry_run=False, now=None, profile_dir=None):
+    """Remove up to ``batch`` of the artifacts in ``directory`` the
+    ``policy`` selects, see ``remove_artifact``. Returns the (path,
+    reason, size) of those removed, or of those that would be when
+    ``dry_run`` is true.
+    """
+    if now is None:
+        now = time.time()
+    removed = []
+    for artifact, reason in policy.select(collect(directory), now):
+        if len(removed) >= batch:
+            break
+        if dry_run:
+            removed.append((artifact.path, reason, artifact.size))
+        elif remove_artifact(artifact.path, index, profile_dir):
+            removed.append((artifact.path, reason, artifact.size))
+            logger.info("Removed '{0}' ({1}).".format(artifact.path, reason))
+    if not dry_run:
+        _remove_stale_temporaries(directory, now, policy.grace)
+    return removed
+
+
+def get_policy(settings):
+    """Return the retention policy configured in the runner
+    ``settings``, None when nothing is to be removed.
+
+    Available settings:
+
+    - **retention-keep-versions** - Number of versions of each
+      collection and format to keep.
+    - **retention-max-age** - Days after which an artifact is removed.
+    - **retention-max-size** - Size quota of the output directory, e.g.
+      ``500G``. The least recently used artifacts are removed first.
+    - **retention-grace** - Seconds an artifact is kept after it was
+      last used or published. (default: 3600)
+
+    """
+    def get(key, convert):
+        value = settings.get(key, None)
+        return value is not None and convert(value) or None
+
+    keep_versions = get('retention-keep-versions', int)
+    max_age = get('retention-max-age', lambda x: float(x) * DAY)
+    max_size = get('retention-max-size', assize)
+    if keep_versions is None and max_age is None and max_size is None:
+        return None
+    return RetentionPolicy(keep_versions, max_age, max_size,
+                           float(settings.get('retention-grace',
+                                              DEFAULT_GRACE)))
+
+
+def sweep_runners(runner_settings, batch=DEFAULT_BATCH, dry_run=False):
+    """Sweep the output directory of each runner (``[runner:<name>]``
+    settings by name) that has a retention policy, once per directory,
+    and evict its artifact cache down to its ``cache-max-size``.
+    Returns the removed (path, reason, size) tuples.
+    """
+    removed = []
+    swept = set()
+    for name, settings in sorted(runner_settings.items()):
+        cache = get_cache(settings)
+        if cache is not None and not dry_run:
+            freed = cache.evict()
+            if freed:
+                logger.info("Evicted {0} bytes from the cache of "
+                            "{1}.".format(freed, name))
+        policy = get_policy(settings)
+        directory = settings.get('output-dir')
+        if policy is None or not directory or directory in swept:
+            continue
+        swept.add(directory)
+        removed.extend(sweep(directory, policy, batch - len(removed),
+                             get_index(settings), dry_run,
+                             profile_dir=settings.get('profile-dir')))
+    return removed
+
+
+def main(argv=None):
+    import argparse
+    from ConfigParser import RawConfigParser
+    parser = argparse.ArgumentParser(
+        description="Remove the artifacts the runners' retention "
+                    "policies no longer keep")
+    parser.add_argument('config', help="configuration (ini) file")
+    parser.add_argument('runners', nargs='*',
+                        help="runner names (default: all)")
+    parser.add_argument('--batch', type=int, default=DEFAULT_BATCH,
+                        help="artifacts to remove per sweep")
+    parser.add_argument('--interval', type=float,
+                        help="keep sweeping, every so many seconds")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="only list what would be removed")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    config = RawConfigParser()
+    config.read(args.config)
+    runner_settings = {}
+    for section in config.sections():
+        if section.startswith('runner:'):
+            name = section[len('runner:'):]
+            if not args.runners or name in args.runners:
+                runner_settings[name] = dict(config.items(section))
+
+    while True:
+        removed = sweep_runners(runner_settings, args.batch, args.dry_run)
+        if args.dry_run:
+            for path, reason, size in removed:
+                print('{0} {1} {2}'.format(path, reason, size))
+        if args.interval is None:
+            return 0
+        # A full batch means there is more to do right away.
+        if len(removed) < args.batch:
+            time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Process-wide pool of HTTP sessions used to talk to the repositories.
+
+Each repository host gets one ``requests.Session`` so that connections are
+kept alive and reused across the many jobs a worker handles.
+
+"""
+import os
+import logging
+import threading
+from urlparse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .config import asbool, asfloat_pair
+
+__all__ = ('get_session', 'clear_sessions',)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+# Connect and read timeouts in seconds.
+DEFAULT_TIMEOUT = (10.0, 300.0)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class Session(requests.Session):
+    """A ``requests.Session`` that applies a default timeout."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        super(Session, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(Session, self).request(method, url, **kwargs)
+
+
+def _host_key(base_uri):
+    parts = urlsplit(base_uri)
+    return (parts.scheme.lower(), parts.netloc.lower())
+
+
+def _make_session(settings):
+    pool_connections = int(settings.get('http-pool-connections',
+                                        DEFAULT_POOL_CONNECTIONS))
+    pool_maxsize = int(settings.get('http-pool-maxsize',
+                                    DEFAULT_POOL_MAXSIZE))
+    pool_block = asbool(settings.get('http-pool-block', False))
+    max_retries = int(settings.get('http-max-retries', 0))
+    keep_alive = asbool(settings.get('http-keep-alive', True))
+    timeout = asfloat_pair(settings.get('http-timeout', DEFAULT_TIMEOUT))
+
+    session = Session(timeout=timeout)
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          max_retries=max_retries,
+                          pool_block=pool_block)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_session(base_uri, settings={}):
+    """Return the process-wide session for the host in ``base_uri``,
+    creating it on first use.
+
+    The session is configured from the settings of the runner that first
+    talks to the host. Available settings:
+
+    - **http-pool-connections** - Number of connection pools to cache.
+      (default: 10)
+    - **http-pool-maxsize** - Maximum number of connections kept open to
+      the host. (default: 10)
+    - **http-pool-block** - Block instead of opening connections beyond
+      the maximum, making the maximum a hard per-host limit.
+      (default: false)
+    - **http-max-retries** - Retries for failed connection attempts.
+      (default: 0)
+    - **http-keep-alive** - Reuse connections between requests.
+      (default: true)
+    - **http-timeout** - Timeout in seconds, either a single value or a
+      ``<connect>, <read>`` pair. (default: 10, 300)
+
+    """
+    key = _host_key(base_uri)
+    pid = os.getpid()
+    with _sessions_lock:
+        entry = _sessions.get(key)
+        # Connections can not be shared with a forked child process.
+        if entry is None or entry[0] != pid:
+            logger.debug("Creating HTTP session for '{0}://{1}'.".format(*key))
+            entry = (pid, _make_session(settings))
+            _sessions[key] = entry
+        return entry[1]
+
+
+def clear_sessions():
+    """Close and forget all the sessions in this process."""
+    with _sessions_lock:
+        for pid, session in _sessions.values():
+            if pid == os.getpid():
+                session.close()
+        _sessions.clear()
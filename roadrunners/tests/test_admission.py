@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the admission control of build jobs.
+
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+import coyote
+from .. import admission
+from ..command import run_command
+
+
+class AdmissionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+
+    def make_controller(self, **kwargs):
+        options = {'max_load': 1000, 'min_free_memory': 0,
+                   'max_wait': 0, 'poll_interval': 0.01}
+        options.update(kwargs)
+        return admission.AdmissionController(self.state_dir, **options)
+
+    def test_disabled(self):
+        calls = []
+
+        @admission.admission_controlled('test')
+        def make_thing(build_request, settings={}):
+            calls.append(build_request)
+            return ['result']
+
+        self.assertEqual(make_thing('request', {}), ['result'])
+        self.assertEqual(calls, ['request'])
+
+    def test_admit(self):
+        controller = self.make_controller(default_footprint=1024)
+        with controller.admit('test'):
+            self.assertEqual(controller.stats()['running'], 1)
+            # Allocate and hold some memory for the sampling to see.
+            code = "import time; x = ' ' * 64 * 1024 ** 2; time.sleep(1.5)"
+            result = run_command([sys.executable, '-c', code],
+                                 self.state_dir)
+        stats = controller.stats()
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['admitted'], 1)
+        self.assertTrue(result.peak_rss >= 64 * 1024 ** 2)
+        self.assertEqual(controller.footprint('test'), result.peak_rss)
+        self.assertEqual(controller.footprint('other'), 1024)
+
+    def test_requeue(self):
+        controller = self.make_controller(max_load=0, max_wait=0.05)
+        try:
+            with controller.admit('test'):
+                self.fail("Should not have been admitted.")
+        except coyote.Blocked as exc:
+            self.assertTrue('load per CPU' in str(exc))
+        stats = controller.stats()
+        self.assertEqual(stats['delayed'], 1)
+        self.assertEqual(stats['requeued'], 1)
+        self.assertEqual(stats['admitted'], 0)
+        self.assertEqual(stats['waiting'], 0)
+
+    def test_memory_reserved_by_running_jobs(self):
+        available = admission.available_memory()
+        controller = self.make_controller(default_footprint=available // 2)
+        with controller.admit('test'):
+            admitted, reason = controller.decide('test', available // 2 + 1)
+            self.assertFalse(admitted)
+            self.assertTrue('reserved by running jobs' in reason)
+
+    def test_dead_jobs_are_forgotten(self):
+        controller = self.make_controller()
+        # Assume no process has this (maximum) pid.
+        path = os.path.join(controller.running_dir, '4194304-abc.json')
+        with open(path, 'w') as f:
+            json.dump({'runner': 'test', 'footprint': 1}, f)
+        self.assertEqual(controller.stats()['running'], 0)
+        self.assertFalse(os.path.exists(path))
+
+    def test_footprint_history(self):
+        controller = self.make_controller()
+        controller.record_footprint('test', 1000)
+        controller.record_footprint('test', 2000)
+        self.assertEqual(controller.footprint('test'), 1800)
+        controller.record_footprint('test', 100)
+        self.assertEqual(controller.footprint('test'), 1290)
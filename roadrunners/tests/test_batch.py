@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for running runners in batches.
+
+"""
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import coyote
+from .. import batch
+from .. import legacy
+from ..benchmarks import synthetic
+from ..benchmarks.repository import FakeRepository
+
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def test_limits(self):
+        lock = threading.Lock()
+        running = {}
+        peaks = {}
+
+        def make_thing(build_request, settings={}):
+            host = build_request.transport.uri
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                peaks[host] = max(peaks.get(host, 0), running[host])
+                total = sum(running.values())
+                peaks['total'] = max(peaks.get('total', 0), total)
+            time.sleep(0.05)
+            with lock:
+                running[host] -= 1
+            if build_request.get_package() == 'col3':
+                raise coyote.Failed("Broken.")
+            return [build_request.get_package()]
+
+        items = [('col{0}'.format(i), '1.1') for i in range(8)]
+        items += [('col{0}'.format(i), '1.1', 'http://other.org')
+                  for i in range(8, 12)]
+        settings = {'batch-concurrency': '5', 'batch-per-host': '3'}
+        results = batch.run_batch(make_thing, items, settings,
+                                  'http://cnx.org')
+
+        self.assertEqual([r.pkg_name for r in results],
+                         [item[0] for item in items])
+        self.assertEqual([r.ok for r in results],
+                         [i != 3 for i in range(12)])
+        self.assertEqual(results[0].artifacts, ['col0'])
+        self.assertTrue(isinstance(results[3].error, coyote.Failed))
+        self.assertEqual(peaks['http://cnx.org'], 3)
+        self.assertTrue(peaks['http://other.org'] <= 3)
+        self.assertTrue(peaks['total'] <= 5)
+
+    def test_completezip(self):
+        complete = synthetic.make_zip(
+            os.path.join(self.output_dir, 'source.zip'), 'col10000', '1.1',
+            modules=2, images=1, image_size=1024)
+        settings = {'output-dir': self.output_dir, 'username': 'user1',
+                    'password': 'user1'}
+        items = [('col{0}'.format(i), '1.1') for i in range(4)]
+        with FakeRepository(complete=complete) as repository:
+            results = batch.run_batch(legacy.make_completezip, items,
+                                      settings, repository.uri)
+        self.assertTrue(all(r.ok for r in results))
+        for i, result in enumerate(results):
+            filename = 'col{0}-1.1.complete.zip'.format(i)
+            self.assertEqual(result.artifacts,
+                             [os.path.join(self.output_dir, filename)])
+            self.assertEqual(os.path.getsize(result.artifacts[0]),
+                             os.path.getsize(complete))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the benchmark harness.
+
+"""
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+import requests
+from ..benchmarks import harness, stubs, synthetic
+from ..benchmarks.repository import FakeRepository
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.complete = synthetic.make_zip(
+            os.path.join(self.work_dir, 'complete.zip'), 'col10000', '1.1',
+            modules=3, images=1, image_size=1024)
+
+    def test_make_zip(self):
+        offline = synthetic.make_zip(
+            os.path.join(self.work_dir, 'offline.zip'), 'col10000', '1.1',
+            modules=3, images=2, image_size=1024, zipname='offline')
+        with zipfile.ZipFile(self.complete) as zip_file:
+            names = zip_file.namelist()
+        self.assertIn('col10000_1.1_complete/collection.xml', names)
+        self.assertIn('col10000_1.1_complete/m10002/image0.png', names)
+        self.assertEqual(len(names), 1 + 3 * 2)
+        with zipfile.ZipFile(offline) as zip_file:
+            names = zip_file.namelist()
+        self.assertIn('col10000_1.1_complete/content/collection.xml', names)
+        self.assertIn('col10000_1.1_complete/content/m10000/image1.png',
+                      names)
+
+    def test_repository(self):
+        with FakeRepository(complete=self.complete) as repository:
+            url = '{0}/content/col1/latest/complete'.format(repository.uri)
+            resp = requests.get(url)
+            self.assertEqual(resp.status_code, 200)
+            with open(self.complete, 'rb') as f:
+                self.assertEqual(resp.content, f.read())
+            resp = requests.get(url, headers={
+                'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 304)
+            resp = requests.get('{0}/content/col1/latest/offline'.format(
+                repository.uri))
+            self.assertEqual(resp.status_code, 404)
+        self.assertEqual(repository.requests, 3)
+        self.assertEqual(repository.bytes_sent,
+                         os.path.getsize(self.complete))
+
+    def test_run_runner(self):
+        settings = stubs.install_stubs(os.path.join(self.work_dir, 'stubs'),
+                                       output_size=1024)
+        settings['output-dir'] = os.path.join(self.work_dir, 'output')
+        os.mkdir(settings['output-dir'])
+        with FakeRepository(complete=self.complete) as repository:
+            result = harness.run_runner('epub', repository.uri, settings,
+                                        jobs=2, concurrency=2)
+        self.assertEqual(result['runs'], 2)
+        self.assertEqual(result['failures'], 0)
+        self.assertTrue(result['p50'] > 0)
+        self.assertTrue(result['peak_rss'] > 0)
+        self.assertEqual(sorted(result['phases']),
+                         ['build', 'cleanup', 'fetch', 'manifest', 'publish',
+                          'unpack'])
+        outputs = [name for name in os.listdir(settings['output-dir'])
+                   if name.endswith('.epub')]
+        self.assertEqual(sorted(outputs),
+                         ['col10000-1.1.epub', 'col10001-1.1.epub'])
+
+    def test_compare(self):
+        baseline = {'unpack_zip': {'name': 'unpack_zip', 'failures': 0,
+                                   'p50': 0.1, 'peak_rss': 1000}}
+        result = dict(baseline['unpack_zip'])
+        self.assertEqual(harness.compare([result], baseline), [])
+        result.update(p50=0.2, peak_rss=2000)
+        self.assertEqual(len(harness.compare([result], baseline)), 2)
+        self.assertEqual(harness.compare([result], baseline, tolerance=2),
+                         [])
+        self.assertEqual(harness.compare([result], {}), [])
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(harness.percentile(values, 50), 50)
+        self.assertEqual(harness.percentile(values, 99), 99)
+        self.assertEqual(harness.percentile([3], 90), 3)
+        self.assertEqual(harness.percentile([], 50), None)
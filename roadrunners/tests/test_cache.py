@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the shared artifact cache.
+
+"""
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from .. import cache
+from . import test_data
+
+
+class ArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.key = cache.ArtifactCache.make_key('http://cnx.org', 'col10642',
+                                                '1.2', 'complete')
+
+    def make_file(self, name, size):
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def test_key(self):
+        make_key = cache.ArtifactCache.make_key
+        self.assertEqual(self.key,
+                         make_key('http://CNX.org/', 'col10642', '1.2',
+                                  'complete'))
+        self.assertNotEqual(self.key,
+                            make_key('http://cnx.org', 'col10642', '1.2',
+                                     'offline'))
+
+    def test_store_and_fetch(self):
+        artifact_cache = cache.ArtifactCache(self.cache_dir)
+        self.assertEqual(artifact_cache.lookup(self.key), None)
+        source = test_data('col10642-1.2.complete.zip')
+        artifact_cache.store(self.key, source, id='col10642')
+
+        entry = artifact_cache.get_entry(self.key)
+        self.assertEqual(entry['sha256'], cache.sha256_file(source))
+        self.assertEqual(entry['id'], 'col10642')
+
+        destination = os.path.join(self.work_dir, 'copy.zip')
+        self.assertEqual(artifact_cache.fetch(self.key, destination),
+                         destination)
+        self.assertEqual(cache.sha256_file(destination), entry['sha256'])
+        # Nothing is left behind in the staging area.
+        self.assertEqual(os.listdir(artifact_cache.tmp_dir), [])
+
+    def test_corrupt_content_is_discarded(self):
+        artifact_cache = cache.ArtifactCache(self.cache_dir, verify=True)
+        path = artifact_cache.store(self.key, self.make_file('a.zip', 100))
+        os.chmod(path, 0o644)
+        with open(path, 'r+b') as f:
+            f.write(b'x' * 10)
+        self.assertEqual(artifact_cache.lookup(self.key), None)
+        self.assertEqual(artifact_cache.get_entry(self.key), None)
+        self.assertFalse(os.path.exists(path))
+
+    def test_evicted_during_fetch(self):
+        artifact_cache = cache.ArtifactCache(self.cache_dir)
+        path = artifact_cache.store(self.key, self.make_file('a.zip', 100))
+        lookup = artifact_cache.lookup
+
+        def evicting_lookup(key):
+            # Evicted right after it was looked up.
+            found = lookup(key)
+            artifact_cache.evict(0)
+            return found
+
+        artifact_cache.lookup = evicting_lookup
+        destination = os.path.join(self.work_dir, 'copy.zip')
+        self.assertEqual(artifact_cache.fetch(self.key, destination), None)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(destination))
+        self.assertEqual(artifact_cache.get_entry(self.key), None)
+
+    def test_lru_eviction(self):
+        artifact_cache = cache.ArtifactCache(self.cache_dir, max_size=250)
+        keys = [cache.ArtifactCache.make_key('http://cnx.org', 'col1', str(i),
+                                             'complete')
+                for i in range(3)]
+        paths = []
+        for i, key in enumerate(keys[:2]):
+            paths.append(artifact_cache.store(
+                key, self.make_file('{0}.zip'.format(i), 100)))
+        # Make the first one the least recently used, then use it.
+        now = time.time()
+        os.utime(paths[0], (now - 20, now - 20))
+        os.utime(paths[1], (now - 10, now - 10))
+        artifact_cache.lookup(keys[0])
+
+        artifact_cache.store(keys[2], self.make_file('2.zip', 100))
+        self.assertTrue(artifact_cache.lookup(keys[0]) is not None)
+        self.assertEqual(artifact_cache.lookup(keys[1]), None)
+        self.assertTrue(artifact_cache.lookup(keys[2]) is not None)
+        self.assertEqual(artifact_cache.total_size(), 200)
+
+    def test_lock(self):
+        artifact_cache = cache.ArtifactCache(self.cache_dir)
+        results = []
+        def contender():
+            with artifact_cache.lock(self.key, timeout=0.2) as acquired:
+                results.append(acquired)
+
+        with artifact_cache.lock(self.key) as acquired:
+            self.assertTrue(acquired)
+            thread = threading.Thread(target=contender)
+            thread.start()
+            thread.join()
+        # The contender gave up while the lock was held...
+        self.assertEqual(results, [False])
+        # ... and gets it once it has been released.
+        contender()
+        self.assertEqual(results, [False, True])
+
+    def test_lock_waits_for_holder(self):
+        artifact_cache = cache.ArtifactCache(self.cache_dir)
+        source = self.make_file('a.zip', 100)
+        found = []
+        def waiter():
+            with artifact_cache.lock(self.key):
+                found.append(artifact_cache.lookup(self.key))
+
+        with artifact_cache.lock(self.key):
+            thread = threading.Thread(target=waiter)
+            thread.start()
+            time.sleep(0.1)
+            path = artifact_cache.store(self.key, source)
+        thread.join()
+        self.assertEqual(found, [path])
+
+    def test_get_cache(self):
+        self.assertEqual(cache.get_cache({}), None)
+        artifact_cache = cache.get_cache({'cache-dir': self.cache_dir,
+                                          'cache-max-size': '1M'})
+        self.assertEqual(artifact_cache.max_size, 1024 * 1024)
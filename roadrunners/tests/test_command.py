@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the external command execution.
+
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+from .. import command
+
+
+def process_exists(pid):
+    """Whether the process ``pid`` exists, not counting zombies."""
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            state = f.read().rsplit(')', 1)[1].split()[0]
+    except IOError:
+        return False
+    return state != 'Z'
+
+
+class CommandTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_output(self):
+        settings = {'command-tail-lines': '3'}
+        script = ('for i in $(seq 1 10); do echo out $i; echo err $i >&2; '
+                  'done; exit 2')
+        result = command.run_command(['/bin/sh', '-c', script],
+                                     self.directory, settings, 'job.log')
+        self.assertEqual(result.returncode, 2)
+        self.assertEqual(result.stdout_lines, 10)
+        self.assertEqual(result.stderr_lines, 10)
+        self.assertEqual(result.bytes_read, 2 * (10 * 6 + 1))
+        # Only the tail is kept in memory.
+        self.assertEqual(result.stdout, 'out 8\nout 9\nout 10\n')
+        self.assertEqual(result.stderr, 'err 8\nerr 9\nerr 10\n')
+        message = result.failure_message()
+        self.assertTrue(message.startswith("Command exited with status 2."))
+        self.assertTrue('err 10' in message)
+        self.assertFalse('out 10' in message)
+
+        # The log has all of the output.
+        log_path = os.path.join(self.directory, 'job.log')
+        self.assertTrue(log_path in message)
+        with open(log_path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 20)
+        self.assertTrue('stdout: out 1' in lines)
+        self.assertTrue('stderr: err 10' in lines)
+
+    def test_log_rotation(self):
+        log_dir = os.path.join(self.directory, 'logs')
+        os.mkdir(log_dir)
+        settings = {'command-log-dir': log_dir,
+                    'command-log-max-size': '100',
+                    'command-log-backups': '2',
+                    }
+        script = 'for i in $(seq 1 100); do echo line $i; done'
+        result = command.run_command(script, self.directory, settings,
+                                     'job.log', shell=True)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(sorted(os.listdir(log_dir)),
+                         ['job.log', 'job.log.1', 'job.log.2'])
+        for filename in os.listdir(log_dir):
+            self.assertTrue(
+                os.path.getsize(os.path.join(log_dir, filename)) <= 100)
+        with open(os.path.join(log_dir, 'job.log')) as f:
+            self.assertTrue(f.read().endswith('stdout: line 100\n'))
+
+    def assertKilled(self, pid):
+        deadline = time.time() + 5
+        while process_exists(pid) and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertFalse(process_exists(pid))
+
+    def test_timeout(self):
+        settings = {'command-timeout': '1', 'command-kill-grace': '1'}
+        # The shell starts a child of its own, which must be killed too.
+        started = time.time()
+        result = command.run_command('sleep 30 & echo $!; wait',
+                                     self.directory, settings, shell=True)
+        self.assertTrue(time.time() - started < 10)
+        self.assertEqual(result.termination_reason, 'timeout')
+        self.assertNotEqual(result.returncode, 0)
+        self.assertTrue(result.failure_message().startswith(
+            "Command timed out after 1.0 seconds."))
+        self.assertKilled(int(result.stdout))
+
+    def test_cpu_timeout(self):
+        settings = {'command-cpu-timeout': '0.5'}
+        result = command.run_command('while :; do :; done', self.directory,
+                                     settings, shell=True)
+        self.assertEqual(result.termination_reason, 'cpu-timeout')
+        self.assertNotEqual(result.returncode, 0)
+
+    def test_cancel(self):
+        results = []
+
+        def run():
+            results.append(command.run_command(
+                ['/bin/sh', '-c', 'sleep 30 & echo $!; wait'],
+                self.directory))
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        deadline = time.time() + 5
+        while not command._running and time.time() < deadline:
+            time.sleep(0.05)
+        command.cancel_all()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        result = results[0]
+        self.assertEqual(result.termination_reason, 'cancelled')
+        self.assertEqual(result.failure_message().splitlines()[0],
+                         "Command was cancelled.")
+        self.assertKilled(int(result.stdout))
+
+    def run_python(self, code, settings):
+        return command.run_command([sys.executable, '-c', code],
+                                   self.directory, settings)
+
+    def test_memory_limit(self):
+        settings = {'command-max-memory': '256M'}
+        result = self.run_python("x = ' ' * 512 * 1024 ** 2", settings)
+        self.assertEqual(result.termination_reason, 'memory-limit')
+        self.assertTrue(result.failure_message().startswith(
+            "Command exceeded its memory limit (268435456 bytes)"))
+        self.assertEqual(self.run_python("x = ' ' * 1024 ** 2",
+                                         settings).returncode, 0)
+
+    def test_cpu_time_limit(self):
+        settings = {'command-max-cpu-time': '1'}
+        result = command.run_command('while :; do :; done', self.directory,
+                                     settings, shell=True)
+        self.assertEqual(result.termination_reason, 'cpu-time-limit')
+
+    def test_open_files_limit(self):
+        settings = {'command-max-open-files': '16'}
+        code = "files = [open('/dev/null') for i in range(32)]"
+        result = self.run_python(code, settings)
+        self.assertEqual(result.termination_reason, 'open-files-limit')
+
+    def test_nice(self):
+        settings = {'command-nice': '5'}
+        result = self.run_python("import os; print(os.nice(0))", settings)
+        self.assertEqual(int(result.stdout), os.nice(0) + 5)
+        self.assertEqual(result.termination_reason, None)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the multi-format runner.
+
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import mock
+import coyote
+from .. import composite
+from ..batch import BuildRequest
+from ..benchmarks import stubs, synthetic
+from ..benchmarks.repository import FakeRepository
+
+
+class CompositeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.output_dir = os.path.join(self.work_dir, 'output')
+        os.mkdir(self.output_dir)
+        data_dir = os.path.join(self.work_dir, 'data')
+        os.mkdir(data_dir)
+        options = dict(modules=2, images=1, image_size=1024)
+        self.complete = synthetic.make_zip(
+            os.path.join(data_dir, 'complete.zip'), 'col10000', '1.1',
+            **options)
+        self.offline = synthetic.make_zip(
+            os.path.join(data_dir, 'offline.zip'), 'col10000', '1.1',
+            zipname='offline', **options)
+        self.settings = stubs.install_stubs(
+            os.path.join(self.work_dir, 'stubs'), output_size=1024)
+        self.settings.update({'output-dir': self.output_dir,
+                              'python': sys.executable})
+
+    def test_make_formats(self):
+        workspace_root = os.path.join(self.work_dir, 'workspaces')
+        self.settings['workspace-root'] = workspace_root
+        with FakeRepository(self.complete, self.offline) as repository, \
+                mock.patch.object(composite, '_prefetch',
+                                  wraps=composite._prefetch) as prefetch:
+            request = BuildRequest('col10000', '1.1', repository.uri)
+            artifacts = composite.make_formats(request, self.settings)
+        # The epub is the offlinezip build's.
+        self.assertEqual(artifacts, [
+            os.path.join(self.output_dir, name)
+            for name in ('col10000-1.1.pdf', 'col10000-1.1.offline.zip',
+                         'col10000-1.1.epub')])
+        # Each zip is downloaded once, for all the formats, into a cache
+        #   on the workspace root.
+        self.assertEqual(repository.requests, 2)
+        cache_dir = prefetch.call_args[0][2]['cache-dir']
+        self.assertEqual(os.path.dirname(cache_dir), workspace_root)
+
+    def test_failed_format(self):
+        # Without the stand-in of the pdf build script.
+        os.remove(os.path.join(self.settings['oer.exports-dir'],
+                               'collectiondbk2pdf.py'))
+        self.settings['formats'] = 'epub, pdf'
+        with FakeRepository(self.complete, self.offline) as repository:
+            request = BuildRequest('col10000', '1.1', repository.uri)
+            with self.assertRaises(coyote.Failed) as caught:
+                composite.make_formats(request, self.settings)
+        self.assertIn('pdf: ', str(caught.exception))
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         ['col10000-1.1.epub',
+                          'col10000-1.1.epub.manifest.json', 'logs'])
+        # The log of the failed build outlives its workspace.
+        log_path = os.path.join(self.output_dir, 'logs',
+                                'col10000-1.1.pdf.log')
+        self.assertIn(log_path, str(caught.exception))
+        with open(log_path) as f:
+            self.assertIn('collectiondbk2pdf.py', f.read())
+
+    def test_unknown_format(self):
+        self.settings['formats'] = 'epub, html'
+        request = BuildRequest('col10000', '1.1', 'http://cnx.org')
+        with self.assertRaises(coyote.Failed):
+            composite.make_formats(request, self.settings)
+
+    def test_no_formats(self):
+        self.settings['formats'] = ' , '
+        request = BuildRequest('col10000', '1.1', 'http://cnx.org')
+        self.assertEqual(composite.make_formats(request, self.settings), [])
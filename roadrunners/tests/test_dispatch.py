@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the local dispatcher.
+
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import mock
+import coyote
+from .. import dispatch
+
+
+def make_thing(build_request, settings={}):
+    pkg_name = build_request.get_package()
+    if os.path.exists(os.path.join(settings['output-dir'], 'broken-'
+                                   + pkg_name)):
+        raise coyote.Failed("Broken.")
+    path = os.path.join(settings['output-dir'], pkg_name + '.thing')
+    with open(path, 'w') as f:
+        f.write(build_request.get_version())
+    return [path]
+
+
+def make_derived(build_request, settings={}):
+    """Needs the output of ``make_thing``."""
+    pkg_name = build_request.get_package()
+    source = os.path.join(settings['output-dir'], pkg_name + '.thing')
+    if not os.path.exists(source):
+        raise coyote.Blocked("No thing yet.")
+    path = source + '.derived'
+    shutil.copy(source, path)
+    return [path]
+
+
+def make_crash(build_request, settings={}):
+    """Takes its worker down."""
+    os._exit(1)
+
+
+def make_nothing(build_request, settings={}):
+    """Never done."""
+    time.sleep(60)
+
+
+CONFIG = """\
+[runner:thing]
+runner = python!roadrunners.tests.test_dispatch:make_thing
+output-dir = {0}
+
+[runner:derived]
+runner = python!roadrunners.tests.test_dispatch:make_derived
+output-dir = {0}
+
+[runner:crash]
+runner = python!roadrunners.tests.test_dispatch:make_crash
+
+[runner:nothing]
+runner = python!roadrunners.tests.test_dispatch:make_nothing
+"""
+
+
+class DispatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.config_path = os.path.join(self.work_dir, 'dispatch.ini')
+        with open(self.config_path, 'w') as f:
+            f.write(CONFIG.format(self.work_dir))
+        self.journal_path = os.path.join(self.work_dir, 'journal.jsonl')
+
+    def make_dispatcher(self, jobs, processes=2):
+        return dispatch.Dispatcher(self.config_path, jobs, processes,
+                                   journal_path=self.journal_path,
+                                   retry_delay=0.1, output=StringIO())
+
+    def test_run_and_resume(self):
+        open(os.path.join(self.work_dir, 'broken-col2'), 'w').close()
+        jobs = [dispatch.Job('col{0}'.format(i), '1.1', 'thing')
+                for i in range(4)]
+        dispatcher = self.make_dispatcher(jobs)
+        outcomes = dispatcher.run()
+        self.assertEqual(sorted((o['id'], o['status']) for o in outcomes),
+                         [('col0', 'ok'), ('col1', 'ok'),
+                          ('col2', 'failed'), ('col3', 'ok')])
+        self.assertEqual(dispatcher.output.getvalue().count('\n'), 4)
+        summary = dispatcher.format_summary()
+        self.assertIn('thing: 3 ok, 1 failed', summary)
+        self.assertIn('col2/1.1 thing: Failed: Broken.', summary)
+
+        # Only the failed job runs again.
+        os.remove(os.path.join(self.work_dir, 'broken-col2'))
+        jobs = [dispatch.Job('col{0}'.format(i), '1.1', 'thing')
+                for i in range(4)]
+        dispatcher = self.make_dispatcher(jobs)
+        outcomes = dispatcher.run()
+        self.assertEqual([(o['id'], o['status']) for o in outcomes],
+                         [('col2', 'ok')])
+        self.assertEqual(len(dispatcher.skipped), 3)
+        journal = dispatch.read_journal(self.journal_path)
+        self.assertEqual(journal[('col2', '1.1', 'thing')]['status'], 'ok')
+
+    def test_blocked(self):
+        # The derived job is queued first, it waits for the thing.
+        #   One process runs them in that order.
+        jobs = [dispatch.Job('col1', '1.1', 'derived'),
+                dispatch.Job('col1', '1.1', 'thing')]
+        dispatcher = self.make_dispatcher(jobs, processes=1)
+        outcomes = dispatcher.run()
+        self.assertEqual([(o['runner'], o['status']) for o in outcomes],
+                         [('thing', 'ok'), ('derived', 'ok')])
+        self.assertEqual(outcomes[1]['attempts'], 2)
+        self.assertIn('derived blocked, retrying',
+                      dispatcher.output.getvalue())
+
+    def test_requires(self):
+        open(os.path.join(self.work_dir, 'broken-col1'), 'w').close()
+        thing = dispatch.Job('col1', '1.1', 'thing')
+        derived = dispatch.Job('col1', '1.1', 'derived',
+                               requires=[thing.key])
+        dispatcher = self.make_dispatcher([derived, thing])
+        outcomes = dispatcher.run()
+        self.assertEqual([(o['runner'], o['status']) for o in outcomes],
+                         [('thing', 'failed'), ('derived', 'skipped')])
+        self.assertEqual(outcomes[1]['attempts'], 0)
+        self.assertEqual(outcomes[1]['error'], 'col1/1.1 thing did not build')
+
+    def test_limits(self):
+        jobs = [dispatch.Job('col{0}'.format(i), '1.1', 'thing')
+                for i in range(4)]
+        dispatcher = self.make_dispatcher(jobs)
+        self.assertEqual(dispatcher._next_job({}, 0).pkg_name, 'col0')
+        # One 'thing' at a time by default.
+        self.assertEqual(dispatcher._next_job({'thing': 1}, 1), None)
+        dispatcher.limits = {'thing': 2}
+        self.assertEqual(dispatcher._next_job({'thing': 1}, 1).pkg_name,
+                         'col1')
+        self.assertEqual(dispatcher._next_job({'thing': 1}, 2), None)
+
+    def test_parse_collection(self):
+        uri = dispatch.DEFAULT_URI
+        self.assertEqual(dispatch._parse_collection('col1/1.1', uri),
+                         ['col1', '1.1', uri])
+        self.assertEqual(dispatch._parse_collection('col1 1.1\n', uri),
+                         ['col1', '1.1', uri])
+        self.assertEqual(dispatch._parse_collection(
+            'col1 1.1 http://other.org', uri),
+            ['col1', '1.1', 'http://other.org'])
+        for value in ('col1', 'col1/1.1/x', 'col1 1.1 http://a.org x'):
+            with self.assertRaises(ValueError):
+                dispatch._parse_collection(value, uri)
+
+    def test_main_bad_line(self):
+        with mock.patch.object(sys, 'stderr', StringIO()) as stderr:
+            with self.assertRaises(SystemExit):
+                dispatch.main([self.config_path, 'col1', '-f', 'thing'])
+        self.assertIn("Not a collection: 'col1'", stderr.getvalue())
+
+    def test_lost_workers(self):
+        jobs = [dispatch.Job('col1', '1.1', 'crash'),
+                dispatch.Job('col1', '1.1', 'nothing'),
+                dispatch.Job('col1', '1.1', 'thing')]
+        dispatcher = self.make_dispatcher(jobs)
+        dispatcher.timeouts = {'nothing': 0.5}
+        outcomes = dispatcher.run()
+        statuses = dict((o['runner'], (o['status'], o['error']))
+                        for o in outcomes)
+        self.assertEqual(statuses['thing'], ('ok', None))
+        self.assertEqual(statuses['crash'][0], 'failed')
+        self.assertIn('died', statuses['crash'][1])
+        self.assertEqual(statuses['nothing'],
+                         ('failed', 'Timed out after 0.5s'))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the artifact index.
+
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import mock
+from .. import index
+
+
+def make_artifact(build_request, settings={}):
+    path = os.path.join(settings['output-dir'], '{0}-{1}.epub'.format(
+        build_request.get_package(), build_request.get_version()))
+    with open(path, 'w') as f:
+        f.write('epub')
+    return [path]
+
+
+class IndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        os.mkdir(self.output_dir)
+        self.index_file = os.path.join(self.tmp_dir, 'index.sqlite')
+        self.index = index.ArtifactIndex(self.index_file)
+
+    def write(self, filename, content='data'):
+        path = os.path.join(self.output_dir, filename)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_parse_filename(self):
+        self.assertEqual(index.parse_filename('/x/col1-1.10.complete.zip'),
+                         ('col1', '1.10', 'completezip'))
+        self.assertEqual(index.parse_filename('m1-1.2.xml'),
+                         ('m1', '1.2', 'collxml'))
+        self.assertEqual(index.parse_filename('col1-1.1.epub.manifest.json'),
+                         None)
+        self.assertEqual(index.parse_filename('col1.pdf'), None)
+
+    def test_record_and_query(self):
+        for version in ('1.9', '1.10', '1.2'):
+            self.index.record(self.write('col1-{0}.pdf'.format(version)),
+                              'pdf', 1.5)
+        path = self.write('col1-1.9.epub', 'epub')
+        row = self.index.record(path, 'epub', 2.0)
+        self.assertEqual((row['id'], row['version'], row['format'],
+                          row['size']), ('col1', '1.9', 'epub', 4))
+        self.assertEqual(len(row['sha256']), 64)
+        self.assertEqual(self.index.record(path, 'epub', 0.1)['duration'],
+                         2.0)
+        self.assertEqual(self.index.record(self.write('notes.txt')), None)
+
+        self.assertTrue(self.index.exists('col1', '1.9', 'epub'))
+        self.assertFalse(self.index.exists('col1', '1.10', 'epub'))
+        self.assertEqual(self.index.latest('col1', 'pdf'), '1.10')
+        self.assertEqual(self.index.latest('col2', 'pdf'), None)
+        self.assertEqual([r['version'] for r in self.index.find('col1')],
+                         ['1.10', '1.9', '1.9', '1.2'])
+        self.assertEqual(self.index.report(),
+                         [('epub', 1, 4), ('pdf', 3, 12)])
+
+        os.remove(path)
+        self.assertEqual(self.index.prune(), 1)
+        self.assertFalse(self.index.exists('col1', '1.9', 'epub'))
+
+    def test_indexed(self):
+        runner = index.indexed('epub')(make_artifact)
+        request = mock.Mock()
+        request.get_package.return_value = 'col1'
+        request.get_version.return_value = '1.1'
+        settings = {'output-dir': self.output_dir,
+                    'index-file': self.index_file}
+        runner(request, settings)
+        row = self.index.find('col1', '1.1', 'epub')[0]
+        self.assertEqual(row['runner'], 'epub')
+        self.assertTrue(row['duration'] >= 0)
+        # Indexing is off without an index file.
+        request.get_version.return_value = '1.2'
+        runner(request, {'output-dir': self.output_dir})
+        self.assertFalse(self.index.exists('col1', '1.2', 'epub'))
+
+    def test_main(self):
+        self.write('col1-1.1.epub')
+        self.write('col1-1.2.epub')
+        with mock.patch.object(sys, 'stdout', StringIO()) as stdout:
+            self.assertEqual(index.main([self.index_file, 'scan',
+                                         self.output_dir]), 0)
+            self.assertEqual(index.main([self.index_file, 'latest', 'col1',
+                                         'epub']), 0)
+            self.assertEqual(index.main([self.index_file, 'exists', 'col1',
+                                         '1.3', 'epub']), 1)
+        self.assertEqual(stdout.getvalue().splitlines(),
+                         ['{0}: 2 artifacts'.format(self.output_dir),
+                          '1.2'])
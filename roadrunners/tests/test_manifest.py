@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the build manifests.
+
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from .. import epub, manifest
+from ..batch import BuildRequest
+from ..benchmarks import stubs, synthetic
+from ..benchmarks.repository import FakeRepository
+
+
+def git(directory, *args):
+    subprocess.check_call(('git', '-c', 'user.name=test',
+                           '-c', 'user.email=test@example.com') + args,
+                          cwd=directory, stdout=open(os.devnull, 'w'))
+
+
+class ManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            subprocess.call(['git', '--version'],
+                            stdout=open(os.devnull, 'w'))
+        except OSError:
+            raise unittest.SkipTest("git is not available")
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.addCleanup(manifest._revisions.clear)
+        self.settings = stubs.install_stubs(self.work_dir, output_size=1024)
+        self.toolchain = self.settings['oer.exports-dir']
+        git(self.toolchain, 'init', '-q')
+        git(self.toolchain, 'add', '.')
+        git(self.toolchain, 'commit', '-q', '-m', 'Stubs')
+        self.output_dir = os.path.join(self.work_dir, 'output')
+        os.mkdir(self.output_dir)
+        self.settings.update({'output-dir': self.output_dir,
+                              'python': sys.executable})
+
+    def test_toolchain_revision(self):
+        revision = manifest.toolchain_revision(self.toolchain)
+        self.assertEqual(len(revision), 40)
+        with open(os.path.join(self.toolchain, 'static', 'content.css'),
+                  'w') as f:
+            f.write('body {}')
+        # The revision is remembered for a while.
+        self.assertEqual(manifest.toolchain_revision(self.toolchain),
+                         revision)
+        manifest._revisions.clear()
+        self.assertEqual(manifest.toolchain_revision(self.toolchain),
+                         revision + '+dirty')
+        self.assertEqual(manifest.toolchain_revision(self.output_dir), None)
+
+    def test_is_current(self):
+        input_filepath = os.path.join(self.work_dir, 'input.zip')
+        with open(input_filepath, 'w') as f:
+            f.write('input')
+        output_filepath = os.path.join(self.output_dir, 'col1-1.1.epub')
+        with open(output_filepath, 'w') as f:
+            f.write('output')
+
+        def describe(**settings):
+            return manifest.make_manifest(
+                'epub', dict(self.settings, **settings), ('python',),
+                ('oer.exports-dir',), files={'complete': input_filepath})
+
+        built = describe()
+        self.assertFalse(manifest.is_current(output_filepath, built))
+        manifest.write_manifest(output_filepath, built)
+        self.assertTrue(manifest.is_current(output_filepath, describe()))
+        self.assertFalse(manifest.is_current(output_filepath, built,
+                                             {'force': 'true'}))
+        self.assertFalse(manifest.is_current(output_filepath,
+                                             describe(python='python3')))
+        with open(input_filepath, 'w') as f:
+            f.write('changed')
+        self.assertFalse(manifest.is_current(output_filepath, describe()))
+
+        # Without a known toolchain revision, nothing is current.
+        built = describe(**{'oer.exports-dir': self.output_dir})
+        manifest.write_manifest(output_filepath, built)
+        self.assertFalse(manifest.is_current(output_filepath, built))
+
+    def test_make_epub(self):
+        complete = synthetic.make_zip(
+            os.path.join(self.work_dir, 'complete.zip'), 'col10000', '1.1',
+            modules=2, images=1, image_size=1024)
+        output_filepath = os.path.join(self.output_dir, 'col10000-1.1.epub')
+        with FakeRepository(complete=complete) as repository:
+            request = BuildRequest('col10000', 'latest', repository.uri)
+            self.assertEqual(epub.make_epub(request, self.settings),
+                             [output_filepath])
+            self.assertTrue(os.path.exists(output_filepath
+                                           + manifest.MANIFEST_SUFFIX))
+
+            # Nothing changed, the epub is not built again.
+            os.utime(output_filepath, (0, 0))
+            self.assertEqual(epub.make_epub(request, self.settings),
+                             [output_filepath])
+            self.assertEqual(os.path.getmtime(output_filepath), 0)
+
+            settings = dict(self.settings, force='true')
+            epub.make_epub(request, settings)
+            self.assertNotEqual(os.path.getmtime(output_filepath), 0)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the job metrics.
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+import mock
+import coyote
+from .. import metrics
+from ..command import run_command
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.settings = {
+            'metrics-file': os.path.join(self.tmp_dir, 'metrics.jsonl'),
+            'metrics-prometheus-dir': self.tmp_dir,
+            }
+        self.mock_request = mock.Mock()
+        self.mock_request.get_package.return_value = 'col10642'
+        self.mock_request.get_version.return_value = '1.2'
+
+    def read_lines(self):
+        with open(self.settings['metrics-file']) as f:
+            return [json.loads(line) for line in f]
+
+    def test_phases(self):
+        tmp_dir = self.tmp_dir
+
+        @metrics.instrumented('test')
+        def make_thing(build_request, settings={}):
+            with metrics.phase('fetch') as fetching:
+                fetching.bytes = 1024
+            with metrics.phase('build'):
+                run_command([sys.executable, '-c', 'pass'], tmp_dir)
+            return ['result']
+
+        self.assertEqual(make_thing(self.mock_request, self.settings),
+                         ['result'])
+        self.assertEqual(metrics.current_job(), None)
+
+        lines = self.read_lines()
+        self.assertEqual(len(lines), 1)
+        job = lines[0]
+        self.assertEqual(job['runner'], 'test')
+        self.assertEqual(job['job'], 'col10642/1.2')
+        self.assertEqual(job['status'], 'ok')
+        self.assertEqual([p['name'] for p in job['phases']],
+                         ['fetch', 'build'])
+        fetch, build = job['phases']
+        self.assertEqual(fetch['bytes'], 1024)
+        self.assertEqual(fetch['commands'], 0)
+        self.assertEqual(build['commands'], 1)
+        self.assertTrue(job['peak_rss'] > 0)
+        self.assertTrue(job['duration'] >= build['duration'])
+
+    def test_peak_rss(self):
+        # A spike that is freed before the phase ends still counts.
+        size = 64 * 1024 * 1024
+        with metrics.phase('unpack') as unpacking:
+            started = metrics.current_rss()
+            spike = b'x' * size
+            time.sleep(4 * metrics.SAMPLE_INTERVAL)
+            del spike
+        self.assertTrue(unpacking.peak_rss >= started + size * 0.9)
+        self.assertTrue(metrics.current_rss() < unpacking.peak_rss)
+
+    def test_failed(self):
+        @metrics.instrumented('test')
+        def make_thing(build_request, settings={}):
+            with metrics.phase('build'):
+                raise coyote.Failed("Broken.")
+
+        with self.assertRaises(coyote.Failed):
+            make_thing(self.mock_request, self.settings)
+
+        job = self.read_lines()[0]
+        self.assertEqual(job['status'], 'failed')
+        self.assertTrue(job['phases'][0]['failed'])
+
+    def test_phase_without_job(self):
+        with metrics.phase('build') as measured:
+            pass
+        self.assertEqual(measured.name, 'build')
+        self.assertTrue(measured.duration >= 0)
+
+    def test_prometheus(self):
+        @metrics.instrumented('prometheus-test')
+        def make_thing(build_request, settings={}):
+            with metrics.phase('publish') as publishing:
+                publishing.bytes = 10
+            return []
+
+        make_thing(self.mock_request, self.settings)
+        make_thing(self.mock_request, self.settings)
+
+        # A file left by a process that is gone.
+        stale_path = os.path.join(self.tmp_dir, 'roadrunners-999999999.prom')
+        open(stale_path, 'w').close()
+        metrics.write_prometheus(self.tmp_dir)
+        self.assertFalse(os.path.exists(stale_path))
+
+        path = os.path.join(self.tmp_dir,
+                            'roadrunners-{0}.prom'.format(os.getpid()))
+        with open(path) as f:
+            text = f.read()
+        self.assertIn('# TYPE roadrunners_jobs_total counter\n', text)
+        self.assertIn('roadrunners_jobs_total{runner="prometheus-test",'
+                      'status="ok"} 2.0\n', text)
+        self.assertIn('roadrunners_phase_bytes_total{phase="publish",'
+                      'runner="prometheus-test"} 20.0\n', text)
+
+    def test_format_prometheus(self):
+        samples = [('a_total', 'counter', "An a.", {}, 1),
+                   ('b', 'gauge', "A b.", {'x': 'say "hi"'}, 2.5),
+                   ('b', 'gauge', "A b.", {'x': 'y'}, 3),
+                   ]
+        self.assertEqual(metrics.format_prometheus(samples),
+                         '# HELP a_total An a.\n'
+                         '# TYPE a_total counter\n'
+                         'a_total 1.0\n'
+                         '# HELP b A b.\n'
+                         '# TYPE b gauge\n'
+                         'b{x="say \\"hi\\""} 2.5\n'
+                         'b{x="y"} 3.0\n')
@@ -44,7 +44,7 @@ settings = config_to_dict(config)['runner:pdf']
 
 class PdfTests(unittest.TestCase):
     
-    def mocked_get_offlinezip(self, url, auth=None):
+    def mocked_get_offlinezip(self, url, auth=None, **kwargs):
         # Make sure the url and authorization are good
         url1 = 'http://cnx.org/content/col10642/1.2/'
         url2 = 'http://cnx.org/content/col10642/latest/'
@@ -58,6 +58,8 @@ class PdfTests(unittest.TestCase):
         mock_response.status_code = 200
         with open(test_data('col10642-1.2.offline.zip'), 'rb') as zip_object:
             mock_response.content = zip_object.read()
+        mock_response.headers = {}
+        mock_response.iter_content.return_value = [mock_response.content]
         return mock_response
         
         
@@ -77,11 +79,11 @@ class PdfTests(unittest.TestCase):
         self.mock_request.transport.uri = "http://cnx.org"
         self.mock_request.job.packageinstance.package.version = "1.2"
         
-        def mock_popen(command, stdout, stderr, cwd):
+        def mock_popen(command, stdout, stderr, cwd, **kwargs):
             # don't want to do anything with the uzip command
             if (command[0] == 'unzip'):
                 PdfTests.patcher.stop()
-                process = subprocess.Popen(command, stdout=stdout, stderr=stderr, cwd=cwd)
+                process = subprocess.Popen(command, stdout=stdout, stderr=stderr, cwd=cwd, **kwargs)
                 PdfTests.patcher.start()
                 return process
             # the pdf building command
@@ -89,11 +91,11 @@ class PdfTests(unittest.TestCase):
             command.insert(8, '-t')
             command.insert(9, self.test_output)
             PdfTests.patcher.stop()
-            process = subprocess.Popen(command, stdout=stdout, stderr=stderr, cwd=cwd)
+            process = subprocess.Popen(command, stdout=stdout, stderr=stderr, cwd=cwd, **kwargs)
             PdfTests.patcher.start()
             return process
             
-        PdfTests.patcher = mock.patch('roadrunners.pdf.subprocess.Popen', mock_popen)
+        PdfTests.patcher = mock.patch('roadrunners.command.subprocess.Popen', mock_popen)
         PdfTests.patcher.start()
         self.addCleanup(PdfTests.patcher.stop)
     
@@ -124,7 +126,7 @@ class PdfTests(unittest.TestCase):
     @unittest.skipIf(not os.path.exists(settings['oer.exports-dir']), 'need oer.exports')
     def test_make_pdf(self):
         
-        with mock.patch('roadrunners.utils.requests.get', self.mocked_get_offlinezip):
+        with mock.patch('roadrunners.sessions.Session.get', side_effect=self.mocked_get_offlinezip):
             output_path = pdf.make_pdf(self.mock_request, settings)
         self.assertEquals(os.path.join(self.test_output, 'col10642-1.2.pdf'), output_path[0])
         self.assertEquals(len(output_path), 1)
@@ -145,7 +147,7 @@ class PdfTests(unittest.TestCase):
         self.mock_request.get_version.return_value = "latest"
         self.mock_request.job.packageinstance.package.version = "latest"
 
-        with mock.patch('roadrunners.utils.requests.get', self.mocked_get_offlinezip):
+        with mock.patch('roadrunners.sessions.Session.get', side_effect=self.mocked_get_offlinezip):
             output_path = pdf.make_pdf(self.mock_request, settings)
         self.assertEquals(os.path.join(self.test_output, 'col10642-1.2.pdf'), output_path[0])
         self.assertEquals(len(output_path), 1)
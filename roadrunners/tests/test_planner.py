@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the build planner.
+
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+from .. import pdf
+from ..batch import BuildRequest
+from ..benchmarks import stubs, synthetic
+from ..benchmarks.repository import FakeRepository
+from ..planner import Planner
+
+
+class PlannerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        runners = {
+            'completezip': 'roadrunners.legacy:make_completezip',
+            'offlinezip': 'roadrunners.legacy:make_offlinezip',
+            'epub': 'roadrunners.epub:make_epub',
+            'pdf': 'roadrunners.pdf:make_pdf',
+            }
+        self.runner_settings = dict(
+            (name, {'runner': 'python!' + spec,
+                    'output-dir': self.output_dir})
+            for name, spec in runners.items())
+        self.planner = Planner(self.runner_settings)
+
+    def touch(self, filename, age=0):
+        path = os.path.join(self.output_dir, filename)
+        open(path, 'w').close()
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def describe(self, jobs):
+        return [(job.runner, [key[2] for key in job.requires])
+                for job in jobs]
+
+    def test_plan(self):
+        jobs, fresh = self.planner.plan('col1', '1.1', ['pdf', 'epub'])
+        # The offlinezip job publishes the epub.
+        self.assertEqual(self.describe(jobs), [
+            ('completezip', []),
+            ('offlinezip', ['completezip']),
+            ('pdf', ['offlinezip']),
+            ])
+        self.assertEqual(fresh, [])
+        self.assertEqual(jobs[2].key, ('col1', '1.1', 'pdf'))
+        jobs, fresh = self.planner.plan('col1', '1.1', ['epub'])
+        self.assertEqual(self.describe(jobs), [('completezip', []),
+                                               ('epub', ['completezip'])])
+
+    def test_same_outputs(self):
+        self.runner_settings['print'] = {
+            'runner': 'python!roadrunners.legacy:make_print',
+            'output-dir': self.output_dir}
+        planner = Planner(self.runner_settings)
+        self.assertEqual(len(planner.plan('col1', '1.1', ['print'])[0]), 1)
+        with self.assertRaises(ValueError) as caught:
+            planner.plan('col1', '1.1', ['pdf', 'print'])
+        self.assertIn('col1-1.1.pdf', str(caught.exception))
+        # Not when they publish to different directories.
+        self.runner_settings['print']['output-dir'] = os.path.join(
+            self.output_dir, 'print')
+        self.assertEqual(len(planner.plan('col1', '1.1',
+                                          ['pdf', 'print'])[0]), 4)
+
+    def test_fresh(self):
+        self.touch('col1-1.1.complete.zip', age=30)
+        self.touch('col1-1.1.offline.zip', age=20)
+        self.touch('col1-1.1.epub', age=20)
+        jobs, fresh = self.planner.plan('col1', '1.1', ['pdf'])
+        self.assertEqual(self.describe(jobs), [('pdf', [])])
+        self.assertEqual(fresh, ['completezip', 'offlinezip'])
+
+        # A newer input makes the outputs built from it stale.
+        self.touch('col1-1.1.complete.zip', age=10)
+        jobs, fresh = self.planner.plan('col1', '1.1', ['pdf'])
+        self.assertEqual(self.describe(jobs), [('offlinezip', []),
+                                               ('pdf', ['offlinezip'])])
+        self.assertEqual(fresh, ['completezip'])
+
+        jobs, fresh = self.planner.plan('col1', '1.1', ['pdf'], force=True)
+        self.assertEqual(len(jobs), 3)
+        jobs, fresh = self.planner.plan('col1', 'latest', ['pdf'])
+        self.assertEqual(len(jobs), 3)
+
+    def test_unknown(self):
+        del self.runner_settings['completezip']
+        planner = Planner(self.runner_settings)
+        with self.assertRaises(ValueError):
+            planner.plan('col1', '1.1', ['epub'])
+        with self.assertRaises(ValueError):
+            planner.plan('col1', '1.1', ['html'])
+
+    def test_pdf_from_output_dir(self):
+        # The pdf runner uses the offlinezip in the output directory,
+        #   the repository has none to offer.
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        synthetic.make_zip(
+            os.path.join(self.output_dir, 'col10000-1.1.offline.zip'),
+            'col10000', '1.1', modules=2, images=1, image_size=1024,
+            zipname='offline')
+        settings = stubs.install_stubs(work_dir, output_size=1024)
+        settings.update({'output-dir': self.output_dir,
+                         'python': sys.executable})
+        with FakeRepository() as repository:
+            request = BuildRequest('col10000', '1.1', repository.uri)
+            artifacts = pdf.make_pdf(request, settings)
+        self.assertEqual(artifacts, [os.path.join(self.output_dir,
+                                                  'col10000-1.1.pdf')])
+        self.assertEqual(repository.requests, 0)
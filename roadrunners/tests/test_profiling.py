@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the opt-in profiling of jobs.
+
+"""
+import os
+import sys
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import mock
+import coyote
+from .. import profiling
+from ..command import run_command
+
+
+class ProfilingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.mock_request = mock.Mock()
+        self.mock_request.get_package.return_value = 'col10642'
+        self.mock_request.get_version.return_value = '1.2'
+
+    def test_should_profile(self):
+        self.assertFalse(profiling.should_profile({}))
+        self.assertTrue(profiling.should_profile({'profile': 'true'}))
+        settings = {'profile-sample-rate': '0.1'}
+        with mock.patch('random.random', return_value=0.05):
+            self.assertTrue(profiling.should_profile(settings))
+        with mock.patch('random.random', return_value=0.5):
+            self.assertFalse(profiling.should_profile(settings))
+
+    def test_not_profiled(self):
+        @profiling.profiled('test')
+        def make_thing(build_request, settings={}):
+            return ['result']
+
+        settings = {'output-dir': self.output_dir}
+        self.assertEqual(make_thing(self.mock_request, settings),
+                         ['result'])
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_profiled(self):
+        output_dir = self.output_dir
+
+        @profiling.profiled('test')
+        def make_thing(build_request, settings={}):
+            code = "sum(i * i for i in range(10 ** 6))"
+            run_command([sys.executable, '-c', code], output_dir)
+            return ['result']
+
+        settings = {'output-dir': output_dir, 'profile': 'true'}
+        self.assertEqual(make_thing(self.mock_request, settings),
+                         ['result'])
+        self.assertEqual(sorted(os.listdir(output_dir)),
+                         ['col10642-1.2.test.prof',
+                          'col10642-1.2.test.profile.txt'])
+        stats = pstats.Stats(os.path.join(output_dir,
+                                          'col10642-1.2.test.prof'))
+        self.assertTrue(stats.total_calls > 0)
+        with open(os.path.join(output_dir,
+                               'col10642-1.2.test.profile.txt')) as f:
+            report = f.read()
+        self.assertIn("Profile of the test job col10642-1.2: ok", report)
+        self.assertIn("Child processes: ", report)
+        self.assertIn("-c sum(i * i for i in range(10 ** 6)): ", report)
+        self.assertIn("Top functions by cumulative time:", report)
+        self.assertIn("Top allocations:", report)
+
+    def test_failed(self):
+        profile_dir = os.path.join(self.output_dir, 'profiles')
+        os.mkdir(profile_dir)
+
+        @profiling.profiled('test')
+        def make_thing(build_request, settings={}):
+            raise coyote.Failed("Broken.")
+
+        settings = {'output-dir': self.output_dir, 'profile': 'true',
+                    'profile-dir': profile_dir}
+        with self.assertRaises(coyote.Failed):
+            make_thing(self.mock_request, settings)
+        with open(os.path.join(profile_dir,
+                               'col10642-1.2.test.profile.txt')) as f:
+            self.assertIn("col10642-1.2: failed", f.read())
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for publishing results into the output directory.
+
+"""
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from .. import publish
+
+
+class PublishTests(unittest.TestCase):
+
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.build_dir)
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.filepath = os.path.join(self.build_dir, 'col10642-1.2.pdf')
+        with open(self.filepath, 'wb') as f:
+            f.write(b'%PDF' * 1000)
+
+    def read(self, filepath):
+        with open(filepath, 'rb') as f:
+            return f.read()
+
+    def test_move(self):
+        target = publish.publish(self.filepath, self.output_dir)
+        self.assertEqual(target, os.path.join(self.output_dir,
+                                              'col10642-1.2.pdf'))
+        self.assertFalse(os.path.exists(self.filepath))
+        self.assertEqual(self.read(target), b'%PDF' * 1000)
+
+    def test_rename(self):
+        publish.publish(self.filepath, self.output_dir, 'other.pdf')
+        self.assertEqual(os.listdir(self.output_dir), ['other.pdf'])
+
+    def test_keep(self):
+        target = publish.publish(self.filepath, self.output_dir, keep=True)
+        self.assertTrue(os.path.exists(self.filepath))
+        self.assertEqual(self.read(target), b'%PDF' * 1000)
+        self.assertEqual(os.listdir(self.output_dir), ['col10642-1.2.pdf'])
+
+    def test_move_across_filesystems(self):
+        real_rename = os.rename
+        def rename(source, destination):
+            # Refuse the direct move, as between filesystems.
+            if source == self.filepath:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            return real_rename(source, destination)
+        with mock.patch('roadrunners.publish.os.rename', rename):
+            target = publish.publish(self.filepath, self.output_dir)
+        self.assertFalse(os.path.exists(self.filepath))
+        self.assertEqual(self.read(target), b'%PDF' * 1000)
+        # No temporary files are left behind.
+        self.assertEqual(os.listdir(self.output_dir), ['col10642-1.2.pdf'])
+
+    def test_failed_copy_leaves_nothing(self):
+        def fail(source, destination):
+            open(destination, 'wb').close()
+            raise IOError(errno.ENOSPC, 'No space left on device')
+        with mock.patch('roadrunners.publish._reflink', fail):
+            with mock.patch('roadrunners.publish._copy', fail):
+                with mock.patch('roadrunners.publish.os.link', fail):
+                    self.assertRaises(IOError, publish.publish,
+                                      self.filepath, self.output_dir,
+                                      keep=True)
+        self.assertEqual(os.listdir(self.output_dir), [])
+        self.assertTrue(os.path.exists(self.filepath))
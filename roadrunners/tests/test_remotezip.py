@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for reading repository zips over range requests.
+
+"""
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from .. import remotezip
+from . import test_data
+
+
+class FakeRepository(object):
+    """Serves a file and honors range requests, like the repository."""
+
+    def __init__(self, filepath, accept_ranges=True):
+        with open(filepath, 'rb') as f:
+            self.content = f.read()
+        self.accept_ranges = accept_ranges
+        self.etag = '"v1"'
+        self.ranges = []
+
+    def head(self, url, **kwargs):
+        response = mock.Mock()
+        response.status_code = 200
+        response.url = url
+        response.headers = {'Content-Length': str(len(self.content)),
+                            'ETag': self.etag}
+        if self.accept_ranges:
+            response.headers['Accept-Ranges'] = 'bytes'
+        return response
+
+    def get(self, url, headers={}, **kwargs):
+        start, end = re.match(r'bytes=(\d+)-(\d+)',
+                              headers['Range']).groups()
+        start, end = int(start), int(end)
+        self.ranges.append((start, end))
+        response = mock.Mock()
+        if headers.get('If-Range') != self.etag:
+            response.status_code = 200
+            response.content = self.content
+            return response
+        response.status_code = 206
+        response.content = self.content[start:end + 1]
+        response.headers = {'Content-Range': 'bytes {0}-{1}/{2}'.format(
+            start, start + len(response.content) - 1, len(self.content))}
+        return response
+
+
+class RemoteZipTests(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.repository = FakeRepository(
+            test_data('col10642-1.2.offline.zip'))
+        patcher = mock.patch('roadrunners.remotezip.get_session',
+                             return_value=self.repository)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_remote_file(self):
+        content = self.repository.content
+        remote_file = remotezip.RemoteFile('http://cnx.org/x', self.repository,
+                                           block_size=1000, max_blocks=2)
+        remote_file.seek(-10, os.SEEK_END)
+        self.assertEqual(remote_file.read(), content[-10:])
+        remote_file.seek(1500)
+        self.assertEqual(remote_file.read(3000), content[1500:4500])
+        self.assertEqual(remote_file.tell(), 4500)
+        # Contiguous blocks are fetched in one go.
+        self.assertEqual(self.repository.ranges[-1], (1000, 4999))
+        # Cached blocks are not fetched again.
+        requests = remote_file.requests
+        remote_file.seek(4200)
+        self.assertEqual(remote_file.read(10), content[4200:4210])
+        self.assertEqual(remote_file.requests, requests)
+
+    def test_open_remote_zip(self):
+        remote_zip = remotezip.open_remote_zip('col10642', '1.2',
+                                               'http://cnx.org', 'offline')
+        self.assertTrue('col10642_1.2_complete/content/collection.xml'
+                        in remote_zip.namelist())
+        collxml = remote_zip.read(
+            'col10642_1.2_complete/content/collection.xml')
+        self.assertTrue(b'<col:collection' in collxml)
+        self.assertTrue(remote_zip.fp.bytes_fetched
+                        < len(self.repository.content))
+
+    def test_extract_remote_members(self):
+        manifest = remotezip.extract_remote_members(
+            'col10642', '1.2', 'http://cnx.org', self.test_dir,
+            ['*/collection.xml'], zipname='offline')
+        self.assertEqual(manifest, ['col10642_1.2_complete'])
+        self.assertEqual(
+            os.listdir(os.path.join(self.test_dir, 'col10642_1.2_complete',
+                                    'content')),
+            ['collection.xml'])
+
+    def test_range_not_supported(self):
+        self.repository.accept_ranges = False
+        self.assertRaises(remotezip.RangeNotSupported,
+                          remotezip.open_remote_zip, 'col10642', '1.2',
+                          'http://cnx.org', 'offline')
+
+    def test_changed(self):
+        remote_file = remotezip.RemoteFile('http://cnx.org/x', self.repository,
+                                           block_size=1000)
+        self.assertEqual(remote_file.read(10), self.repository.content[:10])
+        self.assertEqual(remote_file.if_range, '"v1"')
+        # A new version is published between the reads.
+        self.repository.etag = '"v2"'
+        remote_file.seek(5000)
+        self.assertRaises(remotezip.RemoteFileChanged, remote_file.read, 10)
+
+    def test_wrong_range(self):
+        remote_file = remotezip.RemoteFile('http://cnx.org/x', self.repository,
+                                           block_size=1000)
+        get = self.repository.get
+
+        def shifted(url, headers={}, **kwargs):
+            response = get(url, headers, **kwargs)
+            response.headers['Content-Range'] = 'bytes 1-1000/{0}'.format(
+                remote_file.size)
+            return response
+
+        with mock.patch.object(self.repository, 'get', shifted):
+            self.assertRaises(remotezip.RangeNotSupported,
+                              remote_file.read, 10)
+        self.assertEqual(remote_file._blocks, {})
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the output directory retention.
+
+"""
+import os
+import time
+import errno
+import shutil
+import tempfile
+import unittest
+
+import mock
+from .. import retention
+from ..index import ArtifactIndex
+from ..manifest import MANIFEST_SUFFIX
+from ..utils import VALIDATORS_SUFFIX
+
+DAY = 24 * 60 * 60
+
+
+class RetentionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.now = time.time()
+
+    def write(self, filename, size=10, age=0, used=None):
+        """Write an artifact built ``age`` days ago, last used ``used``
+        days ago.
+        """
+        path = os.path.join(self.output_dir, filename)
+        with open(path, 'w') as f:
+            f.write('x' * size)
+        mtime = self.now - age * DAY
+        atime = used is None and mtime or self.now - used * DAY
+        os.utime(path, (atime, mtime))
+        return path
+
+    def remaining(self):
+        return sorted(os.listdir(self.output_dir))
+
+    def test_keep_versions(self):
+        for version in ('1.1', '1.2', '1.9', '1.10'):
+            self.write('col1-{0}.pdf'.format(version), age=1)
+            self.write('col1-{0}.epub'.format(version), age=1)
+        self.write('col2-1.1.pdf', age=1)
+        # Published just now, kept whatever the policy.
+        self.write('col3-1.1.pdf')
+        self.write('col3-1.2.pdf')
+        policy = retention.RetentionPolicy(keep_versions=1)
+        removed = retention.sweep(self.output_dir, policy, now=self.now)
+        self.assertEqual(len(removed), 6)
+        self.assertEqual(set(reason for path, reason, size in removed),
+                         set(['versions']))
+        self.assertEqual(self.remaining(), [
+            'col1-1.10.epub', 'col1-1.10.pdf', 'col2-1.1.pdf',
+            'col3-1.1.pdf', 'col3-1.2.pdf'])
+
+    def test_max_age_and_quota(self):
+        old = self.write('col1-1.1.complete.zip', age=40)
+        with open(old + MANIFEST_SUFFIX, 'w') as f:
+            f.write('{}')
+        self.write('col2-1.1.offline.zip', size=100, age=10, used=5)
+        self.write('col3-1.1.offline.zip', size=100, age=10, used=2)
+        self.write('col4-1.1.xml', size=100, age=10, used=3)
+        self.write('notes.txt', size=1000, age=100)
+        self.write('.col5-1.1.pdf.0123.tmp', age=1)
+        policy = retention.RetentionPolicy(max_age=30 * DAY, max_size=150)
+        removed = retention.sweep(self.output_dir, policy, now=self.now,
+                                  dry_run=True)
+        self.assertEqual([(os.path.basename(path), reason)
+                          for path, reason, size in removed],
+                         [('col1-1.1.complete.zip', 'age'),
+                          ('col2-1.1.offline.zip', 'quota'),
+                          ('col4-1.1.xml', 'quota')])
+        self.assertEqual(len(self.remaining()), 7)
+
+        # One at a time.
+        removed = retention.sweep(self.output_dir, policy, batch=1,
+                                  now=self.now)
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(self.remaining(), [
+            'col2-1.1.offline.zip', 'col3-1.1.offline.zip', 'col4-1.1.xml',
+            'notes.txt'])
+
+    def test_sidecars(self):
+        old = self.write('col1-1.1.pdf', age=10)
+        self.write('col1-1.1.pdf' + VALIDATORS_SUFFIX, age=10)
+        self.write('col1-1.1.epub', age=10)
+        for filename in ('col1-1.1.pdf.prof', 'col1-1.1.pdf.profile.txt',
+                         'col1-1.1.epub.prof', 'col1-1.1.2.pdf.prof'):
+            self.write(filename, age=10)
+        self.assertTrue(retention.remove_artifact(old))
+        # The epub of the version still has its profile.
+        self.assertEqual(self.remaining(), [
+            'col1-1.1.2.pdf.prof', 'col1-1.1.epub', 'col1-1.1.epub.prof',
+            'col1-1.1.pdf.prof', 'col1-1.1.pdf.profile.txt'])
+        self.assertTrue(retention.remove_artifact(
+            os.path.join(self.output_dir, 'col1-1.1.epub')))
+        self.assertEqual(self.remaining(), ['col1-1.1.2.pdf.prof'])
+
+    def test_replaced_or_read_only(self):
+        path = self.write('col1-1.1.pdf', age=10)
+        replacement = self.write('.col1-1.1.pdf.0123.tmp')
+        stat = os.stat
+
+        def republish(path):
+            # The artifact is republished as the sweep locks it.
+            os.rename(replacement, path)
+            return stat(path)
+
+        with mock.patch.object(retention.os, 'stat', republish):
+            self.assertFalse(retention.remove_artifact(path))
+        self.assertEqual(self.remaining(), ['col1-1.1.pdf'])
+
+        os.chmod(path, 0o444)
+        with mock.patch.object(retention.os, 'open',
+                               side_effect=OSError(errno.EROFS,
+                                                   'Read-only')):
+            self.assertFalse(retention.remove_artifact(path))
+        self.assertEqual(self.remaining(), ['col1-1.1.pdf'])
+
+    def test_in_use(self):
+        path = self.write('col1-1.1.pdf', age=10)
+        index = ArtifactIndex(os.path.join(self.output_dir, 'index.sqlite'))
+        index.record(path)
+        # Hashing it for the index was a use.
+        os.utime(path, (self.now - 10 * DAY, self.now - 10 * DAY))
+        policy = retention.RetentionPolicy(max_age=DAY)
+        with retention.in_use(path):
+            self.assertEqual(retention.sweep(self.output_dir, policy,
+                                             index=index, now=self.now), [])
+        self.assertEqual(len(retention.sweep(self.output_dir, policy,
+                                             index=index, now=self.now)), 1)
+        self.assertFalse(index.exists('col1', '1.1', 'pdf'))
+        with self.assertRaises(IOError):
+            with retention.in_use(path):
+                pass
+
+    def test_get_policy(self):
+        self.assertEqual(retention.get_policy({'output-dir': '/tmp'}), None)
+        policy = retention.get_policy({'retention-keep-versions': '3',
+                                       'retention-max-age': '7',
+                                       'retention-max-size': '2G'})
+        self.assertEqual((policy.keep_versions, policy.max_age,
+                          policy.max_size, policy.grace),
+                         (3, 7 * DAY, 2 * 1024 ** 3, 3600))
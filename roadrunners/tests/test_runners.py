@@ -43,7 +43,7 @@ settings = config_to_dict(config)
 
 class RoadrunnerTests(unittest.TestCase):
     # Mock utils get_completezip so that necessary files are returned
-    def mocked_get_completezip(self, url, auth=None):
+    def mocked_get_completezip(self, url, auth=None, **kwargs):
         # Make sure the url and authorization are good
         url1 = 'http://cnx.org/content/col10642/1.2/'
         url2 = 'http://cnx.org/content/col10642/latest/'
@@ -57,6 +57,8 @@ class RoadrunnerTests(unittest.TestCase):
         mock_response.status_code = 200
         with open(test_data('col10642-1.2.complete.zip'), 'rb') as zip_object:
             mock_response.content = zip_object.read()
+        mock_response.headers = {}
+        mock_response.iter_content.return_value = [mock_response.content]
         return mock_response
     
     def setUp(self):
@@ -70,7 +72,7 @@ class RoadrunnerTests(unittest.TestCase):
         self.mock_request.transport.uri = "http://cnx.org"
         self.mock_request.job.packageinstance.package.version = "1.2"
         
-        def mocked_get(url, auth=None):
+        def mocked_get(url, auth=None, **kwargs):
             # Make sure the url and authorization are good
             self.assertTrue('http://cnx.org/content/col10642/1.2/' in url)
             if auth:
@@ -88,8 +90,10 @@ class RoadrunnerTests(unittest.TestCase):
             else:
                 with open(test_data('test_zip.zip'), 'rb') as zip_object:
                     mock_response.content = zip_object.read()
+            mock_response.headers = {}
+            mock_response.iter_content.return_value = [mock_response.content]
             return mock_response
-        get_patcher = mock.patch('roadrunners.legacy.requests.get', mocked_get)
+        get_patcher = mock.patch('roadrunners.sessions.Session.get', side_effect=mocked_get)
         get_patcher.start()
         self.addCleanup(get_patcher.stop)
     
@@ -105,6 +109,33 @@ class RoadrunnerTests(unittest.TestCase):
         self.assertEquals(os.path.join(self.test_output, 'col10642-1.2.xml'), output_path[0])
         self.assertEquals(len(output_path), 1)
         
+    def test_make_collxml_not_modified(self):
+        loc_settings = settings['runner:xml']
+        loc_settings['output-dir'] = self.test_output
+        output_filepath = os.path.join(self.test_output, 'col10642-1.2.xml')
+
+        requested_headers = []
+        def mocked_get(url, headers={}, **kwargs):
+            requested_headers.append(headers)
+            mock_response = mock.Mock()
+            if headers.get('If-None-Match') == '"v1"':
+                mock_response.status_code = 304
+                return mock_response
+            mock_response.status_code = 200
+            mock_response.headers = {'ETag': '"v1"'}
+            mock_response.content = b'<collection/>'
+            mock_response.iter_content.return_value = [mock_response.content]
+            return mock_response
+        with mock.patch('roadrunners.sessions.Session.get', side_effect=mocked_get):
+            legacy.make_collxml(self.mock_request, loc_settings)
+            output_path = legacy.make_collxml(self.mock_request, loc_settings)
+
+        self.assertEqual(output_path, [output_filepath])
+        self.assertEqual(requested_headers[0], {})
+        self.assertEqual(requested_headers[1], {'If-None-Match': '"v1"'})
+        with open(output_filepath, 'rb') as f:
+            self.assertEqual(f.read(), b'<collection/>')
+
     def test_completezip(self):
         loc_settings = settings['runner:completezip']
         loc_settings['output-dir'] = self.test_output
@@ -153,7 +184,7 @@ class RoadrunnerTests(unittest.TestCase):
         loc_settings['output-dir'] = self.test_output
         
         # get the completezip and put it where its supposed to be
-        with mock.patch('roadrunners.utils.requests.get', self.mocked_get_completezip):
+        with mock.patch('roadrunners.sessions.Session.get', side_effect=self.mocked_get_completezip):
             utils.get_completezip("col10642", "1.2", "http://cnx.org", self.test_output, unpack=False)
         
         path_list = legacy.make_offlinezip(self.mock_request, loc_settings)
@@ -168,7 +199,7 @@ class RoadrunnerTests(unittest.TestCase):
         loc_settings = settings['runner:offlinezip']
         loc_settings['output-dir'] = self.test_output
         
-        with mock.patch('roadrunners.utils.requests.get', self.mocked_get_completezip):
+        with mock.patch('roadrunners.sessions.Session.get', side_effect=self.mocked_get_completezip):
             path_list = legacy.make_offlinezip(self.mock_request, loc_settings)
         self.assertEquals(len(path_list), 2)
         self.assertTrue(os.path.join(self.test_output, 'col10642-1.2.epub') in path_list)
@@ -181,7 +212,7 @@ class RoadrunnerTests(unittest.TestCase):
         loc_settings = settings['runner:epub']
         loc_settings['output-dir'] = self.test_output
         
-        with mock.patch('roadrunners.utils.requests.get', self.mocked_get_completezip):
+        with mock.patch('roadrunners.sessions.Session.get', side_effect=self.mocked_get_completezip):
             output_path = epub.make_epub(self.mock_request, loc_settings)
         self.assertEquals(os.path.join(self.test_output, 'col10642-1.2.epub'), output_path[0])
         self.assertEquals(len(output_path), 1)
@@ -197,7 +228,7 @@ class RoadrunnerTests(unittest.TestCase):
         self.mock_request.get_version.return_value = "latest"
         self.mock_request.job.packageinstance.package.version = "latest"
         
-        with mock.patch('roadrunners.utils.requests.get', self.mocked_get_completezip):
+        with mock.patch('roadrunners.sessions.Session.get', side_effect=self.mocked_get_completezip):
             output_path = epub.make_epub(self.mock_request, loc_settings)
         self.assertEquals(os.path.join(self.test_output, 'col10642-1.2.epub'), output_path[0])
         self.assertEquals(len(output_path), 1)
\ No newline at end of file
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the pooled repository sessions.
+
+"""
+import unittest
+
+from .. import sessions
+
+
+class SessionRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        sessions.clear_sessions()
+
+    def tearDown(self):
+        sessions.clear_sessions()
+
+    def test_one_session_per_host(self):
+        session = sessions.get_session('http://cnx.org:80')
+        self.assertTrue(session is sessions.get_session('http://CNX.org:80/'))
+        self.assertFalse(session is sessions.get_session('http://legacy.cnx.org'))
+
+    def test_settings(self):
+        settings = {'http-pool-maxsize': '4',
+                    'http-pool-block': 'true',
+                    'http-max-retries': '2',
+                    'http-keep-alive': 'false',
+                    'http-timeout': '5, 60',
+                    }
+        session = sessions.get_session('http://cnx.org', settings)
+        self.assertEqual(session.timeout, (5.0, 60.0))
+        self.assertEqual(session.headers['Connection'], 'close')
+        adapter = session.get_adapter('http://cnx.org/content')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertTrue(adapter._pool_block)
+        self.assertEqual(adapter.max_retries.total, 2)
+
+    def test_default_timeout_applied(self):
+        session = sessions.get_session('http://cnx.org', {'http-timeout': '7'})
+        captured = {}
+        def send(request, **kwargs):
+            captured.update(kwargs)
+            raise RuntimeError('stop')
+        session.send = send
+        self.assertRaises(RuntimeError, session.get, 'http://cnx.org/content')
+        self.assertEqual(captured['timeout'], 7.0)
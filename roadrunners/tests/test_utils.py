@@ -13,7 +13,9 @@ import os
 import tempfile
 import shutil
 import unittest
+import zipfile
 
+import requests
 from .. import utils
 from . import test_data
 try:
@@ -27,14 +29,16 @@ class RoadrunnerUtilTests(unittest.TestCase):
         # Create a temporary directory to work in
         self.test_dir = tempfile.mkdtemp()
         # Overwrite requests.get in utils for the tests
-        def mocked_get(url, auth=None):
+        def mocked_get(url, auth=None, **kwargs):
             self.assertTrue('http://cnx.org/content/col10642/1.2/' in url)
             mock_response = mock.Mock()
             mock_response.status_code = 200
             with open(test_data("test_zip.zip"), 'rb') as file_object:
                 mock_response.content = file_object.read()
+            mock_response.headers = {}
+            mock_response.iter_content.return_value = [mock_response.content]
             return mock_response
-        self.get_patcher = mock.patch('roadrunners.legacy.requests.get', mocked_get)
+        self.get_patcher = mock.patch('roadrunners.sessions.Session.get', side_effect=mocked_get)
         self.get_patcher.start()
         self.addCleanup(self.get_patcher.stop)
     
@@ -65,11 +69,215 @@ class RoadrunnerUtilTests(unittest.TestCase):
         unpacked_file = utils.unpack_zip(test_data("test_zip.zip"), self.test_dir)
         self.verify_unpack(unpacked_file)
     
+    def test_unpack_zip_duplicate_members(self):
+        unpacked_file = utils.unpack_zip(test_data("col10642-1.2.complete.zip"),
+                                         self.test_dir, workers=3)
+        self.assertEqual(unpacked_file, ['col10642_1.2_complete'])
+        contents = os.listdir(os.path.join(self.test_dir,
+                                           'col10642_1.2_complete'))
+        self.assertTrue('collection.xml' in contents)
+
+    def test_unpack_zip_selective(self):
+        unpacked_file = utils.unpack_zip(test_data("test_zip.zip"),
+                                         self.test_dir, patterns=['*.txt'])
+        self.assertEqual(unpacked_file, ['test_zip'])
+        directory_listing = os.listdir(os.path.join(self.test_dir, "test_zip"))
+        self.assertEqual(directory_listing, ['file.txt'])
+
+    def test_unpack_zip_bad_crc(self):
+        zip_filepath = os.path.join(self.test_dir, 'bad.zip')
+        with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_STORED) as zip_file:
+            zip_file.writestr('bad/file.txt', 'original content')
+        with open(zip_filepath, 'rb') as f:
+            data = f.read()
+        with open(zip_filepath, 'wb') as f:
+            f.write(data.replace(b'original content', b'tampered content'))
+        self.assertRaises(RuntimeError, utils.unpack_zip, 'bad.zip',
+                          self.test_dir)
+
+    def test_unpack_zip_outside_working_dir(self):
+        zip_filepath = os.path.join(self.test_dir, 'evil.zip')
+        with zipfile.ZipFile(zip_filepath, 'w') as zip_file:
+            zip_file.writestr('../evil.txt', 'evil')
+        self.assertRaises(RuntimeError, utils.unpack_zip, 'evil.zip',
+                          self.test_dir)
+
     def test_get_zip_dont_unpack(self):   
         zip = utils.get_zip('col10642', '1.2', 'http://cnx.org', self.test_dir, False)
         self.assertEqual(zip, os.path.join(self.test_dir, 'col10642-1.2.complete.zip'))
         self.assertTrue('col10642-1.2.complete.zip' in os.listdir(self.test_dir))
-    
+
+    def test_download_resume(self):
+        with open(test_data("test_zip.zip"), 'rb') as file_object:
+            content = file_object.read()
+        filepath = os.path.join(self.test_dir, 'col10642-1.2.complete.zip')
+        # Leave a partial file behind, as an interrupted job would.
+        with open(filepath + '.part', 'wb') as f:
+            f.write(content[:1000])
+        utils.save_validators(filepath + '.part', {'etag': '"v1"'})
+
+        requested_headers = []
+        def mocked_get(url, **kwargs):
+            requested_headers.append(kwargs['headers'])
+            mock_response = mock.Mock()
+            mock_response.status_code = 206
+            mock_response.headers = {
+                'Content-Range': 'bytes 1000-{0}/{1}'.format(
+                    len(content) - 1, len(content)),
+                }
+            mock_response.iter_content.return_value = [content[1000:]]
+            return mock_response
+        with mock.patch('roadrunners.utils.requests.get', mocked_get):
+            progress = utils.download('http://cnx.org/content/col10642/1.2/complete',
+                                      filepath)
+
+        self.assertEqual(requested_headers, [{'Range': 'bytes=1000-',
+                                              'If-Range': '"v1"'}])
+        self.assertEqual(progress.received, len(content) - 1000)
+        self.assertEqual(progress.size, len(content))
+        self.assertFalse(os.path.exists(filepath + '.part'))
+        self.assertFalse(os.path.exists(filepath + '.part'
+                                        + utils.VALIDATORS_SUFFIX))
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_download_ignored_range(self):
+        with open(test_data("test_zip.zip"), 'rb') as file_object:
+            content = file_object.read()
+        filepath = os.path.join(self.test_dir, 'col10642-1.2.complete.zip')
+        with open(filepath + '.part', 'wb') as f:
+            f.write(b'garbage')
+
+        def mocked_get(url, **kwargs):
+            # The server ignores the Range header and sends everything.
+            mock_response = mock.Mock()
+            mock_response.status_code = 200
+            mock_response.headers = {'Content-Length': str(len(content))}
+            mock_response.iter_content.return_value = [content[:10],
+                                                       content[10:]]
+            return mock_response
+        with mock.patch('roadrunners.utils.requests.get', mocked_get):
+            progress = utils.download('http://cnx.org/content/col10642/1.2/complete',
+                                      filepath)
+
+        self.assertEqual(progress.size, len(content))
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_download_resume_changed(self):
+        with open(test_data("test_zip.zip"), 'rb') as file_object:
+            content = file_object.read()
+        filepath = os.path.join(self.test_dir, 'col10642-latest.complete.zip')
+        with open(filepath + '.part', 'wb') as f:
+            f.write(b'old version')
+        utils.save_validators(filepath + '.part', {'etag': '"v1"'})
+
+        requested_headers = []
+        def mocked_get(url, **kwargs):
+            requested_headers.append(kwargs['headers'])
+            if len(requested_headers) == 1:
+                raise requests.exceptions.ReadTimeout("Timed out.")
+            # A new version, the If-Range does not match.
+            mock_response = mock.Mock()
+            mock_response.status_code = 200
+            mock_response.headers = {'ETag': '"v2"'}
+            mock_response.iter_content.return_value = [content]
+            return mock_response
+        with mock.patch('roadrunners.utils.requests.get', mocked_get):
+            progress = utils.download('http://cnx.org/content/col10642/latest/complete',
+                                      filepath)
+
+        self.assertEqual(len(requested_headers), 2)
+        self.assertEqual(requested_headers[1]['If-Range'], '"v1"')
+        self.assertEqual(progress.validators, {'etag': '"v2"'})
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_download_part_without_validators(self):
+        with open(test_data("test_zip.zip"), 'rb') as file_object:
+            content = file_object.read()
+        filepath = os.path.join(self.test_dir, 'col10642-1.2.complete.zip')
+        with open(filepath + '.part', 'wb') as f:
+            f.write(content[:1000])
+
+        requested_headers = []
+        def mocked_get(url, **kwargs):
+            requested_headers.append(kwargs['headers'])
+            mock_response = mock.Mock()
+            mock_response.status_code = 200
+            mock_response.headers = {}
+            mock_response.iter_content.return_value = [content]
+            return mock_response
+        with mock.patch('roadrunners.utils.requests.get', mocked_get):
+            utils.download('http://cnx.org/content/col10642/1.2/complete',
+                           filepath)
+
+        # Not knowing what the part is of, it is not resumed.
+        self.assertEqual(requested_headers, [{}])
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_get_zip_cached(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        settings = {'cache-dir': cache_dir}
+        first_dir = os.path.join(self.test_dir, 'first')
+        second_dir = os.path.join(self.test_dir, 'second')
+        os.mkdir(first_dir)
+        os.mkdir(second_dir)
+
+        utils.get_zip('col10642', '1.2', 'http://cnx.org', first_dir,
+                      False, settings=settings)
+        # The second job is fed from the cache.
+        self.get_patcher.stop()
+        with mock.patch('roadrunners.sessions.Session.get') as mocked_get:
+            zip = utils.get_zip('col10642', '1.2', 'http://cnx.org',
+                                second_dir, False, settings=settings)
+            self.assertFalse(mocked_get.called)
+        self.get_patcher.start()
+        self.assertEqual(zip, os.path.join(second_dir,
+                                           'col10642-1.2.complete.zip'))
+        with open(test_data("test_zip.zip"), 'rb') as f:
+            with open(zip, 'rb') as cached:
+                self.assertEqual(cached.read(), f.read())
+
+    def test_get_zip_latest_revalidated(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        settings = {'cache-dir': cache_dir}
+        with open(test_data("col10642-1.2.complete.zip"), 'rb') as f:
+            content = f.read()
+
+        requested_headers = []
+        def mocked_get(url, headers={}, **kwargs):
+            requested_headers.append(headers)
+            mock_response = mock.Mock()
+            if headers.get('If-None-Match') == '"v1"':
+                mock_response.status_code = 304
+                return mock_response
+            mock_response.status_code = 200
+            mock_response.headers = {'ETag': '"v1"'}
+            mock_response.iter_content.return_value = [content]
+            return mock_response
+
+        self.get_patcher.stop()
+        with mock.patch('roadrunners.sessions.Session.get', side_effect=mocked_get):
+            for name in ('first', 'second'):
+                working_dir = os.path.join(self.test_dir, name)
+                os.mkdir(working_dir)
+                utils.get_zip('col10642', 'latest', 'http://cnx.org',
+                              working_dir, False, settings=settings)
+                with open(os.path.join(working_dir,
+                                       'col10642-latest.complete.zip'),
+                          'rb') as f:
+                    self.assertEqual(f.read(), content)
+            # The resolved version is available to other jobs.
+            utils.get_zip('col10642', '1.2', 'http://cnx.org',
+                          working_dir, False, settings=settings)
+        self.get_patcher.start()
+        self.assertEqual(len(requested_headers), 2)
+        self.assertEqual(requested_headers[1], {'If-None-Match': '"v1"'})
+
     def test_get_zip_unpack(self):
         
         # Check correct file was unpacked
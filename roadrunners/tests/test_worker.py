@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the long-lived oer.exports worker.
+
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from .. import worker
+from ..command import Command
+
+SCRIPT = """\
+import os
+import sys
+sys.stdout.write('{0} {1}'.format(os.getpid(), ' '.join(sys.argv[1:])))
+sys.stderr.write(os.getcwd())
+if sys.argv[1:] == ['fail']:
+    raise RuntimeError('failed')
+if sys.argv[1:] == ['sleep']:
+    import time
+    time.sleep(30)
+sys.exit(int(sys.argv[1]))
+"""
+
+
+class WorkerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.script = os.path.join(self.directory, 'script.py')
+        with open(self.script, 'w') as f:
+            f.write(SCRIPT)
+        self.worker = worker.OerExportsWorker(sys.executable, self.directory,
+                                              max_jobs=3, preload=['json'])
+        self.addCleanup(self.worker.close)
+
+    def run_job(self, *args):
+        command = Command([self.script] + list(args), cwd=self.directory)
+        returncode = self.worker.run(command)
+        pid = int(command.stdout.split()[0])
+        return returncode, pid, command.stdout, command.stderr
+
+    def test_import_path(self):
+        # Only the roadrunners package, not its installation directory.
+        directory = worker._import_path()
+        self.assertEqual(os.listdir(directory), ['roadrunners'])
+        self.assertEqual(os.path.realpath(os.path.join(directory,
+                                                       'roadrunners')),
+                         os.path.realpath(os.path.dirname(worker.__file__)))
+
+    def test_run(self):
+        returncode, pid, stdout, stderr = self.run_job('0')
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, '{0} 0'.format(pid))
+        self.assertEqual(os.path.realpath(stderr),
+                         os.path.realpath(self.directory))
+        self.assertNotEqual(pid, os.getpid())
+
+        returncode, second_pid, stdout, stderr = self.run_job('3')
+        self.assertEqual(returncode, 3)
+        # The same process handled both jobs.
+        self.assertEqual(pid, second_pid)
+
+    def test_failure(self):
+        returncode, pid, stdout, stderr = self.run_job('fail')
+        self.assertEqual(returncode, 1)
+        self.assertTrue('RuntimeError: failed' in stderr)
+        # The worker survives a failed job.
+        self.assertEqual(self.run_job('0')[1], pid)
+
+    def test_retire(self):
+        pids = [self.run_job('0')[1] for i in range(4)]
+        self.assertEqual(len(set(pids[:3])), 1)
+        self.assertNotEqual(pids[3], pids[0])
+
+    def test_run_script_without_worker(self):
+        settings = {'python': sys.executable,
+                    'oer.exports-dir': self.directory}
+        self.assertEqual(worker.get_worker(settings), None)
+        command = worker.run_script(self.script, ['2'], self.directory,
+                                    settings)
+        self.assertEqual(command.returncode, 2)
+        self.assertTrue(command.stdout.endswith(' 2'))
+
+    def test_log(self):
+        log_path = os.path.join(self.directory, 'job.log')
+        command = Command([self.script, '0'], cwd=self.directory,
+                          log_path=log_path)
+        self.worker.run(command)
+        self.assertEqual(command.stdout_lines, 1)
+        self.assertEqual(command.stderr_lines, 1)
+        with open(log_path) as f:
+            self.assertEqual(f.read(), 'stdout: {0}stderr: {1}'.format(
+                command.stdout, command.stderr))
+
+    def test_timeout(self):
+        pid = self.run_job('0')[1]
+        command = Command([self.script, 'sleep'], cwd=self.directory,
+                          timeout=1)
+        self.assertNotEqual(self.worker.run(command), 0)
+        self.assertEqual(command.termination_reason, 'timeout')
+        # A new worker takes over.
+        self.assertNotEqual(self.run_job('0')[1], pid)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the build workspaces.
+
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import workspace
+
+
+class WorkspaceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.tmpfs_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.addCleanup(shutil.rmtree, self.tmpfs_root)
+        self.settings = {'workspace-root': self.root,
+                         'workspace-tmpfs-root': self.tmpfs_root,
+                         'workspace-tmpfs-threshold': '1M',
+                         }
+
+    def pool(self, root=None):
+        return workspace.get_pool(root or self.root)
+
+    def test_cleanup(self):
+        with workspace.build_workspace(self.settings) as build_dir:
+            self.assertEqual(os.path.dirname(build_dir), self.root)
+            self.assertEqual(os.listdir(build_dir), [])
+            with open(os.path.join(build_dir, 'file.txt'), 'w') as f:
+                f.write('content')
+        self.pool().join()
+        self.assertFalse(os.path.exists(build_dir))
+        # Only the pool's ready workspaces are left.
+        self.assertEqual(len(os.listdir(self.root)), self.pool().size)
+
+    def test_cleanup_on_failure(self):
+        try:
+            with workspace.build_workspace(self.settings) as build_dir:
+                raise ValueError()
+        except ValueError:
+            pass
+        self.pool().join()
+        self.assertFalse(os.path.exists(build_dir))
+
+    def test_tmpfs(self):
+        with workspace.build_workspace(self.settings, 1024) as build_dir:
+            self.assertEqual(os.path.dirname(build_dir), self.tmpfs_root)
+        with workspace.build_workspace(self.settings, 2 ** 30) as build_dir:
+            self.assertEqual(os.path.dirname(build_dir), self.root)
+        self.pool(self.tmpfs_root).join()
+
+    def test_orphans_are_removed(self):
+        # Assume no process has this (maximum) pid.
+        orphan = os.path.join(self.root, 'rr-4194304-abc')
+        os.mkdir(orphan)
+        pool = workspace.WorkspacePool(self.root)
+        pool.join()
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_quota(self):
+        # Other files on the root do not count against the quota.
+        with open(os.path.join(self.root, 'unrelated.bin'), 'wb') as f:
+            f.write(b'x' * 1000)
+        pool = workspace.WorkspacePool(self.root, quota=100)
+        self.assertEqual(pool.usage(), 0)
+        path = pool.acquire()
+        with open(os.path.join(path, 'file.txt'), 'wb') as f:
+            f.write(b'x' * 100)
+        self.assertRaises(workspace.QuotaExceeded, pool.acquire, 10)
+        pool.release(path)
+        pool.join()
+        pool.release(pool.acquire(10))
+        pool.join()
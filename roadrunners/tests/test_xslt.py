@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Tests for the XML helpers.
+
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import xslt
+
+COLLXML = """\
+<col:collection xmlns="http://cnx.rice.edu/collxml"
+                xmlns:col="http://cnx.rice.edu/collxml"
+                xmlns:md="http://cnx.rice.edu/mdml">
+  <metadata><md:title>Title</md:title></metadata>
+  <col:parameters>
+    <col:param name="print-font-size" value="10pt"/>
+    {0}
+  </col:parameters>
+  <col:content>
+    <col:param name="print-style" value="not-this-one"/>
+  </col:content>
+</col:collection>
+"""
+
+# Selects the parameter like oer.exports' collxml-print-style.xsl, but
+#   with a default.
+STYLESHEET = """\
+<xsl:stylesheet version="1.0"
+                xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+                xmlns:col="http://cnx.rice.edu/collxml">
+  <xsl:output method="text"/>
+  <xsl:template match="/">
+    <xsl:choose>
+      <xsl:when test="//col:parameters/col:param[@name='print-style']">
+        <xsl:value-of
+            select="//col:parameters/col:param[@name='print-style']/@value"/>
+      </xsl:when>
+      <xsl:otherwise>{0}</xsl:otherwise>
+    </xsl:choose>
+  </xsl:template>
+</xsl:stylesheet>
+"""
+
+
+class XsltTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(xslt.clear_stylesheets)
+
+    def write(self, filename, content):
+        path = os.path.join(self.directory, filename)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_extract_param(self):
+        path = self.write('collection.xml', COLLXML.format(
+            '<col:param name="print-style" value=" ccap-physics "/>'))
+        self.assertEqual(xslt.extract_collection_param(path, 'print-style'),
+                         ' ccap-physics ')
+        self.assertEqual(xslt.extract_print_style(path), 'ccap-physics')
+        # Parameters found in the content are not collection parameters.
+        path = self.write('collection.xml', COLLXML.format(''))
+        self.assertEqual(xslt.extract_collection_param(path, 'print-style'),
+                         None)
+        self.assertEqual(xslt.extract_print_style(path), '')
+
+    def test_stylesheet_fallback(self):
+        path = self.write('collection.xml', COLLXML.format(''))
+        stylesheet = self.write('print-style.xsl', STYLESHEET.format('def'))
+        self.assertEqual(xslt.extract_print_style(path, stylesheet), 'def')
+
+    def test_stylesheet_cache(self):
+        stylesheet = self.write('print-style.xsl', STYLESHEET.format('a'))
+        compiled = xslt.get_stylesheet(stylesheet)
+        self.assertTrue(xslt.get_stylesheet(stylesheet) is compiled)
+        # A modified stylesheet is compiled again.
+        self.write('print-style.xsl', STYLESHEET.format('b'))
+        mtime = os.path.getmtime(stylesheet) + 10
+        os.utime(stylesheet, (mtime, mtime))
+        recompiled = xslt.get_stylesheet(stylesheet)
+        self.assertFalse(recompiled is compiled)
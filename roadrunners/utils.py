@@ -10,66 +10,532 @@ Common utilities used in the rbit extensions.
 
 """
 import os
+import json
+import time
+import shutil
+import fnmatch
 import logging
-import subprocess
+import zipfile
+import functools
+from multiprocessing.pool import ThreadPool
+
 import requests
 
-__all__ = ('logger', 'unpack_zip', 'get_completezip', 'get_offlinezip',)
+from .cache import ArtifactCache, get_cache
+from .metrics import phase
+from .sessions import get_session
+
+__all__ = ('logger', 'unpack_zip', 'download', 'get_completezip',
+           'get_offlinezip',)
 
 logger = logging.getLogger('roadrunners')
 
-def unpack_zip(file, working_dir=None):
-    """Unpacks a zip file and returns the contents file path."""
-    # Get a listing of the current directory if we are working in
-    #   one. This is used later to differentiate the unpacked contents
-    #   from those that were previously there.
-    directory_listing = os.listdir(working_dir)
-
-    command = ['unzip', '-n', file]
-    if working_dir is not None:
-        command.extend(['-d', working_dir])
-    process = subprocess.Popen(command,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                               cwd=working_dir)
-    logger.debug("Running: " + ' '.join(command))
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        raise RuntimeError(stdout + "\n\n" + stderr)
-
-    return [x for x in os.listdir(working_dir) if x not in directory_listing]
-
-def get_zip(pkg_name, version, base_uri, working_dir, unpack=True, zipname='complete'):
+# Size of the buffer used when streaming a download to disk.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Number of times an interrupted download is resumed before giving up.
+DOWNLOAD_ATTEMPTS = 3
+# Log the download progress every so many bytes.
+PROGRESS_INTERVAL = 16 * 1024 * 1024
+# Number of threads used to unpack a zip file.
+UNPACK_WORKERS = 4
+UNPACK_CHUNK_SIZE = 256 * 1024
+# Suffix of the file holding the HTTP validators of a downloaded file.
+VALIDATORS_SUFFIX = '.validators.json'
+# Errors of a transfer that is worth retrying.
+INTERRUPTIONS = (requests.exceptions.ConnectionError,
+                 requests.exceptions.ChunkedEncodingError,
+                 requests.exceptions.Timeout,)
+
+def _zip_member_path(working_dir, name):
+    """Resolve a zip member ``name`` to a path inside ``working_dir``,
+    refusing anything that would land outside of it.
+    """
+    path = os.path.normpath(os.path.join(working_dir, name))
+    if os.path.isabs(name) or not path.startswith(working_dir + os.sep):
+        raise RuntimeError("Refusing to unpack '{0}' outside of "
+                           "'{1}'.".format(name, working_dir))
+    return path
+
+
+def _extract_members(filepath, working_dir, members):
+    """Extract the given (file) ``members`` using a private handle on the
+    zip, so that this can run alongside other threads doing the same.
+    Returns the number of bytes written.
+    """
+    written = 0
+    with zipfile.ZipFile(filepath) as zip_file:
+        for info in members:
+            path = _zip_member_path(working_dir, info.filename)
+            if os.path.exists(path):
+                # Like 'unzip -n', never overwrite existing files.
+                continue
+            # Reading the member to its end verifies its CRC, a
+            #   mismatch raises BadZipfile.
+            with zip_file.open(info) as source, open(path, 'wb') as target:
+                shutil.copyfileobj(source, target, UNPACK_CHUNK_SIZE)
+            mode = (info.external_attr >> 16) & 0o777
+            if mode:
+                os.chmod(path, mode)
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            os.utime(path, (mtime, mtime))
+            written += info.file_size
+    return written
+
+
+def unpack_zip(file, working_dir=None, patterns=None, workers=None):
+    """Unpacks a zip file and returns the contents file path.
+
+    The returned list is the manifest of the top level entries (files
+    and directories) in the zip. A relative ``file`` is taken to be
+    relative to the ``working_dir``. Existing files are never
+    overwritten. When ``patterns`` (a list of glob patterns) is given,
+    only the members matching one of them are unpacked. The members are
+    unpacked and checked against their CRC in ``workers`` threads.
+
+    """
+    if working_dir is None:
+        working_dir = os.curdir
+    working_dir = os.path.abspath(working_dir)
+    filepath = os.path.join(working_dir, file)
+    if workers is None:
+        workers = UNPACK_WORKERS
+
+    try:
+        with zipfile.ZipFile(filepath) as zip_file:
+            infolist = zip_file.infolist()
+    except (IOError, zipfile.BadZipfile) as exc:
+        raise RuntimeError("Could not unpack '{0}': {1}".format(filepath, exc))
+
+    manifest = []
+    directories = set()
+    members = []
+    seen = set()
+    for info in infolist:
+        name = info.filename
+        # When a member is listed more than once, the first one wins.
+        if name in seen:
+            continue
+        seen.add(name)
+        if patterns is not None \
+           and not any(fnmatch.fnmatch(name, p) for p in patterns):
+            continue
+        top_level = name.split('/', 1)[0]
+        if top_level not in manifest:
+            manifest.append(top_level)
+        path = _zip_member_path(working_dir, name)
+        if name.endswith('/'):
+            directories.add(path)
+        else:
+            directories.add(os.path.dirname(path))
+            members.append(info)
+
+    for path in sorted(directories):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    # Spread the members over the workers, largest first, so that
+    #   each gets about the same amount of data to inflate.
+    workers = max(1, min(workers, len(members)))
+    batches = [[] for i in range(workers)]
+    sizes = [0] * workers
+    for info in sorted(members, key=lambda x: x.file_size, reverse=True):
+        i = sizes.index(min(sizes))
+        batches[i].append(info)
+        sizes[i] += info.file_size
+
+    logger.debug("Unpacking {0} members of '{1}' in {2} thread(s).".format(
+        len(members), filepath, workers))
+    try:
+        if workers == 1:
+            written = [_extract_members(filepath, working_dir, batches[0])]
+        else:
+            pool = ThreadPool(workers)
+            try:
+                written = pool.map(
+                    functools.partial(_extract_members, filepath,
+                                      working_dir),
+                    batches)
+            finally:
+                pool.close()
+                pool.join()
+    except zipfile.BadZipfile as exc:
+        raise RuntimeError("Could not unpack '{0}': {1}".format(filepath, exc))
+    logger.debug("Unpacked {0} bytes from '{1}'.".format(sum(written),
+                                                         filepath))
+
+    return manifest
+
+
+def response_validators(response):
+    """Pick the cache validators (ETag and Last-Modified) out of an
+    HTTP response. Returns a dict, empty if the response has none.
+    """
+    validators = {}
+    for header in ('ETag', 'Last-Modified'):
+        value = response.headers.get(header)
+        if value:
+            validators[header.lower()] = value
+    return validators
+
+
+def conditional_headers(validators):
+    """Make the request headers that revalidate a previous response
+    with the given ``validators``.
+    """
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last-modified'):
+        headers['If-Modified-Since'] = validators['last-modified']
+    return headers
+
+
+def load_validators(filepath):
+    """Load the validators stored alongside ``filepath``. Returns an empty
+    dict when there are none or the file itself is missing.
+    """
+    if not os.path.exists(filepath):
+        return {}
+    try:
+        with open(filepath + VALIDATORS_SUFFIX, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_validators(filepath, validators):
+    """Store the ``validators`` of the response ``filepath`` was written
+    from alongside it. Any stale validators are removed when there are
+    none.
+    """
+    validators_filepath = filepath + VALIDATORS_SUFFIX
+    if not validators:
+        if os.path.exists(validators_filepath):
+            os.remove(validators_filepath)
+        return
+    tmp_filepath = validators_filepath + '.tmp'
+    with open(tmp_filepath, 'w') as f:
+        json.dump(validators, f)
+    os.rename(tmp_filepath, validators_filepath)
+
+
+class DownloadProgress(object):
+    """Byte counters for a single streamed download."""
+
+    def __init__(self, url, callback=None):
+        self.url = url
+        self.callback = callback
+        # Expected size of the complete file, when the server tells us.
+        self.total = None
+        # Bytes that were already on disk when the transfer (re)started.
+        self.offset = 0
+        # Bytes currently written to the (partial) file.
+        self.size = 0
+        # Bytes received over the wire, across all attempts.
+        self.received = 0
+        self.attempts = 0
+        # Set when the server confirmed the previous copy is current.
+        self.not_modified = False
+        # The validators (ETag, Last-Modified) of the response.
+        self.validators = {}
+        self._next_report = PROGRESS_INTERVAL
+
+    def update(self, nbytes):
+        self.received += nbytes
+        self.size += nbytes
+        if self.size >= self._next_report:
+            logger.debug("Downloaded {0} of {1} bytes from '{2}'.".format(
+                self.size, self.total or 'unknown', self.url))
+            self._next_report = self.size + PROGRESS_INTERVAL
+        if self.callback is not None:
+            self.callback(self)
+
+
+def _parse_content_range(value):
+    """Parse a ``Content-Range: bytes <start>-<end>/<total>`` header
+    value into a (start, total) tuple. The total is None when unknown.
+    """
+    try:
+        unit, spec = value.split(' ', 1)
+        span, total = spec.split('/', 1)
+        start = int(span.split('-', 1)[0])
+    except (AttributeError, ValueError):
+        return None, None
+    if unit != 'bytes':
+        return None, None
+    total = total != '*' and int(total) or None
+    return start, total
+
+
+def if_range_header(validators):
+    """The ``If-Range`` value to resume a transfer with the given
+    ``validators``, None when they are too weak to tell whether the
+    partial content is of the same version.
+    """
+    etag = validators.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return validators.get('last-modified') or None
+
+
+def _discard_partial(partial_filepath):
+    if os.path.exists(partial_filepath):
+        os.remove(partial_filepath)
+    save_validators(partial_filepath, {})
+
+
+def download(url, filepath, chunk_size=DOWNLOAD_CHUNK_SIZE, resume=True,
+             attempts=DOWNLOAD_ATTEMPTS, progress=None, session=None,
+             validators=None, **kwargs):
+    """Stream the body at ``url`` to ``filepath`` without holding it in
+    memory.
+
+    The body is written to ``<filepath>.part`` in ``chunk_size`` pieces
+    and renamed into place once complete. When ``resume`` is true, an
+    existing partial file (from an interrupted job or an earlier failed
+    attempt) is continued with an HTTP Range request. The request is
+    made with ``If-Range`` and the validators of the response the
+    partial file was started from, so a changed file (e.g. a new
+    ``latest``) is downloaded whole instead of being spliced onto the
+    old part. Transfers that drop mid-stream or time out are retried up
+    to ``attempts`` times.
+
+    When the ``validators`` of a previous response are given, the
+    request is made conditional. If the server answers that nothing
+    changed, the file is left untouched and the returned counters have
+    ``not_modified`` set.
+
+    The request is made using ``session`` (defaults to the module level
+    ``requests`` api); additional keyword arguments are passed through
+    to its ``get``. Returns the ``DownloadProgress`` counters for the
+    transfer.
+
+    """
+    if session is None:
+        session = requests
+    if progress is None:
+        progress = DownloadProgress(url)
+    partial_filepath = filepath + '.part'
+    extra_headers = kwargs.pop('headers', None) or {}
+    if not resume:
+        _discard_partial(partial_filepath)
+
+    while True:
+        progress.attempts += 1
+        headers = dict(extra_headers)
+        offset = 0
+        if os.path.exists(partial_filepath):
+            offset = os.path.getsize(partial_filepath)
+            if_range = if_range_header(load_validators(partial_filepath))
+            if offset and if_range is None:
+                # Nothing tells what version the part is of.
+                _discard_partial(partial_filepath)
+                offset = 0
+        if offset:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+            headers['If-Range'] = if_range
+        elif validators:
+            headers.update(conditional_headers(validators))
+        try:
+            response = session.get(url, stream=True, headers=headers,
+                                   **kwargs)
+        except INTERRUPTIONS as exc:
+            if progress.attempts >= attempts:
+                raise
+            logger.debug("Request for '{0}' failed, retrying: {1}".format(
+                url, exc))
+            continue
+        try:
+            if response.status_code == 304 and validators and not offset:
+                logger.debug("'{0}' has not been modified.".format(url))
+                progress.not_modified = True
+                progress.validators = validators
+                return progress
+            elif response.status_code == 206:
+                start, total = _parse_content_range(
+                    response.headers.get('Content-Range'))
+                if start != offset:
+                    # The server did not honor the range we asked for,
+                    #   start over rather than corrupt the file.
+                    _discard_partial(partial_filepath)
+                    continue
+                mode = 'ab'
+                logger.debug("Resuming download of '{0}' at byte "
+                             "{1}.".format(url, offset))
+            elif response.status_code == 200:
+                # Also the answer to a resume of a file that changed.
+                offset, mode = 0, 'wb'
+                total = response.headers.get('Content-Length')
+                total = total is not None and int(total) or None
+                # Keep what the part is of, to resume it safely.
+                save_validators(partial_filepath,
+                                response_validators(response))
+            elif response.status_code == 416 and offset:
+                # The partial file is no good to us, start from scratch.
+                _discard_partial(partial_filepath)
+                continue
+            else:
+                raise RuntimeError("Could not download file at '{0}' with "
+                                   "response ({1}):\n{2}".format(
+                                       url, response.status_code,
+                                       response.text))
+            progress.offset = progress.size = offset
+            progress.total = total
+            progress.validators = response_validators(response) \
+                or load_validators(partial_filepath)
+            try:
+                with open(partial_filepath, mode) as f:
+                    for chunk in response.iter_content(chunk_size):
+                        if chunk:
+                            f.write(chunk)
+                            progress.update(len(chunk))
+            except INTERRUPTIONS as exc:
+                if progress.attempts >= attempts:
+                    raise
+                logger.debug("Download of '{0}' interrupted at byte {1}, "
+                             "retrying: {2}".format(url, progress.size, exc))
+                continue
+        finally:
+            response.close()
+
+        if progress.total is not None and progress.size < progress.total:
+            if progress.attempts >= attempts:
+                raise RuntimeError("Incomplete download of '{0}', received "
+                                   "{1} of {2} bytes.".format(
+                                       url, progress.size, progress.total))
+            continue
+        break
+
+    os.rename(partial_filepath, filepath)
+    save_validators(partial_filepath, {})
+    logger.debug("Downloaded '{0}' ({1} bytes, {2} attempt(s)).".format(
+        url, progress.size, progress.attempts))
+    return progress
+
+
+def resolve_zip_version(filepath):
+    """Find the collection version of a complete or offline zip from
+    its top level directory, named ``<id>_<version>_complete``.
+    """
+    try:
+        with zipfile.ZipFile(filepath) as zip_file:
+            names = zip_file.namelist()
+    except zipfile.BadZipfile:
+        return None
+    if not names:
+        return None
+    parts = names[0].split('/', 1)[0].split('_')
+    if len(parts) != 3:
+        return None
+    return parts[1]
+
+
+def _fetch_zip(url, filepath, base_uri, pkg_name, version, zipname,
+               settings):
+    """Put the zip at ``url`` in place at ``filepath``, from the shared
+    artifact cache when possible. Returns the number of bytes received
+    from the repository.
+    """
+    session = get_session(base_uri, settings)
+    cache = get_cache(settings)
+    received = 0
+    if cache is None:
+        # Stream the zip to disk, revalidating a copy left over from
+        #   an earlier run.
+        progress = download(url, filepath, session=session,
+                            validators=load_validators(filepath))
+        received += progress.received
+        if not progress.not_modified:
+            save_validators(filepath, progress.validators)
+    elif version == 'latest':
+        # 'latest' is a moving target. The last copy is kept in the
+        #   cache with its validators so it can be revalidated, it is
+        #   shared with other jobs under the version it resolves to.
+        latest_key = ArtifactCache.make_key(base_uri, pkg_name, version,
+                                            zipname)
+        entry = cache.get_entry(latest_key) or {}
+        progress = download(url, filepath, session=session,
+                            validators=entry.get('validators'))
+        received += progress.received
+        if progress.not_modified \
+           and cache.fetch(latest_key, filepath) is None:
+            # The content is gone from the cache after all.
+            progress = download(url, filepath, session=session)
+            received += progress.received
+        if not progress.not_modified:
+            info = dict(host=base_uri, id=pkg_name, zipname=zipname)
+            cache.store(latest_key, filepath, version=version,
+                        validators=progress.validators, **info)
+            resolved_version = resolve_zip_version(filepath)
+            if resolved_version is not None:
+                key = ArtifactCache.make_key(base_uri, pkg_name,
+                                             resolved_version, zipname)
+                cache.alias(latest_key, key, version=resolved_version,
+                            validators={})
+    else:
+        key = ArtifactCache.make_key(base_uri, pkg_name, version, zipname)
+        if cache.fetch(key, filepath) is None:
+            # Only one of the concurrent jobs needing this zip fetches
+            #   it, the others wait for it to show up in the cache.
+            with cache.lock(key):
+                if cache.fetch(key, filepath) is None:
+                    progress = download(url, filepath, session=session)
+                    received += progress.received
+                    cache.store(key, filepath, host=base_uri, id=pkg_name,
+                                version=version, zipname=zipname)
+    return received
+
+
+def get_zip(pkg_name, version, base_uri, working_dir, unpack=True,
+            zipname='complete', settings={}):
     """"Acquire the collection data from a (Plone based) Connexions
     repository in the completezip format.
 
     An assumption is made that the working_dir is empty. This is so that
     the unpacked contents can be discovered.
 
+    The ``settings`` are those of the calling runner, they are used to
+    configure the connection to the repository (see
+    ``roadrunners.sessions.get_session``) and the shared artifact cache
+    (see ``roadrunners.cache.get_cache``).
+
     """
     filename = "{0}-{1}.{2}.zip".format(pkg_name, version, zipname)
     url = '{0}/content/{1}/{2}/{3}'.format(base_uri, pkg_name, version, zipname)
-
-    # Download the completezip
-    response = requests.get(url)
-    if response.status_code != 200:
-        raise RuntimeError("Could not download file at '{0}' with "
-                           "response ({1}):\n{2}".format(url,
-                                                         response.status_code,
-                                                         response.text))
     filepath = os.path.join(working_dir, filename)
-    with open(filepath, 'wb') as f:
-        f.write(response.content)
+
+    with phase('fetch') as fetching:
+        fetching.bytes = _fetch_zip(url, filepath, base_uri, pkg_name,
+                                    version, zipname, settings)
 
     if unpack is True:
-        unpacked_file_list = unpack_zip(filename, working_dir)
+        with phase('unpack') as unpacking:
+            unpacked_file_list = unpack_zip(filename, working_dir)
+            unpacking.bytes = os.path.getsize(filepath)
         unpacked_filename = unpacked_file_list[0]
         return unpacked_filename
     else:
         return os.path.join(working_dir, filename)
 
 
-def get_completezip(pkg_name, version, base_uri, working_dir, unpack=True, zipname='complete'):
-    return get_zip(pkg_name, version, base_uri, working_dir, unpack, zipname)
+def cached_zip_size(pkg_name, version, base_uri, zipname, settings={}):
+    """Size in bytes of a completezip or offlinezip, if it is known to
+    the shared artifact cache. Returns None otherwise.
+    """
+    cache = get_cache(settings)
+    if cache is None:
+        return None
+    key = ArtifactCache.make_key(base_uri, pkg_name, version, zipname)
+    entry = cache.get_entry(key)
+    return entry and entry['size'] or None
+
+
+def get_completezip(pkg_name, version, base_uri, working_dir, unpack=True,
+                    zipname='complete', settings={}):
+    return get_zip(pkg_name, version, base_uri, working_dir, unpack, zipname,
+                   settings)
 
-def get_offlinezip(pkg_name, version, base_uri, working_dir, unpack=True, zipname='offline'):
-    return get_zip(pkg_name, version, base_uri, working_dir, unpack, zipname)
+def get_offlinezip(pkg_name, version, base_uri, working_dir, unpack=True,
+                   zipname='offline', settings={}):
+    return get_zip(pkg_name, version, base_uri, working_dir, unpack, zipname,
+                   settings)
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+A long-lived python process that runs the oer.exports scripts.
+
+Starting a new interpreter for every job means paying for the startup,
+the imports (lxml) and the XSL compilation each time. The worker does
+that once and then runs the scripts in-process, one job at a time, as
+requested over its stdin/stdout pipe (one JSON document per line). It
+retires itself after a number of jobs or once its memory use grows
+past a limit, and a new one is started on the next job.
+
+The worker side of this module only depends on the standard library,
+since it runs under the python configured for oer.exports.
+
+"""
+import os
+import sys
+import json
+import atexit
+import shutil
+import runpy
+import logging
+import tempfile
+import threading
+import traceback
+import subprocess
+
+from .command import Command, make_command, run_command
+from .config import asbool, assize
+from .limits import get_limits
+
+__all__ = ('OerExportsWorker', 'get_worker', 'run_script',)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_JOBS = 50
+DEFAULT_MAX_MEMORY = 1024 ** 3
+DEFAULT_PRELOAD = 'lxml.etree'
+# The roadrunners package directory.
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+_import_dir = []
+_import_dir_lock = threading.Lock()
+
+
+def _import_path():
+    """A directory holding nothing but (a link to) the roadrunners
+    package, for the worker's PYTHONPATH. The directory the package is
+    installed in, e.g. the runners' site-packages, could shadow the
+    packages of the oer.exports python.
+    """
+    with _import_dir_lock:
+        if not _import_dir:
+            directory = tempfile.mkdtemp(prefix='rr-worker-path-')
+            os.symlink(_PACKAGE_DIR, os.path.join(directory, 'roadrunners'))
+            atexit.register(shutil.rmtree, directory, True)
+            _import_dir.append(directory)
+        return _import_dir[0]
+
+
+def _memory_usage():
+    """Resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        import resource
+        # Linux reports the peak in kilobytes.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run_job(script, args, cwd):
+    """Run ``script`` as ``__main__`` with ``args`` in ``cwd``, capturing
+    everything written to the stdout and stderr file descriptors.
+    Returns a (returncode, stdout, stderr) tuple, where the outputs are
+    temporary files.
+    """
+    outputs = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+    saved_fds = [os.dup(1), os.dup(2)]
+    saved_state = (list(sys.argv), list(sys.path), os.getcwd())
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(outputs[0].fileno(), 1)
+    os.dup2(outputs[1].fileno(), 2)
+    returncode = 0
+    try:
+        os.chdir(cwd)
+        sys.argv = [script] + list(args)
+        sys.path.insert(0, os.path.dirname(script))
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as exc:
+        if exc.code is None:
+            returncode = 0
+        elif isinstance(exc.code, int):
+            returncode = exc.code
+        else:
+            sys.stderr.write(str(exc.code) + '\n')
+            returncode = 1
+    except:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        for fd in saved_fds:
+            os.close(fd)
+        sys.argv[:], sys.path[:] = saved_state[:2]
+        os.chdir(saved_state[2])
+    for output in outputs:
+        output.seek(0)
+    return returncode, outputs[0], outputs[1]
+
+
+def serve(max_jobs=DEFAULT_MAX_JOBS, max_memory=DEFAULT_MAX_MEMORY,
+          preload=()):
+    """The worker's main loop. Requests are read from stdin and the
+    replies written to the original stdout, which is kept apart from the
+    output of the jobs.
+    """
+    requests = sys.stdin
+    replies = os.fdopen(os.dup(1), 'w')
+    # Nothing but the jobs' output goes to the regular stdout.
+    os.dup2(2, 1)
+    for name in preload:
+        __import__(name)
+
+    jobs = 0
+    for line in iter(requests.readline, ''):
+        request = json.loads(line)
+        script, args = request.pop('script'), request.pop('args')
+        command = Command([script] + args, **request)
+        returncode, stdout, stderr = _run_job(script, args, command.cwd)
+        command.returncode = returncode
+        # Log the output and keep its tail, as if the job ran in a
+        #   process of its own.
+        command.consume(stdout, stderr)
+        jobs += 1
+        memory = _memory_usage()
+        retire = jobs >= max_jobs or memory >= max_memory
+        replies.write(json.dumps({
+            'returncode': returncode,
+            # The outputs are bytes, which JSON can not carry as such.
+            'stdout': command.stdout.decode('latin-1'),
+            'stderr': command.stderr.decode('latin-1'),
+            'stdout_lines': command.stdout_lines,
+            'stderr_lines': command.stderr_lines,
+            'stdout_bytes': command.stdout_bytes,
+            'stderr_bytes': command.stderr_bytes,
+            'jobs': jobs,
+            'memory': memory,
+            'retire': retire,
+            }) + '\n')
+        replies.flush()
+        if retire:
+            break
+
+
+class OerExportsWorker(object):
+    """Client side of a worker process running under ``python`` with the
+    oer.exports package in ``oerexports_dir``. The process is started on
+    the first job and restarted after it retires. The resource
+    ``limits`` apply to the worker process as a whole.
+    """
+
+    def __init__(self, python, oerexports_dir, max_jobs=DEFAULT_MAX_JOBS,
+                 max_memory=DEFAULT_MAX_MEMORY, preload=(), limits=None):
+        self.python = python
+        self.oerexports_dir = oerexports_dir
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.preload = list(preload)
+        self.limits = limits
+        self.pid = os.getpid()
+        self.process = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        command = [self.python, '-m', __name__,
+                   '--max-jobs', str(self.max_jobs),
+                   '--max-memory', str(self.max_memory),
+                   ]
+        for name in self.preload:
+            command.extend(['--preload', name])
+        env = dict(os.environ)
+        pythonpath = [_import_path(), self.oerexports_dir]
+        if env.get('PYTHONPATH'):
+            pythonpath.append(env['PYTHONPATH'])
+        env['PYTHONPATH'] = os.pathsep.join(pythonpath)
+        logger.debug("Starting worker: " + ' '.join(command))
+        self.process = subprocess.Popen(command,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        cwd=self.oerexports_dir, env=env,
+                                        close_fds=True,
+                                        preexec_fn=self._preexec)
+
+    def _preexec(self):
+        # In a session of its own, so that it can be killed along with
+        #   what it started.
+        os.setsid()
+        if self.limits is not None:
+            self.limits.apply()
+
+    def run(self, command):
+        """Run the oer.exports script ``command`` (a
+        ``roadrunners.command.Command``, with the script and its
+        arguments as args) in the worker, instead of in a process of its
+        own. Returns the command's exit status.
+        """
+        script, args = command.args[0], list(command.args[1:])
+        request = {'script': script, 'args': args, 'cwd': command.cwd,
+                   'log_path': command.log_path,
+                   'log_max_size': command.log_max_size,
+                   'log_backups': command.log_backups,
+                   'tail_lines': command.tail_lines,
+                   }
+        logger.debug("Running in worker: " + command.description)
+        with self._lock:
+            if self.process is None or self.process.poll() is not None:
+                self._start()
+            # The time limits apply to the worker while it runs the job;
+            #   when they are exceeded the worker is killed.
+            command.watch(self.process)
+            try:
+                self.process.stdin.write(json.dumps(request) + '\n')
+                self.process.stdin.flush()
+                line = self.process.stdout.readline()
+            except (IOError, OSError):
+                line = ''
+            finally:
+                command.unwatch()
+            if not line:
+                # The worker died while running the job, possibly
+                #   taking down the interpreter (e.g. in lxml).
+                returncode = self.process.wait()
+                self.process = None
+                command.returncode = returncode or -1
+                command.stderr_tail.append(
+                    "The worker process exited ({0}) while running "
+                    "'{1}'.".format(returncode, script))
+                return command.returncode
+            reply = json.loads(line)
+            if reply['retire']:
+                logger.debug("Retiring worker after {0} job(s) at {1} "
+                             "bytes.".format(reply['jobs'], reply['memory']))
+                self.close()
+        command.returncode = reply['returncode']
+        for name in ('stdout', 'stderr'):
+            output = reply[name].encode('latin-1')
+            getattr(command, name + '_tail').extend(output.splitlines(True))
+            for counter in ('_lines', '_bytes'):
+                setattr(command, name + counter, reply[name + counter])
+        command.classify_failure()
+        return command.returncode
+
+    def close(self):
+        """Stop the worker process."""
+        process, self.process = self.process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        process.wait()
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def get_worker(settings):
+    """Return the process-wide oer.exports worker configured in the runner
+    ``settings`` or None if the worker is not enabled.
+
+    Available settings:
+
+    - **oer.exports-worker** - Run the oer.exports scripts in a
+      long-lived worker process. (default: false)
+    - **oer.exports-worker-max-jobs** - Number of jobs after which the
+      worker is replaced. (default: 50)
+    - **oer.exports-worker-max-memory** - Memory use after which the
+      worker is replaced, e.g. ``512M``. (default: 1G)
+    - **oer.exports-worker-preload** - Modules imported when the worker
+      starts. (default: lxml.etree)
+
+    The **command-max-*** resource limits, except the CPU time, apply to
+    the worker process as a whole.
+
+    """
+    if not asbool(settings.get('oer.exports-worker', False)):
+        return None
+    python = settings.get('python', sys.executable)
+    oerexports_dir = settings['oer.exports-dir']
+    key = (python, os.path.abspath(oerexports_dir))
+    with _workers_lock:
+        worker = _workers.get(key)
+        if worker is None or worker.pid != os.getpid():
+            max_jobs = int(settings.get('oer.exports-worker-max-jobs',
+                                        DEFAULT_MAX_JOBS))
+            max_memory = assize(settings.get('oer.exports-worker-max-memory',
+                                             DEFAULT_MAX_MEMORY))
+            preload = settings.get('oer.exports-worker-preload',
+                                   DEFAULT_PRELOAD).split()
+            limits = get_limits(settings)
+            if limits is not None:
+                # The CPU time would add up over the worker's jobs,
+                #   command-cpu-timeout applies per job instead.
+                limits = limits.without_cpu_time()
+            worker = OerExportsWorker(python, oerexports_dir,
+                                      max_jobs=max_jobs,
+                                      max_memory=max_memory,
+                                      preload=preload, limits=limits)
+            _workers[key] = worker
+        return worker
+
+
+def run_script(script, args, cwd, settings, log_name=None):
+    """Run an oer.exports ``script`` with ``args`` in the ``cwd``
+    directory, in the worker when it is enabled or else in a new python
+    process. Returns the finished ``roadrunners.command.Command``; see
+    ``roadrunners.command.run_command`` for the ``log_name`` and the
+    output settings.
+    """
+    worker = get_worker(settings)
+    if worker is not None:
+        command = make_command([script] + list(args), cwd, settings,
+                               log_name)
+        worker.run(command)
+        return command
+    python_executable = settings.get('python', sys.executable)
+    return run_command([python_executable, script] + list(args), cwd,
+                       settings, log_name)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="oer.exports worker")
+    parser.add_argument('--max-jobs', type=int, default=DEFAULT_MAX_JOBS)
+    parser.add_argument('--max-memory', type=int, default=DEFAULT_MAX_MEMORY)
+    parser.add_argument('--preload', action='append', default=[])
+    args = parser.parse_args(argv)
+    serve(args.max_jobs, args.max_memory, args.preload)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+Build workspaces (temporary directories) for the runners.
+
+Workspaces are handed out from a pool of ready made directories and are
+removed in a background thread once the job is done with them, whether
+it succeeded or not. Directories left behind by dead processes are
+cleaned up the next time a pool is created on the same root.
+
+"""
+import os
+import re
+import time
+import errno
+import Queue
+import shutil
+import logging
+import tempfile
+import threading
+import contextlib
+
+from .config import assize
+from .metrics import phase
+
+__all__ = ('build_workspace', 'get_pool', 'QuotaExceeded',)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 2
+# Seconds to wait on pending cleanups to free up quota.
+QUOTA_WAIT = 60
+_WORKSPACE_PREFIX = 'rr-'
+_WORKSPACE_NAME = re.compile(r'^rr-(\d+)-.*?(\.trash)?$')
+
+
+class QuotaExceeded(Exception):
+    """Raised when there is not enough room left for a workspace."""
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+def _disk_usage(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class WorkspacePool(object):
+    """A pool of workspaces on the ``root`` directory.
+
+    ``size`` empty directories are kept ready for use. Released
+    workspaces are renamed out of the way at once and removed by a
+    background thread. When a ``quota`` (in bytes) is given, a workspace
+    is only handed out while the workspaces on the root use less than
+    that.
+
+    """
+
+    def __init__(self, root, size=DEFAULT_POOL_SIZE, quota=None):
+        self.root = os.path.abspath(root)
+        self.size = size
+        self.quota = quota
+        self.pid = os.getpid()
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self._ready = []
+        self._lock = threading.Lock()
+        self._trash = Queue.Queue()
+        self._cleaner = threading.Thread(target=self._clean,
+                                         name='workspace-cleaner')
+        self._cleaner.daemon = True
+        self._cleaner.start()
+        self._collect_orphans()
+        self._trash.put(None)  # replenish the pool
+
+    def _collect_orphans(self):
+        """Queue the removal of workspaces of processes that died."""
+        for name in os.listdir(self.root):
+            match = _WORKSPACE_NAME.match(name)
+            if match is None:
+                continue
+            pid = int(match.group(1))
+            if pid != os.getpid() and not _pid_alive(pid):
+                logger.debug("Removing orphaned workspace '{0}'.".format(name))
+                self._trash.put(os.path.join(self.root, name))
+
+    def _make(self):
+        prefix = '{0}{1}-'.format(_WORKSPACE_PREFIX, os.getpid())
+        return tempfile.mkdtemp(prefix=prefix, dir=self.root)
+
+    def _replenish(self):
+        while True:
+            with self._lock:
+                if len(self._ready) >= self.size:
+                    return
+            path = self._make()
+            with self._lock:
+                self._ready.append(path)
+
+    def _clean(self):
+        while True:
+            path = self._trash.get()
+            try:
+                if path is not None:
+                    shutil.rmtree(path, ignore_errors=True)
+                self._replenish()
+            except Exception:
+                logger.exception("Failed to clean up workspaces.")
+            finally:
+                self._trash.task_done()
+
+    def usage(self):
+        """Bytes used by the workspaces on the root, including those
+        waiting to be removed. Anything else on the root is not counted.
+        """
+        total = 0
+        for name in os.listdir(self.root):
+            if _WORKSPACE_NAME.match(name) is not None:
+                total += _disk_usage(os.path.join(self.root, name))
+        return total
+
+    def _check_quota(self, expected_size):
+        if self.quota is None:
+            return
+        deadline = time.time() + QUOTA_WAIT
+        while True:
+            usage = self.usage()
+            if usage + (expected_size or 0) <= self.quota:
+                return
+            if self._trash.unfinished_tasks == 0 or time.time() > deadline:
+                break
+            # Pending cleanups may free up enough room.
+            time.sleep(0.5)
+        raise QuotaExceeded("Workspaces on '{0}' use {1} bytes, which "
+                            "leaves no room for another {2} bytes under "
+                            "the {3} byte quota.".format(
+                                self.root, usage, expected_size or 0,
+                                self.quota))
+
+    def acquire(self, expected_size=None):
+        """Hand out an empty workspace directory."""
+        self._check_quota(expected_size)
+        with self._lock:
+            path = self._ready and self._ready.pop() or None
+        if path is None or not os.path.isdir(path):
+            path = self._make()
+        self._trash.put(None)  # replenish the pool
+        return path
+
+    def release(self, path):
+        """Give back a workspace. Its removal happens in the background."""
+        trash = path + '.trash'
+        try:
+            os.rename(path, trash)
+        except OSError:
+            trash = path
+        self._trash.put(trash)
+
+    def join(self):
+        """Wait for the pending cleanups to finish."""
+        self._trash.join()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(root, size=DEFAULT_POOL_SIZE, quota=None):
+    """Return the process-wide workspace pool for ``root``. The pool is
+    configured by the first caller.
+    """
+    key = os.path.abspath(root)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.pid != os.getpid():
+            pool = WorkspacePool(root, size=size, quota=quota)
+            _pools[key] = pool
+        return pool
+
+
+@contextlib.contextmanager
+def build_workspace(settings, expected_size=None):
+    """Provide a build directory for the duration of the context. The
+    directory and everything in it is removed afterwards, also when the
+    build fails.
+
+    Available settings:
+
+    - **workspace-root** - Directory the workspaces are made in.
+      (default: the system's temporary directory)
+    - **workspace-pool-size** - Number of workspaces kept ready for use.
+      (default: 2)
+    - **workspace-quota** - Disk space the workspaces on the root may
+      use, e.g. ``50G``. (default: unlimited)
+    - **workspace-tmpfs-root** - Directory on a memory backed filesystem
+      for small builds.
+    - **workspace-tmpfs-threshold** - Builds with an ``expected_size``
+      (in bytes) below this size are made on the tmpfs root, e.g.
+      ``64M``.
+    - **workspace-tmpfs-quota** - As workspace-quota, for the tmpfs root.
+
+    """
+    size = int(settings.get('workspace-pool-size', DEFAULT_POOL_SIZE))
+    root = settings.get('workspace-root', None) or tempfile.gettempdir()
+    quota = settings.get('workspace-quota', None)
+
+    tmpfs_root = settings.get('workspace-tmpfs-root', None)
+    threshold = settings.get('workspace-tmpfs-threshold', None)
+    if tmpfs_root and threshold is not None and expected_size is not None \
+       and expected_size < assize(threshold):
+        root = tmpfs_root
+        quota = settings.get('workspace-tmpfs-quota', None)
+    if quota is not None:
+        quota = assize(quota)
+
+    pool = get_pool(root, size=size, quota=quota)
+    build_dir = pool.acquire(expected_size)
+    logger.debug("Working in '{0}'.".format(build_dir))
+    try:
+        yield build_dir
+    finally:
+        with phase('cleanup'):
+            pool.release(build_dir)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+XML helpers shared by the runners: a per-process cache of compiled XSLT
+stylesheets and a streaming reader for the collection parameters.
+
+"""
+import os
+import logging
+import threading
+
+from lxml import etree
+
+__all__ = ('get_stylesheet', 'clear_stylesheets', 'extract_collection_param',
+           'extract_print_style',)
+
+logger = logging.getLogger(__name__)
+
+COLLXML_NS = 'http://cnx.rice.edu/collxml'
+_PARAM_TAG = '{{{0}}}param'.format(COLLXML_NS)
+_CONTENT_TAG = '{{{0}}}content'.format(COLLXML_NS)
+
+_stylesheets = {}
+_stylesheets_lock = threading.Lock()
+
+
+def get_stylesheet(path):
+    """Return the compiled ``etree.XSLT`` for the stylesheet at ``path``.
+    Stylesheets are compiled once per process and again only when the
+    file is modified.
+    """
+    path = os.path.abspath(path)
+    mtime = os.path.getmtime(path)
+    with _stylesheets_lock:
+        cached = _stylesheets.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    logger.debug("Compiling stylesheet '{0}'.".format(path))
+    xslt = etree.XSLT(etree.parse(path))
+    with _stylesheets_lock:
+        _stylesheets[path] = (mtime, xslt)
+    return xslt
+
+
+def clear_stylesheets():
+    """Forget all the compiled stylesheets."""
+    with _stylesheets_lock:
+        _stylesheets.clear()
+
+
+def extract_collection_param(collxml_path, name):
+    """Read the value of the ``name`` parameter from a collection.xml
+    file, without building the whole document tree. Reading stops at the
+    parameter or at the start of the collection's content, which is
+    where the parameters end. Returns None when the parameter is not
+    found.
+    """
+    context = etree.iterparse(collxml_path, events=('start', 'end'))
+    try:
+        for event, element in context:
+            if event == 'start':
+                if element.tag == _CONTENT_TAG:
+                    break
+                continue
+            if element.tag == _PARAM_TAG and element.get('name') == name:
+                return element.get('value')
+            # Keep memory flat for whatever precedes the parameters.
+            element.clear()
+    finally:
+        del context
+    return None
+
+
+def extract_print_style(collxml_path, stylesheet_path=None):
+    """Find the print-style of a collection. The parameter is read
+    directly when present, otherwise the result of the
+    ``stylesheet_path`` (collxml-print-style.xsl) is used, so that its
+    defaults still apply.
+    """
+    printstyle = extract_collection_param(collxml_path, 'print-style')
+    if printstyle is not None or stylesheet_path is None:
+        return (printstyle or '').strip()
+    xslt = get_stylesheet(stylesheet_path)
+    return str(xslt(etree.parse(collxml_path))).strip()
@@ -33,6 +33,11 @@ setup(
     install_requires=install_requirements,
     tests_require = test_requirements,
     entry_points = """\
+    [console_scripts]
+    roadrunners-batch = roadrunners.batch:main
+    roadrunners-dispatch = roadrunners.dispatch:main
+    roadrunners-index = roadrunners.index:main
+    roadrunners-retention = roadrunners.retention:main
     """,
     test_suite='roadrunners.tests',
     )